@@ -3,6 +3,44 @@ Salt execution module for managing AppImage applications.
 
 This module provides functions to download and install AppImages to a global
 executable directory with proper permissions.
+
+HTTP(S) downloads reuse keep-alive connections to each host. They are written
+to a `.part` file in `/var/cache/salt/appimage/downloads`, hashed as they are
+written, and renamed into place once complete and verified. Interrupted
+downloads are resumed with HTTP range requests, within the same run and by
+later runs. Progress is logged every few seconds.
+
+Checksums of installed AppImages are recorded in
+`/var/lib/salt/appimage/manifest.json` with the size, modification time and
+inode of the file they were computed from. Installed files are only hashed
+again if one of those changed.
+
+AppImages are installed atomically: the new file is staged in the target
+directory, hard linked from the download if both are on the same filesystem
+and otherwise cloned with a reflink or `copy_file_range`, then renamed over
+the installed file. The replaced file is kept as a backup named
+`<name>.<timestamp>.bak` in `/var/lib/salt/appimage/backups/<target_dir>`,
+outside of the executable search path, and only the newest `keep_backups`
+backups of each AppImage are kept.
+
+If `store_dir` is set AppImages are kept in a content addressed store
+instead, as `<store_dir>/<sha256>/<name>.AppImage`, and `<target_dir>/<name>`
+is a symlink to the installed version. Installing a version which is already
+stored, or rolling back with `rollback`, only swaps the symlink. Identical
+AppImages installed under different names are stored once. The newest
+`keep_versions` versions of each AppImage are kept, older versions are removed
+once no AppImage uses them. Backups are not made for stored AppImages.
+
+`download_many` downloads several AppImages at once, the number of concurrent
+downloads can be configured in the Salt minion configuration file:
+
+```yaml
+appimage:
+  max_parallel_downloads: 4
+  keep_backups: 1
+  store_dir: /opt/appimages
+  keep_versions: 3
+```
 """
 
 import os
@@ -10,14 +48,87 @@ import stat
 import hashlib
 import logging
 import shutil
-from typing import Optional, Dict, Any
+import glob
+import fcntl
+import json
+import tempfile
+import threading
+import time
+import concurrent.futures
+import contextvars
+from typing import Optional, Dict, Any, List, Tuple
 
 from salt.exceptions import CommandExecutionError, SaltInvocationError
+from salt_phases import timed_phase
+from salt_trace import trace_span
+
+try:
+    import requests
+    import requests.adapters
+
+    HAS_REQUESTS = True
+except ImportError:
+    HAS_REQUESTS = False
 
 log = logging.getLogger(__name__)
 
 __virtualname__ = "appimage"
 
+OPTS_PARENT_KEY = "appimage"
+OPTS_MAX_PARALLEL_DOWNLOADS_KEY = "max_parallel_downloads"
+OPTS_KEEP_BACKUPS_KEY = "keep_backups"
+OPTS_STORE_DIR_KEY = "store_dir"
+OPTS_KEEP_VERSIONS_KEY = "keep_versions"
+
+DEFAULT_MAX_PARALLEL_DOWNLOADS = 4
+DEFAULT_KEEP_BACKUPS = 1
+DEFAULT_KEEP_VERSIONS = 3
+
+# Records the versions of each AppImage in the store, see _read_store_index
+STORE_INDEX_FILE = "index.json"
+
+# ioctl which makes a file share the data blocks of another file, from linux/fs.h
+FICLONE = 0x40049409
+
+# Bytes read from the network at a time
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Seconds to wait for a connection or for data
+DOWNLOAD_TIMEOUT = 60
+
+# Downloads and partial downloads, only accessible by root
+DOWNLOAD_DIR = "/var/cache/salt/appimage/downloads"
+
+# Times an interrupted download is resumed before giving up
+DOWNLOAD_RETRIES = 5
+
+# Seconds between download progress log messages
+PROGRESS_INTERVAL = 10
+
+# Partial downloads not resumed for this many seconds are removed by clean_downloads
+PARTIAL_DOWNLOAD_MAX_AGE = 7 * 24 * 3600
+
+# Replaced AppImages, by the path they were installed at, only accessible by root
+BACKUP_DIR = "/var/lib/salt/appimage/backups"
+
+# Checksums of installed files, see _installed_checksum
+MANIFEST_PATH = "/var/lib/salt/appimage/manifest.json"
+
+# Bytes read from disk at a time when hashing, large reads let hashlib release the GIL for longer
+HASH_CHUNK_SIZE = 1024 * 1024
+
+CONTEXT_MANIFEST_KEY = "appimage.manifest"
+
+# Concurrent checks and installs update the same manifest
+_manifest_lock = threading.Lock()
+
+# Installs, rollbacks and garbage collection update the same store index
+_store_lock = threading.Lock()
+
+# Shared by concurrent downloads, which reuse its connections to each host
+_session = None
+_session_lock = threading.Lock()
+
 
 def __virtual__():
     """
@@ -33,6 +144,8 @@ def installed(
     checksum: Optional[str] = None,
     checksum_type: str = "sha256",
     force: bool = False,
+    downloaded_path: Optional[str] = None,
+    downloaded_sha256: Optional[str] = None,
 ) -> Dict[str, Any]:
     """
     Download and install an AppImage to a global executable directory.
@@ -49,7 +162,14 @@ def installed(
     :type checksum_type: str
     :param force: Force download even if file exists
     :type force: bool
-    :return: Dict with 'result', 'comment', 'changes' keys
+    :param downloaded_path: Path of the source already downloaded and verified by download_many,
+                            the source is downloaded if None
+    :type downloaded_path: str or None
+    :param downloaded_sha256: SHA256 checksum of downloaded_path if download_many computed it,
+                              the download is hashed if it is needed and None
+    :type downloaded_sha256: str or None
+    :return: Dict with 'result', 'comment', 'changes' and 'phases' keys. Phases are the seconds
+             spent checking the installed file, downloading, hashing the download and copying it into place
     :rtype: dict
 
     CLI Example:
@@ -61,22 +181,26 @@ def installed(
     """
     target_path = os.path.join(target_dir, name)
     changes = {}
+    phases = {}
 
     # Check if already installed and not forcing reinstall
     if os.path.exists(target_path) and not force:
         if checksum:
-            existing_checksum = _get_file_checksum(target_path, checksum_type)
+            with timed_phase(phases, "check"):
+                existing_checksum = _installed_checksum(target_path, checksum_type)
             if existing_checksum == checksum:
                 return {
                     "result": True,
                     "comment": f"AppImage {name} is already installed with correct checksum",
                     "changes": {},
+                    "phases": phases,
                 }
         else:
             return {
                 "result": True,
                 "comment": f"AppImage {name} is already installed (use force=True to reinstall)",
                 "changes": {},
+                "phases": phases,
             }
 
     # Create target directory if it doesn't exist
@@ -88,41 +212,222 @@ def installed(
             raise CommandExecutionError(f"Failed to create directory {target_dir}: {e}")
 
     # Download the AppImage
-    try:
-        downloaded_path = _download_file(source, checksum, checksum_type)
-        changes["downloaded"] = source
-    except Exception as e:
-        raise CommandExecutionError(f"Failed to download AppImage from {source}: {e}")
+    remove_download = False
+    digests = {}
+    if checksum:
+        digests[checksum_type] = checksum
+    if downloaded_path is None:
+        try:
+            downloaded_path = _download_file(source, checksum, checksum_type, phases=phases, digests=digests)
+        except Exception as e:
+            raise CommandExecutionError(f"Failed to download AppImage from {source}: {e}")
+        remove_download = os.path.dirname(downloaded_path) == DOWNLOAD_DIR
+    elif downloaded_sha256 is not None:
+        digests["sha256"] = downloaded_sha256
+    changes["downloaded"] = source
 
-    # Move to target location
-    try:
-        # If target exists and we're forcing, back it up first
-        if os.path.exists(target_path):
-            backup_path = f"{target_path}.bak"
-            os.rename(target_path, backup_path)
-            changes["backup"] = backup_path
-
-        # Copy downloaded file to target
-        __salt__["file.copy"](downloaded_path, target_path, remove_existing=True)
-        changes["installed"] = target_path
-    except Exception as e:
-        raise CommandExecutionError(f"Failed to install AppImage to {target_path}: {e}")
-
-    # Set executable permissions
-    try:
-        # rwxr-xr-x (755)
-        os.chmod(target_path, stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
-        changes["permissions"] = "755"
-    except OSError as e:
-        raise CommandExecutionError(f"Failed to set permissions on {target_path}: {e}")
+    store_dir = __opts__.get(OPTS_PARENT_KEY, {}).get(OPTS_STORE_DIR_KEY)
+    if store_dir:
+        digest = digests.get("sha256")
+        if digest is None:
+            with timed_phase(phases, "hash"):
+                digest = _get_file_checksum(downloaded_path, "sha256")
+
+        with timed_phase(phases, "copy"):
+            try:
+                _add_to_store(store_dir, downloaded_path, name, digest, link=os.path.dirname(downloaded_path) == DOWNLOAD_DIR)
+                _activate_version(store_dir, target_path, digest)
+            except OSError as e:
+                raise CommandExecutionError(f"Failed to install AppImage to {target_path}: {e}")
+
+            changes["installed"] = target_path
+            changes["version"] = digest
+            changes["permissions"] = "755"
+
+            if checksum:
+                _record_checksum(target_path, checksum_type, checksum)
+    else:
+        with timed_phase(phases, "copy"):
+            # Stage next to the target so it can be renamed into place
+            try:
+                staged_path = _stage_file(
+                    downloaded_path,
+                    target_dir,
+                    name,
+                    link=os.path.dirname(downloaded_path) == DOWNLOAD_DIR,
+                )
+            except OSError as e:
+                raise CommandExecutionError(f"Failed to install AppImage to {target_path}: {e}")
+
+            try:
+                # Set executable permissions before it is installed, rwxr-xr-x (755)
+                try:
+                    os.chmod(staged_path, stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
+                    changes["permissions"] = "755"
+                except OSError as e:
+                    raise CommandExecutionError(f"Failed to set permissions on {target_path}: {e}")
+
+                try:
+                    backup_path = _backup_file(target_path)
+                    if backup_path is not None:
+                        changes["backup"] = backup_path
+
+                    os.replace(staged_path, target_path)
+                    changes["installed"] = target_path
+                except OSError as e:
+                    raise CommandExecutionError(f"Failed to install AppImage to {target_path}: {e}")
+            finally:
+                if os.path.exists(staged_path):
+                    os.remove(staged_path)
+
+            if checksum:
+                _record_checksum(target_path, checksum_type, checksum)
+
+    if remove_download:
+        os.remove(downloaded_path)
 
     return {
         "result": True,
         "comment": f"AppImage {name} successfully installed to {target_path}",
         "changes": changes,
+        "phases": phases,
     }
 
 
+def _clone_file(src: str, dest: str) -> None:
+    """
+    Copy a file, sharing its data blocks if the filesystem supports reflinks.
+
+    Tries a reflink, then copy_file_range which lets the filesystem copy without passing the
+    data through user space, then a regular copy.
+
+    :param src: File to copy
+    :type src: str
+    :param dest: Path of the copy, must not exist
+    :type dest: str
+    """
+    with open(src, "rb") as src_f, open(dest, "xb") as dest_f:
+        try:
+            fcntl.ioctl(dest_f.fileno(), FICLONE, src_f.fileno())
+            return
+        except OSError:
+            pass
+
+        try:
+            remaining = os.fstat(src_f.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(src_f.fileno(), dest_f.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+            return
+        except (OSError, AttributeError):
+            src_f.seek(0)
+            dest_f.seek(0)
+            dest_f.truncate()
+
+        shutil.copyfileobj(src_f, dest_f, HASH_CHUNK_SIZE)
+
+
+def _temp_path(directory: str, name: str) -> str:
+    """
+    Get an unused hidden path in a directory, to create a file at before renaming it into place.
+
+    :param directory: Directory of the path
+    :type directory: str
+    :param name: Name the file will be renamed to
+    :type name: str
+    :return: Path which doesn't exist
+    :rtype: str
+    """
+    fd, path = tempfile.mkstemp(dir=directory, prefix=f".{name}.")
+    os.close(fd)
+    os.remove(path)
+
+    return path
+
+
+def _stage_file(src: str, target_dir: str, name: str, link: bool = False) -> str:
+    """
+    Put a copy of a file in the target directory under a temporary name, so it can be renamed into place.
+
+    The copy is a hard link if allowed and the file is on the same filesystem, otherwise it is cloned.
+
+    :param src: File to stage
+    :type src: str
+    :param target_dir: Directory the file will be installed in
+    :type target_dir: str
+    :param name: Name the file will be installed as
+    :type name: str
+    :param link: If the file may be hard linked, only for files nothing else will modify
+    :type link: bool
+    :return: Path of the staged file
+    :rtype: str
+    """
+    staged_path = _temp_path(target_dir, name)
+
+    try:
+        if not link:
+            raise OSError("Hard link not allowed")
+        os.link(src, staged_path)
+    except OSError:
+        _clone_file(src, staged_path)
+
+    return staged_path
+
+
+def _backup_file(target_path: str) -> Optional[str]:
+    """
+    Keep the installed file as a backup before it is replaced, and remove backups over the retention limit.
+
+    Backups are kept in BACKUP_DIR, so they aren't on the executable search path like the
+    target directory. The backup is a hard link, or a clone if hard links are not supported,
+    so the installed file stays in place until it is replaced. The newest
+    appimage:keep_backups backups are kept. Backups made next to the installed file by older
+    versions of this module are moved into BACKUP_DIR.
+
+    :param target_path: Path of the installed file
+    :type target_path: str
+    :return: Path of the backup, None if no backup was made
+    :rtype: str or None
+    """
+    keep = __opts__.get(OPTS_PARENT_KEY, {}).get(OPTS_KEEP_BACKUPS_KEY, DEFAULT_KEEP_BACKUPS)
+
+    backup_dir = os.path.join(BACKUP_DIR, os.path.dirname(os.path.abspath(target_path)).lstrip(os.sep))
+    backup_prefix = os.path.join(backup_dir, os.path.basename(target_path))
+    os.makedirs(backup_dir, mode=0o700, exist_ok=True)
+
+    # Backups made before the retention policy existed are the oldest
+    legacy_backups = glob.glob(glob.escape(target_path) + ".bak")
+    legacy_backups += sorted(glob.glob(glob.escape(target_path) + ".[0-9]*.bak"))
+    for legacy_backup in legacy_backups:
+        try:
+            shutil.move(legacy_backup, os.path.join(backup_dir, os.path.basename(legacy_backup)))
+        except OSError as e:
+            log.warning("Failed to move old backup %s to %s: %s", legacy_backup, backup_dir, e)
+
+    backup_path = None
+    if keep > 0 and os.path.exists(target_path):
+        backup_path = f"{backup_prefix}.{time.strftime('%Y%m%d%H%M%S')}.bak"
+        if os.path.exists(backup_path):
+            os.remove(backup_path)
+
+        try:
+            os.link(target_path, backup_path)
+        except OSError:
+            _clone_file(target_path, backup_path)
+
+    backups = glob.glob(glob.escape(backup_prefix) + ".bak")
+    backups += sorted(glob.glob(glob.escape(backup_prefix) + ".[0-9]*.bak"))
+    for old_backup in backups[:max(0, len(backups) - keep)]:
+        try:
+            os.remove(old_backup)
+        except OSError as e:
+            log.warning("Failed to remove old backup %s: %s", old_backup, e)
+
+    return backup_path
+
+
 def removed(name: str, target_dir: str = "/usr/local/bin") -> Dict[str, Any]:
     """
     Remove an installed AppImage.
@@ -143,7 +448,8 @@ def removed(name: str, target_dir: str = "/usr/local/bin") -> Dict[str, Any]:
     """
     target_path = os.path.join(target_dir, name)
 
-    if not os.path.exists(target_path):
+    # A version store link whose version was garbage collected is still removed
+    if not os.path.lexists(target_path):
         return {
             "result": True,
             "comment": f"AppImage {name} is not installed",
@@ -152,6 +458,7 @@ def removed(name: str, target_dir: str = "/usr/local/bin") -> Dict[str, Any]:
 
     try:
         os.remove(target_path)
+        _record_checksum(target_path, None, None)
         return {
             "result": True,
             "comment": f"AppImage {name} removed from {target_path}",
@@ -161,7 +468,12 @@ def removed(name: str, target_dir: str = "/usr/local/bin") -> Dict[str, Any]:
         raise CommandExecutionError(f"Failed to remove {target_path}: {e}")
 
 
-def is_installed(name: str, target_dir: str = "/usr/local/bin") -> bool:
+def is_installed(
+    name: str,
+    target_dir: str = "/usr/local/bin",
+    checksum: Optional[str] = None,
+    checksum_type: str = "sha256",
+) -> bool:
     """
     Check if an AppImage is installed.
 
@@ -169,6 +481,11 @@ def is_installed(name: str, target_dir: str = "/usr/local/bin") -> bool:
     :type name: str
     :param target_dir: Directory where the AppImage should be installed
     :type target_dir: str
+    :param checksum: Optional checksum the installed file must have. The file is only hashed if it
+                     changed since its checksum was recorded in the manifest
+    :type checksum: str or None
+    :param checksum_type: Type of checksum
+    :type checksum_type: str
     :return: True if installed, False otherwise
     :rtype: bool
 
@@ -179,10 +496,392 @@ def is_installed(name: str, target_dir: str = "/usr/local/bin") -> bool:
         salt '*' appimage.is_installed myapp
     """
     target_path = os.path.join(target_dir, name)
-    return os.path.exists(target_path) and os.access(target_path, os.X_OK)
+    if not os.path.exists(target_path) or not os.access(target_path, os.X_OK):
+        return False
+
+    return checksum is None or _installed_checksum(target_path, checksum_type) == checksum
+
+
+def _read_manifest() -> Dict[str, Dict[str, Any]]:
+    """
+    Get the manifest of installed file checksums, reading it once per Salt run.
+
+    Must be called with _manifest_lock held.
+
+    :return: Maps installed file paths to their size, mtime_ns, inode and checksums by type
+    :rtype: dict
+    """
+    if CONTEXT_MANIFEST_KEY not in __context__:
+        manifest = {}
+        try:
+            with open(MANIFEST_PATH, "r") as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            log.warning("Failed to read AppImage manifest %s, rebuilding it: %s", MANIFEST_PATH, e)
+
+        __context__[CONTEXT_MANIFEST_KEY] = manifest
+
+    return __context__[CONTEXT_MANIFEST_KEY]
+
+
+def _write_json(path: str, data: Any) -> None:
+    """
+    Atomically replace a JSON file, creating its directory if needed.
+
+    :param path: Path of the file
+    :type path: str
+    :param data: Value to write
+    :type data: Any
+    """
+    os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _write_manifest(manifest: Dict[str, Dict[str, Any]]) -> None:
+    """
+    Atomically replace the manifest file.
+
+    Must be called with _manifest_lock held.
+
+    :param manifest: Manifest from _read_manifest()
+    :type manifest: dict
+    """
+    try:
+        _write_json(MANIFEST_PATH, manifest)
+    except OSError as e:
+        log.warning("Failed to write AppImage manifest %s: %s", MANIFEST_PATH, e)
+
+
+def _stat_fields(path: str) -> Dict[str, int]:
+    """
+    Get the stat fields which identify a version of a file.
+
+    :param path: Path of the file
+    :type path: str
+    :return: Dict with size, mtime_ns and inode keys
+    :rtype: dict
+    """
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "inode": st.st_ino}
+
+
+def _installed_checksum(path: str, checksum_type: str = "sha256") -> str:
+    """
+    Get the checksum of an installed file, from the manifest if the file didn't change.
+
+    :param path: Path to the file
+    :type path: str
+    :param checksum_type: Type of checksum
+    :type checksum_type: str
+    :return: Hexadecimal checksum string
+    :rtype: str
+    """
+    # Stored AppImages are named by their checksum
+    store_dir = __opts__.get(OPTS_PARENT_KEY, {}).get(OPTS_STORE_DIR_KEY)
+    if store_dir and checksum_type == "sha256" and os.path.islink(path):
+        version_dir = os.path.dirname(os.readlink(path))
+        if os.path.dirname(version_dir) == store_dir.rstrip("/"):
+            return os.path.basename(version_dir)
+
+    fields = _stat_fields(path)
+
+    with _manifest_lock:
+        entry = _read_manifest().get(path)
+        if entry is not None and all(entry.get(key) == value for key, value in fields.items()):
+            recorded = entry.get("checksums", {}).get(checksum_type)
+            if recorded is not None:
+                return recorded
+
+    log.debug("Hashing %s, it changed since its checksum was recorded", path)
+    checksum = _get_file_checksum(path, checksum_type)
+    _record_checksum(path, checksum_type, checksum, fields)
+
+    return checksum
+
+
+def _record_checksum(
+    path: str,
+    checksum_type: Optional[str],
+    checksum: Optional[str],
+    fields: Optional[Dict[str, int]] = None,
+) -> None:
+    """
+    Record the checksum of an installed file in the manifest.
+
+    :param path: Path to the file
+    :type path: str
+    :param checksum_type: Type of checksum, None to forget the file
+    :type checksum_type: str or None
+    :param checksum: Checksum of the file
+    :type checksum: str or None
+    :param fields: Stat fields of the file the checksum was computed from, the file is stat-ed if None
+    :type fields: dict or None
+    """
+    if checksum_type is not None and fields is None:
+        fields = _stat_fields(path)
+
+    with _manifest_lock:
+        manifest = _read_manifest()
+
+        if checksum_type is None:
+            if manifest.pop(path, None) is None:
+                return
+        else:
+            entry = manifest.get(path)
+            if entry is None or any(entry.get(key) != value for key, value in fields.items()):
+                entry = {**fields, "checksums": {}}
+                manifest[path] = entry
+            entry["checksums"][checksum_type] = checksum
+
+        _write_manifest(manifest)
+
+
+def download_many(downloads: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Download several AppImages concurrently.
+
+    At most appimage:max_parallel_downloads downloads run at once. Each source is downloaded once
+    even if it is listed more than once.
+
+    :param downloads: Downloads, each a dict with a 'source' key and optional 'checksum' and
+                      'checksum_type' keys, see installed()
+    :type downloads: list of dict
+    :return: One result per download in the same order, a dict with a 'path' key holding the
+             path of the verified download or None if it failed, an 'error' key holding the
+             failure message or None, a 'phases' key, and a 'sha256' key holding the sha256
+             checksum of the download if it was computed while downloading or None
+    :rtype: list of dict
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' appimage.download_many '[{"source": "https://example.com/app.AppImage"}]'
+    """
+    max_workers = __opts__.get(OPTS_PARENT_KEY, {}).get(OPTS_MAX_PARALLEL_DOWNLOADS_KEY, DEFAULT_MAX_PARALLEL_DOWNLOADS)
+
+    def download(source: str, checksum: Optional[str], checksum_type: str) -> Dict[str, Any]:
+        phases = {}
+        digests = {}
+        try:
+            path = _download_file(source, checksum, checksum_type, phases=phases, digests=digests)
+            return {"path": path, "error": None, "phases": phases, "sha256": digests.get("sha256")}
+        except Exception as e:
+            log.warning("Failed to download %s: %s", source, e)
+            return {"path": None, "error": str(e), "phases": phases, "sha256": None}
+
+    keys = [
+        (item["source"], item.get("checksum"), item.get("checksum_type", "sha256"))
+        for item in downloads
+    ]
+    unique_keys = list(dict.fromkeys(keys))
+    if not unique_keys:
+        return []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(unique_keys)))) as executor:
+        # Salt's loader dunders are context variables, which threads don't inherit, so each download runs in a copy of this context
+        futures = {key: executor.submit(contextvars.copy_context().run, download, *key) for key in unique_keys}
+        results = {key: future.result() for key, future in futures.items()}
+
+    return [results[key] for key in keys]
+
+
+def _get_session() -> "requests.Session":
+    """
+    Get the HTTP session shared by downloads, creating it on first use.
+
+    :return: Session pooling keep-alive connections per host
+    :rtype: requests.Session
+    """
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            max_workers = __opts__.get(OPTS_PARENT_KEY, {}).get(OPTS_MAX_PARALLEL_DOWNLOADS_KEY, DEFAULT_MAX_PARALLEL_DOWNLOADS)
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(1, max_workers))
 
+            _session = requests.Session()
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
 
-def _download_file(source: str, checksum: Optional[str] = None, checksum_type: str = "sha256") -> str:
+        return _session
+
+
+def clean_downloads() -> int:
+    """
+    Remove finished downloads, and partial downloads which were not resumed in a week.
+
+    Partial downloads are kept so later runs can resume them.
+
+    :return: Number of files removed
+    :rtype: int
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' appimage.clean_downloads
+    """
+    if not os.path.isdir(DOWNLOAD_DIR):
+        return 0
+
+    removed_count = 0
+    now = time.time()
+    with os.scandir(DOWNLOAD_DIR) as entries:
+        for entry in entries:
+            partial = entry.name.endswith((".part", ".part.validator"))
+            if partial and now - entry.stat().st_mtime < PARTIAL_DOWNLOAD_MAX_AGE:
+                continue
+
+            try:
+                os.remove(entry.path)
+                removed_count += 1
+            except OSError as e:
+                log.warning("Failed to remove download %s: %s", entry.path, e)
+
+    return removed_count
+
+
+def _http_download(source: str, dest: str, checksum_types: List[str]) -> Tuple[int, Dict[str, str]]:
+    """
+    Stream an HTTP(S) URL to a file over a pooled keep-alive connection, resuming partial downloads.
+
+    The download is written to dest.part and hashed as it is written. If dest.part exists
+    from an interrupted download it is resumed with a range request, guarded by the ETag or
+    Last-Modified validator the server sent when it was started. Once complete, dest.part is
+    renamed to dest.
+
+    :param source: URL to download
+    :type source: str
+    :param dest: Path to write the download to, replaced if it exists
+    :type dest: str
+    :param checksum_types: Types of checksum to compute, all in the same pass over the data
+    :type checksum_types: list of str
+    :return: Number of bytes downloaded in this call, and the checksums of the whole file by type
+    :rtype: tuple
+    """
+    part_path = f"{dest}.part"
+    validator_path = f"{dest}.part.validator"
+    hash_objs = {checksum_type: hashlib.new(checksum_type) for checksum_type in checksum_types}
+
+    # Hash what an interrupted download already wrote
+    offset = 0
+    validator = None
+    if os.path.exists(part_path):
+        with open(part_path, "rb") as f:
+            while chunk := f.read(DOWNLOAD_CHUNK_SIZE):
+                for hash_obj in hash_objs.values():
+                    hash_obj.update(chunk)
+                offset += len(chunk)
+
+        if os.path.exists(validator_path):
+            with open(validator_path, "r") as f:
+                validator = f.read().strip() or None
+
+    downloaded = 0
+    attempt = 0
+    while True:
+        headers = {"Accept-Encoding": "identity"}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            if validator:
+                headers["If-Range"] = validator
+
+        try:
+            with _get_session().get(source, stream=True, timeout=DOWNLOAD_TIMEOUT, headers=headers) as response:
+                if offset and response.status_code == 416:
+                    if response.headers.get("Content-Range") == f"bytes */{offset}":
+                        # The interrupted download had already received everything
+                        break
+
+                    # The partial download is longer than the file, start over
+                    log.info("Partial download of %s is no longer valid, restarting", source)
+                    offset = 0
+                    hash_objs = {checksum_type: hashlib.new(checksum_type) for checksum_type in checksum_types}
+                    continue
+
+                response.raise_for_status()
+
+                if offset and response.status_code != 206:
+                    log.info("Server did not resume download of %s, restarting", source)
+                    offset = 0
+                    hash_objs = {checksum_type: hashlib.new(checksum_type) for checksum_type in checksum_types}
+
+                total = None
+                if "Content-Length" in response.headers:
+                    total = offset + int(response.headers["Content-Length"])
+
+                if offset == 0:
+                    validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+                    with open(validator_path, "w") as f:
+                        f.write(validator or "")
+                elif offset:
+                    log.info("Resuming download of %s at %d bytes", source, offset)
+
+                last_report = time.monotonic()
+                report_offset = offset
+                with open(part_path, "ab" if offset else "wb") as f:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        for hash_obj in hash_objs.values():
+                            hash_obj.update(chunk)
+                        offset += len(chunk)
+                        downloaded += len(chunk)
+
+                        now = time.monotonic()
+                        if now - last_report >= PROGRESS_INTERVAL:
+                            rate = (offset - report_offset) / (now - last_report) / 1024 / 1024
+                            if total:
+                                log.info(
+                                    "Downloading %s: %d%% of %.1f MiB, %.1f MiB/s",
+                                    source, offset * 100 // total, total / 1024 / 1024, rate,
+                                )
+                            else:
+                                log.info("Downloading %s: %.1f MiB, %.1f MiB/s", source, offset / 1024 / 1024, rate)
+                            last_report = now
+                            report_offset = offset
+
+            if total is not None and offset < total:
+                raise requests.exceptions.ConnectionError(f"Connection closed after {offset} of {total} bytes")
+
+            break
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            attempt += 1
+            if attempt > DOWNLOAD_RETRIES:
+                raise CommandExecutionError(
+                    f"Download was interrupted {attempt} times, the {offset} bytes downloaded are kept to resume from: {e}"
+                )
+
+            log.warning(
+                "Download of %s interrupted at %d bytes, resuming (attempt %d of %d): %s",
+                source, offset, attempt, DOWNLOAD_RETRIES, e,
+            )
+            time.sleep(min(2 ** attempt, 30))
+
+    os.replace(part_path, dest)
+    if os.path.exists(validator_path):
+        os.remove(validator_path)
+
+    return downloaded, {checksum_type: hash_obj.hexdigest() for checksum_type, hash_obj in hash_objs.items()}
+
+
+def _download_file(
+    source: str,
+    checksum: Optional[str] = None,
+    checksum_type: str = "sha256",
+    phases: Optional[Dict[str, float]] = None,
+    digests: Optional[Dict[str, str]] = None,
+) -> str:
     """
     Download a file from a URL or salt:// source.
 
@@ -192,17 +891,33 @@ def _download_file(source: str, checksum: Optional[str] = None, checksum_type: s
     :type checksum: str or None
     :param checksum_type: Type of checksum
     :type checksum_type: str
+    :param phases: Timings the download and hash phases are added to. HTTP(S) downloads are
+                   hashed while they are written and without the requests library URL downloads
+                   are verified by cp.get_url, so their hashing is part of the download phase
+    :type phases: dict or None
+    :param digests: Checksums of the download by type are added to it when they are computed while
+                    downloading or verifying it. With a version store configured HTTP(S) downloads
+                    are also hashed with sha256, so they don't have to be read again to be stored
+    :type digests: dict or None
     :return: Path to the downloaded file
     :rtype: str
     """
+    if phases is None:
+        phases = {}
+    if digests is None:
+        digests = {}
+
     if source.startswith("salt://"):
         # Use Salt's file caching mechanism
-        cached_path = __salt__["cp.cache_file"](source)
+        with timed_phase(phases, "download"):
+            cached_path = __salt__["cp.cache_file"](source)
         if not cached_path:
             raise SaltInvocationError(f"Failed to cache file from {source}")
 
         if checksum:
-            actual_checksum = _get_file_checksum(cached_path, checksum_type)
+            with timed_phase(phases, "hash"):
+                actual_checksum = _get_file_checksum(cached_path, checksum_type)
+            digests[checksum_type] = actual_checksum
             if actual_checksum != checksum:
                 raise CommandExecutionError(
                     f"Checksum mismatch: expected {checksum}, got {actual_checksum}"
@@ -210,21 +925,51 @@ def _download_file(source: str, checksum: Optional[str] = None, checksum_type: s
 
         return cached_path
     else:
-        # Use Salt's cp.get_url function for HTTP(S) URLs
-        import tempfile
-        temp_dir = tempfile.gettempdir()
-        temp_path = os.path.join(temp_dir, f"appimage-{hashlib.md5(source.encode()).hexdigest()}")
+        os.makedirs(DOWNLOAD_DIR, mode=0o700, exist_ok=True)
+
+        # Concurrent downloads of the same source expecting different checksums must not share a file
+        temp_key = f"{source}\n{checksum_type}:{checksum}" if checksum else source
+        temp_path = os.path.join(DOWNLOAD_DIR, hashlib.md5(temp_key.encode()).hexdigest())
+
+        if HAS_REQUESTS and source.startswith(("http://", "https://")):
+            if checksum_type not in hashlib.algorithms_available:
+                raise SaltInvocationError(f"Unsupported checksum type: {checksum_type}")
+
+            checksum_types = [checksum_type]
+            if __opts__.get(OPTS_PARENT_KEY, {}).get(OPTS_STORE_DIR_KEY) and checksum_type != "sha256":
+                checksum_types.append("sha256")
+
+            with timed_phase(phases, "download"), trace_span(__opts__, __context__, __salt__, source, "appimage") as span:
+                span["output_bytes"], download_digests = _http_download(source, temp_path, checksum_types)
+            digests.update(download_digests)
+
+            actual_checksum = download_digests[checksum_type]
+            if checksum and actual_checksum != checksum:
+                os.remove(temp_path)
+                raise CommandExecutionError(
+                    f"Checksum mismatch: expected {checksum}, got {actual_checksum}"
+                )
 
+            return temp_path
+
+        # Use Salt's cp.get_url function for other URLs
         # Build source_hash parameter if checksum provided
         source_hash = None
         if checksum:
             source_hash = f"{checksum_type}={checksum}"
 
-        download_result = __salt__["cp.get_url"](
-            path=source,
-            dest=temp_path,
-            source_hash=source_hash,
-        )
+        # An earlier download may be hard linked to an installed AppImage, don't write into it
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+        with timed_phase(phases, "download"), trace_span(__opts__, __context__, __salt__, source, "appimage") as span:
+            download_result = __salt__["cp.get_url"](
+                path=source,
+                dest=temp_path,
+                source_hash=source_hash,
+            )
+            if os.path.exists(temp_path):
+                span["output_bytes"] = os.path.getsize(temp_path)
 
         if not download_result or not os.path.exists(temp_path):
             raise CommandExecutionError(f"Failed to download file from {source}")
@@ -248,7 +993,301 @@ def _get_file_checksum(path: str, checksum_type: str = "sha256") -> str:
 
     hash_obj = hashlib.new(checksum_type)
     with open(path, "rb") as f:
-        while chunk := f.read(8192):
+        while chunk := f.read(HASH_CHUNK_SIZE):
             hash_obj.update(chunk)
 
     return hash_obj.hexdigest()
+
+
+def _read_store_index(store_dir: str) -> Dict[str, List[str]]:
+    """
+    Read which versions of each AppImage are in the store.
+
+    Must be called with _store_lock held.
+
+    :param store_dir: Directory of the store
+    :type store_dir: str
+    :return: Maps installed paths to the checksums of their stored versions, most recently installed last
+    :rtype: dict
+    """
+    try:
+        with open(os.path.join(store_dir, STORE_INDEX_FILE), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        log.warning("Failed to read AppImage store index in %s, starting a new one: %s", store_dir, e)
+        return {}
+
+
+def _store_path(store_dir: str, digest: str, name: str) -> str:
+    """
+    Get the path of a version of an AppImage in the store.
+
+    :param store_dir: Directory of the store
+    :type store_dir: str
+    :param digest: SHA256 checksum of the version
+    :type digest: str
+    :param name: Name of the AppImage
+    :type name: str
+    :return: Path in the store
+    :rtype: str
+    """
+    return os.path.join(store_dir, digest, f"{name}.AppImage")
+
+
+def _add_to_store(store_dir: str, src: str, name: str, digest: str, link: bool = False) -> str:
+    """
+    Put a version of an AppImage in the store, if it isn't there yet.
+
+    A version already stored under another name is hard linked, so identical AppImages use the space of one.
+
+    :param store_dir: Directory of the store
+    :type store_dir: str
+    :param src: File of the version
+    :type src: str
+    :param name: Name of the AppImage
+    :type name: str
+    :param digest: SHA256 checksum of src
+    :type digest: str
+    :param link: If src may be hard linked into the store, see _stage_file
+    :type link: bool
+    :return: Path in the store
+    :rtype: str
+    """
+    store_path = _store_path(store_dir, digest, name)
+    if os.path.exists(store_path):
+        return store_path
+
+    version_dir = os.path.dirname(store_path)
+    os.makedirs(version_dir, mode=0o755, exist_ok=True)
+
+    same_content = glob.glob(os.path.join(glob.escape(version_dir), "*.AppImage"))
+    if same_content:
+        src = same_content[0]
+        link = True
+
+    staged_path = _stage_file(src, version_dir, name, link=link)
+    try:
+        # rwxr-xr-x (755)
+        os.chmod(staged_path, stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
+        os.replace(staged_path, store_path)
+    finally:
+        if os.path.exists(staged_path):
+            os.remove(staged_path)
+
+    return store_path
+
+
+def _activate_version(store_dir: str, target_path: str, digest: str) -> None:
+    """
+    Point an AppImage's symlink at a stored version, then remove versions over the retention limit.
+
+    An AppImage installed before the store was used is moved into the store first, so it can be rolled back to.
+
+    :param store_dir: Directory of the store
+    :type store_dir: str
+    :param target_path: Path of the installed AppImage
+    :type target_path: str
+    :param digest: SHA256 checksum of the stored version
+    :type digest: str
+    """
+    name = os.path.basename(target_path)
+
+    with _store_lock:
+        index = _read_store_index(store_dir)
+        history = index.setdefault(target_path, [])
+
+        if os.path.isfile(target_path) and not os.path.islink(target_path):
+            previous_digest = _installed_checksum(target_path, "sha256")
+            _add_to_store(store_dir, target_path, name, previous_digest, link=True)
+            if previous_digest not in history:
+                history.append(previous_digest)
+
+        # Swap the symlink atomically
+        link_path = _temp_path(os.path.dirname(target_path), name)
+        os.symlink(_store_path(store_dir, digest, name), link_path)
+        try:
+            os.replace(link_path, target_path)
+        except OSError:
+            os.remove(link_path)
+            raise
+
+        if digest in history:
+            history.remove(digest)
+        history.append(digest)
+
+        keep = __opts__.get(OPTS_PARENT_KEY, {}).get(OPTS_KEEP_VERSIONS_KEY, DEFAULT_KEEP_VERSIONS)
+        index[target_path] = history[-max(1, keep):]
+
+        _write_json(os.path.join(store_dir, STORE_INDEX_FILE), index)
+        _remove_unused_versions(store_dir, index)
+
+
+def _remove_unused_versions(store_dir: str, index: Dict[str, List[str]]) -> int:
+    """
+    Remove stored versions which no AppImage in the index uses.
+
+    Must be called with _store_lock held.
+
+    :param store_dir: Directory of the store
+    :type store_dir: str
+    :param index: Store index from _read_store_index()
+    :type index: dict
+    :return: Number of stored files removed
+    :rtype: int
+    """
+    used = {
+        _store_path(store_dir, digest, os.path.basename(target_path))
+        for target_path, history in index.items()
+        for digest in history
+    }
+
+    removed_count = 0
+    for store_path in glob.glob(os.path.join(glob.escape(store_dir), "*", "*.AppImage")):
+        if store_path in used:
+            continue
+
+        try:
+            os.remove(store_path)
+            removed_count += 1
+        except OSError as e:
+            log.warning("Failed to remove unused AppImage version %s: %s", store_path, e)
+            continue
+
+        version_dir = os.path.dirname(store_path)
+        if not os.listdir(version_dir):
+            os.rmdir(version_dir)
+
+    return removed_count
+
+
+def versions(name: str, target_dir: str = "/usr/local/bin") -> List[Dict[str, Any]]:
+    """
+    List the stored versions of an AppImage.
+
+    :param name: The name of the AppImage
+    :type name: str
+    :param target_dir: Directory where the AppImage is installed
+    :type target_dir: str
+    :return: Versions, most recently installed last, each a dict with 'sha256', 'path' and 'current' keys
+    :rtype: list of dict
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' appimage.versions obsidian
+    """
+    store_dir = __opts__.get(OPTS_PARENT_KEY, {}).get(OPTS_STORE_DIR_KEY)
+    if not store_dir:
+        raise SaltInvocationError("The AppImage store is not configured, set appimage:store_dir")
+
+    target_path = os.path.join(target_dir, name)
+    current = os.readlink(target_path) if os.path.islink(target_path) else None
+
+    with _store_lock:
+        history = _read_store_index(store_dir).get(target_path, [])
+
+    return [
+        {
+            "sha256": digest,
+            "path": _store_path(store_dir, digest, name),
+            "current": _store_path(store_dir, digest, name) == current,
+        }
+        for digest in history
+    ]
+
+
+def rollback(name: str, target_dir: str = "/usr/local/bin", version: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Switch an AppImage back to a stored version.
+
+    :param name: The name of the AppImage
+    :type name: str
+    :param target_dir: Directory where the AppImage is installed
+    :type target_dir: str
+    :param version: SHA256 checksum, or a unique prefix of it, of the version to switch to. The version
+                    installed before the current one if None, so rolling back twice returns to the current version
+    :type version: str or None
+    :return: Dict with 'result', 'comment', 'changes' keys
+    :rtype: dict
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' appimage.rollback obsidian
+        salt '*' appimage.rollback obsidian version=3f2a
+    """
+    stored = versions(name, target_dir=target_dir)
+    current = [v for v in stored if v["current"]]
+    previous = [v for v in stored if not v["current"]]
+
+    if version is None:
+        candidates = previous[-1:]
+    else:
+        candidates = [v for v in stored if v["sha256"].startswith(version)]
+
+    if len(candidates) != 1:
+        raise CommandExecutionError(
+            f"No single stored version of {name} matches {version or 'the previous version'}, "
+            f"stored versions: {', '.join(v['sha256'] for v in stored) or 'none'}"
+        )
+
+    target = candidates[0]
+    if target["current"]:
+        return {
+            "result": True,
+            "comment": f"AppImage {name} is already at version {target['sha256']}",
+            "changes": {},
+        }
+
+    target_path = os.path.join(target_dir, name)
+    store_dir = __opts__[OPTS_PARENT_KEY][OPTS_STORE_DIR_KEY]
+    try:
+        _activate_version(store_dir, target_path, target["sha256"])
+    except OSError as e:
+        raise CommandExecutionError(f"Failed to switch {target_path} to {target['path']}: {e}")
+
+    return {
+        "result": True,
+        "comment": f"AppImage {name} switched to version {target['sha256']}",
+        "changes": {
+            "old": current[0]["sha256"] if current else None,
+            "new": target["sha256"],
+        },
+    }
+
+
+def gc() -> int:
+    """
+    Remove stored AppImage versions which are over the keep_versions limit or no longer used.
+
+    AppImages which were removed keep their versions until the next gc, so they can still be rolled back to.
+
+    :return: Number of stored files removed
+    :rtype: int
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' appimage.gc
+    """
+    store_dir = __opts__.get(OPTS_PARENT_KEY, {}).get(OPTS_STORE_DIR_KEY)
+    if not store_dir or not os.path.isdir(store_dir):
+        return 0
+
+    keep = __opts__.get(OPTS_PARENT_KEY, {}).get(OPTS_KEEP_VERSIONS_KEY, DEFAULT_KEEP_VERSIONS)
+
+    with _store_lock:
+        index = _read_store_index(store_dir)
+        index = {
+            target_path: history[-max(1, keep):]
+            for target_path, history in index.items()
+            if os.path.islink(target_path)
+        }
+
+        _write_json(os.path.join(store_dir, STORE_INDEX_FILE), index)
+        return _remove_unused_versions(store_dir, index)
@@ -0,0 +1,178 @@
+"""
+Execution module which traces the external commands run by the custom modules and states.
+
+Each command is recorded as one JSON line, a span, holding:
+
+- command: The command, or the URL for downloads
+- source: Module which ran the command
+- state_id: ID of the state which was running, None outside of custom states
+- start, end: Wall clock time as Unix timestamps
+- duration: Seconds the command ran
+- cpu_user, cpu_system: CPU seconds used by the command and its children
+- max_rss_kb: Peak resident memory of the command, None if it could not be measured
+- retcode: Exit code, None if the command failed without one
+- output_bytes: Size of the command's output
+- cached: Only present and True if the command was not run because a memoized
+  result of an identical earlier command was used
+
+CPU time of commands run with cmd.run is measured from this process' reaped
+children, so it includes other commands which finished at the same time when
+commands run concurrently. Peak memory is only known for commands run by the
+pacman_build worker.
+
+Custom modules record spans with salt_trace.trace_span, and custom states are
+wrapped with salt_trace.traced_state so spans are attributed to the running
+state. Summarize the slowest commands with:
+
+```
+salt-call --local command_trace.summary
+```
+
+Configuration
+=============
+Tracing is enabled by setting the trace file in the Salt minion configuration
+file. Spans can also be sent to the Salt event bus with the tag
+`custom/command_trace/span`:
+
+```yaml
+command_trace:
+  file: /var/log/salt/command-trace.jsonl
+  events: False
+```
+"""
+from typing import Optional, Dict, Any, List
+import json
+import logging
+import os
+
+from salt_trace import OPTS_PARENT_KEY, OPTS_FILE_KEY, trace_enabled, trace_file_lock
+
+log = logging.getLogger(__name__)
+
+
+def enabled() -> bool:
+    """Check if commands are traced.
+
+    Returns:
+        True if the trace file is configured
+    """
+    return trace_enabled(__opts__)
+
+
+def _read_spans(path: str) -> List[Dict[str, Any]]:
+    """Read every span in a trace file.
+
+    Arguments:
+        path: Trace file
+
+    Returns:
+        Spans in the order they were recorded, lines which can't be parsed are skipped
+    """
+    spans = []
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                spans.append(json.loads(line))
+            except ValueError:
+                continue
+
+    return spans
+
+
+def _group_totals(spans: List[Dict[str, Any]], key: str, top: int) -> List[Dict[str, Any]]:
+    """Sum the durations of spans grouped by a field.
+
+    Arguments:
+        spans: Spans to group
+        key: Span field to group by
+        top: Number of groups to return
+
+    Returns:
+        Groups with the largest total duration first, each with count, total, max and cpu seconds
+    """
+    groups: Dict[Any, Dict[str, Any]] = {}
+    for span in spans:
+        group = groups.setdefault(span.get(key), {key: span.get(key), "count": 0, "total": 0.0, "max": 0.0, "cpu": 0.0})
+        group["count"] += 1
+        group["total"] += span.get("duration") or 0
+        group["max"] = max(group["max"], span.get("duration") or 0)
+        group["cpu"] += (span.get("cpu_user") or 0) + (span.get("cpu_system") or 0)
+
+    totals = sorted(groups.values(), key=lambda group: group["total"], reverse=True)[:top]
+    for group in totals:
+        group["total"] = round(group["total"], 3)
+        group["cpu"] = round(group["cpu"], 3)
+
+    return totals
+
+
+def summary(top: int = 10, path: Optional[str] = None, since: Optional[float] = None) -> Dict[str, Any]:
+    """Summarize where traced commands spent their time.
+
+    Arguments:
+        top: Number of entries in each list
+        path: Trace file, the configured file if None
+        since: Only include spans which started after this Unix timestamp
+
+    Returns:
+        Dictionary with keys:
+        - spans: Number of spans summarized, excluding cached spans
+        - duplicates_avoided: Number of commands which were not run because their memoized result was used
+        - total: Seconds spent in traced commands
+        - slowest: The longest running commands
+        - by_program: Total time per program, the first word of each command
+        - by_state: Total time per state ID
+        - by_source: Total time per module
+
+    CLI Example:
+        salt-call --local command_trace.summary top=20
+    """
+    path = path or __opts__.get(OPTS_PARENT_KEY, {}).get(OPTS_FILE_KEY)
+    if not path or not os.path.isfile(path):
+        return {
+            "spans": 0,
+            "duplicates_avoided": 0,
+            "total": 0,
+            "slowest": [],
+            "by_program": [],
+            "by_state": [],
+            "by_source": [],
+        }
+
+    spans = [span for span in _read_spans(path) if since is None or (span.get("start") or 0) >= since]
+    cached = [span for span in spans if span.get("cached")]
+    spans = [span for span in spans if not span.get("cached")]
+    for span in spans:
+        span["program"] = os.path.basename(span.get("command", "").split(" ", 1)[0])
+
+    return {
+        "spans": len(spans),
+        "duplicates_avoided": len(cached),
+        "total": round(sum(span.get("duration") or 0 for span in spans), 3),
+        "slowest": sorted(spans, key=lambda span: span.get("duration") or 0, reverse=True)[:top],
+        "by_program": _group_totals(spans, "program", top),
+        "by_state": _group_totals(spans, "state_id", top),
+        "by_source": _group_totals(spans, "source", top),
+    }
+
+
+def clear(path: Optional[str] = None) -> bool:
+    """Delete the trace file.
+
+    Arguments:
+        path: Trace file, the configured file if None
+
+    Returns:
+        True if a trace file was deleted
+
+    CLI Example:
+        salt-call --local command_trace.clear
+    """
+    path = path or __opts__.get(OPTS_PARENT_KEY, {}).get(OPTS_FILE_KEY)
+    if not path or not os.path.isfile(path):
+        return False
+
+    with trace_file_lock:
+        os.remove(path)
+
+    return True
@@ -3,8 +3,73 @@ Execution module for building Arch Linux packages using makepkg.
 
 This module handles building packages from PKGBUILD files, including reading
 PKGBUILDs from salt://, Jinja templating, and package installation.
+
+Built packages are kept in a cache keyed by a hash of the prepared build files
+(rendered PKGBUILD, patches, etc), the template context and the makepkg flags.
+When a package with the same key was built before it is installed with
+`pacman --upgrade` instead of being rebuilt. VCS packages, which have a
+`pkgver()` function or version control sources, are never cached as what they
+build changes with upstream.
+
+Configuration
+=============
+The maximum size of the built package cache can be configured via the Salt
+minion configuration file, least recently used entries are evicted first:
+
+```yaml
+makepkg:
+  package_cache_max_mb: 10240
+```
+
+`build_many` runs independent builds concurrently. By default one build runs
+per CPU core, limited by how many builds of `build_memory_mb` fit in available
+memory. The number of concurrent builds can also be set directly:
+
+```yaml
+makepkg:
+  build_memory_mb: 4096
+  max_parallel_builds: 4
+```
+
+Builds which don't keep their build directory run on tmpfs when their
+footprint fits in both the tmpfs' free space and available memory, otherwise
+on disk. The footprint is the `build_size_mb` hint if given, or the size the
+package's build directory reached on its last build. Packages with neither
+are built on disk. The locations can be configured:
+
+```yaml
+makepkg:
+  tmpfs_build_dir: /tmp
+  disk_build_dir: /var/tmp
+```
+
+Packages installed with `upstream_source` are checked out from bare git mirrors
+in `/var/cache/salt/makepkg/git/<pkg>.git`. Mirrors are only fetched if they
+weren't fetched in the last `git_mirror_ttl` seconds. New mirrors are cloned
+from `upstream_git_url` if set, where `{pkg}` is replaced with the package
+name, otherwise from the repository `yay -G` clones:
+
+```yaml
+makepkg:
+  git_mirror_ttl: 3600
+  upstream_git_url: https://aur.archlinux.org/{pkg}.git
+```
+
+Stages
+======
+`installed` runs a package through the stages resolve, check, fetch, patch,
+build and install, stopping as soon as the package is known to be installed.
+The resolve stage identifies the build files cheaply: by the rendered PKGBUILD
+for `source`, or by the commit of the git mirror for `upstream_source`, plus
+the rendered patches. The package names and version recorded the last time
+those build files were prepared are then looked up in
+`/var/cache/salt/makepkg/metadata.json`. Unpatched `source` PKGBUILDs which
+assign their names and version literally don't need a record. When the
+metadata is known and the installed packages match it, the package is not
+downloaded, patched or parsed. The time spent in each stage is returned in
+the result's `timings`.
 """
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple, TypedDict
 import logging
 import re
 import tempfile
@@ -13,62 +78,730 @@ import shutil
 import contextlib
 import pwd
 import stat
+import glob
+import hashlib
+import json
+import concurrent.futures
+import contextvars
+import errno
+import threading
+import shlex
+import time
 
 from salt.exceptions import CommandExecutionError, SaltInvocationError
 from salt_types import FileManagedArgs
+from salt_phases import timed_phase
+from salt_trace import trace_span
 
 log = logging.getLogger(__name__)
 
+OPTS_PARENT_KEY = "makepkg"
+OPTS_PACKAGE_CACHE_MAX_MB_KEY = "package_cache_max_mb"
+OPTS_MAX_PARALLEL_BUILDS_KEY = "max_parallel_builds"
+OPTS_BUILD_MEMORY_MB_KEY = "build_memory_mb"
+OPTS_TMPFS_BUILD_DIR_KEY = "tmpfs_build_dir"
+OPTS_DISK_BUILD_DIR_KEY = "disk_build_dir"
+OPTS_GIT_MIRROR_TTL_KEY = "git_mirror_ttl"
+OPTS_UPSTREAM_GIT_URL_KEY = "upstream_git_url"
+
+DEFAULT_PACKAGE_CACHE_MAX_MB = 10240
+DEFAULT_BUILD_MEMORY_MB = 4096
+DEFAULT_TMPFS_BUILD_DIR = "/tmp"
+DEFAULT_DISK_BUILD_DIR = "/var/tmp"
+DEFAULT_GIT_MIRROR_TTL = 3600
+
+# Headroom added to a recorded build size before deciding if it fits on tmpfs
+BUILD_SIZE_MARGIN = 1.25
+
+MAKEPKG_DIR = "/var/cache/salt/makepkg"
+PACKAGE_CACHE_DIR = os.path.join(MAKEPKG_DIR, "packages")
+COMPILER_CACHE_DIR = os.path.join(MAKEPKG_DIR, "ccache")
+BUILD_SIZES_FILE = os.path.join(MAKEPKG_DIR, "build-sizes.json")
+BUILD_METADATA_FILE = os.path.join(MAKEPKG_DIR, "metadata.json")
+GIT_MIRROR_DIR = os.path.join(MAKEPKG_DIR, "git")
+
+# Touched in a git mirror each time it is fetched
+GIT_MIRROR_STAMP_FILE = "salt-fetched"
+
+CCACHE_BIN_DIR = "/usr/lib/ccache/bin"
+
+# Records the sources of the last successful incremental build in a kept build directory
+INCREMENTAL_SIGNATURE_FILE = ".salt-makepkg-sources"
+
+# Concurrent builds record their sizes in the same file
+_build_sizes_lock = threading.Lock()
+_build_metadata_lock = threading.Lock()
+
+
+def _is_tmpfs(path: str) -> bool:
+    """Check if a path is on a tmpfs.
+
+    Arguments:
+        path: Path to check
+
+    Returns:
+        True if the filesystem containing path is a tmpfs
+    """
+    path = os.path.realpath(path)
+    best_mount = ""
+    best_fstype = None
+
+    with open("/proc/mounts", "r") as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 3:
+                continue
+
+            mount_point, fstype = fields[1], fields[2]
+            if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) and len(mount_point) >= len(best_mount):
+                best_mount = mount_point
+                best_fstype = fstype
+
+    return best_fstype == "tmpfs"
+
+
+def _available_memory_bytes() -> Optional[int]:
+    """Get the amount of memory available without swapping.
+
+    Returns:
+        Available memory in bytes, or None if it could not be read
+    """
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError as e:
+        log.warning("Failed to read available memory: %s", e)
+
+    return None
+
+
+def _dir_size_bytes(path: str) -> int:
+    """Get the disk space used by a directory tree.
+
+    Arguments:
+        path: Directory
+
+    Returns:
+        Bytes allocated to all files in the directory
+    """
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files + dirs:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+
+    return total
+
+
+def _read_build_sizes() -> Dict[str, int]:
+    """Read the recorded build directory sizes.
+
+    Returns:
+        Maps package names to the bytes their build directory used on their last build
+    """
+    try:
+        with open(BUILD_SIZES_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _record_build_size(pkg_hint: str, size_bytes: int) -> None:
+    """Record how large a package's build directory became.
+
+    Arguments:
+        pkg_hint: Name of the package
+        size_bytes: Bytes used by the build directory
+    """
+    with _build_sizes_lock:
+        sizes = _read_build_sizes()
+        sizes[pkg_hint] = size_bytes
+
+        os.makedirs(MAKEPKG_DIR, exist_ok=True)
+        tmp_path = f"{BUILD_SIZES_FILE}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(sizes, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, BUILD_SIZES_FILE)
+
+
+def _choose_build_location(pkg_hint: str, build_size_mb: Optional[int]) -> Dict[str, Any]:
+    """Decide if a temporary build directory should be on tmpfs or disk.
+
+    Arguments:
+        pkg_hint: Name of the package, used to look up its recorded build size
+        build_size_mb: Declared build size, overrides the recorded size
+
+    Returns:
+        Dictionary with keys:
+        - dir: Directory to create the build directory in
+        - tmpfs: If dir is on tmpfs
+        - estimate_mb: Estimated build size, None if unknown
+        - reason: Human-readable explanation of the decision
+    """
+    opts = __opts__.get(OPTS_PARENT_KEY, {})
+    tmpfs_dir = opts.get(OPTS_TMPFS_BUILD_DIR_KEY, DEFAULT_TMPFS_BUILD_DIR)
+    disk_dir = opts.get(OPTS_DISK_BUILD_DIR_KEY, DEFAULT_DISK_BUILD_DIR)
+
+    if build_size_mb is not None:
+        estimate_bytes = int(build_size_mb * 1024 * 1024)
+    elif pkg_hint in _read_build_sizes():
+        estimate_bytes = int(_read_build_sizes()[pkg_hint] * BUILD_SIZE_MARGIN)
+    else:
+        estimate_bytes = None
+
+    def location(use_tmpfs: bool, reason: str) -> Dict[str, Any]:
+        return {
+            "dir": tmpfs_dir if use_tmpfs else disk_dir,
+            "tmpfs": use_tmpfs,
+            "estimate_mb": estimate_bytes // (1024 * 1024) if estimate_bytes is not None else None,
+            "reason": reason,
+        }
+
+    if estimate_bytes is None:
+        return location(False, "build size unknown")
+
+    if not os.path.isdir(tmpfs_dir) or not _is_tmpfs(tmpfs_dir):
+        return location(False, f"{tmpfs_dir} is not a tmpfs")
+
+    vfs = os.statvfs(tmpfs_dir)
+    tmpfs_free = vfs.f_bavail * vfs.f_frsize
+    if estimate_bytes > tmpfs_free:
+        return location(False, f"needs more than the {tmpfs_free // (1024 * 1024)} MB free on {tmpfs_dir}")
+
+    memory_free = _available_memory_bytes()
+    if memory_free is None or estimate_bytes > memory_free:
+        return location(False, "needs more than the available memory")
+
+    return location(True, "fits in tmpfs and available memory")
+
+# Files in a build directory which do not affect the built package
+BUILD_KEY_IGNORED_DIRS = [".git"]
+
+# Matches PKGBUILD sources checked out from version control, e.g. "name::git+https://...", their content can change without the build files changing
+VCS_SOURCE_PATTERN = re.compile(r'(^|::|[\s(\'"])(git|svn|hg|bzr|fossil)\+[a-z]+://', re.MULTILINE)
+
+
+def _chown_to_build_user(path: str) -> None:
+    """Give a file or directory to the build user, if one is configured.
+
+    Arguments:
+        path: File or directory, not recursive
+    """
+    build_user = __salt__["pacman_build.get_build_user"]()
+    if build_user:
+        pw = pwd.getpwnam(build_user)
+        os.chown(path, pw.pw_uid, pw.pw_gid, follow_symlinks=False)
+
+
+def _copy_to_build_user(src: str, dst: str) -> None:
+    """Copy a file and give the copy to the build user.
+
+    Used as a shutil copy function, shutil.copy2 uses copy_file_range/sendfile where possible.
+
+    Arguments:
+        src: File to copy
+        dst: Destination path
+    """
+    shutil.copy2(src, dst, follow_symlinks=False)
+    _chown_to_build_user(dst)
+
+
+def _hand_off(src_dir: str, dst_dir: str) -> None:
+    """Move the contents of one directory into another, replacing existing entries.
+
+    Entries are renamed, which costs nothing when both directories are on the same
+    filesystem. Entries are only copied if the directories are on different filesystems.
+    Ownership is set in-process, entries already owned by the build user keep their owner.
+
+    Arguments:
+        src_dir: Directory to empty
+        dst_dir: Directory to fill
+    """
+    for entry in os.listdir(src_dir):
+        src_path = os.path.join(src_dir, entry)
+        dst_path = os.path.join(dst_dir, entry)
+
+        if os.path.isdir(dst_path) and not os.path.islink(dst_path):
+            shutil.rmtree(dst_path)
+        elif os.path.lexists(dst_path):
+            os.remove(dst_path)
+
+        try:
+            os.replace(src_path, dst_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+            if os.path.isdir(src_path) and not os.path.islink(src_path):
+                shutil.copytree(src_path, dst_path, symlinks=True, copy_function=_copy_to_build_user)
+                for root, dirs, _ in os.walk(dst_path):
+                    _chown_to_build_user(root)
+            else:
+                _copy_to_build_user(src_path, dst_path)
+
 
 @contextlib.contextmanager
-def _build_directory(keep: bool, pkg_hint: Optional[str] = None):
-    """Context manager for build directory - either temp or persistent.
+def _build_directory(prepared: "PreparedBuild"):
+    """Context manager for build directory - either temporary or persistent.
+
+    Temporary build directories are placed on tmpfs or disk by _choose_build_location(),
+    the decision is recorded in the build's details.
 
     Arguments:
-        keep: If True, use persistent directory; if False, use temporary directory
-        pkg_hint: Optional package name hint for naming the persistent directory
+        prepared: Build to get a directory for, its download directory is emptied into the build directory
 
     Yields:
-        Path to the build directory
+        Path to the build directory, containing the prepared build files
     """
-    if keep:
+    download_dir = prepared["download_dir"]
+    pkg_hint = prepared["pkg_hint"]
+
+    if prepared["keep_builddir"]:
         # Use persistent directory
-        base_dir = "/var/cache/salt/makepkg"
-        os.makedirs(base_dir, exist_ok=True)
+        os.makedirs(MAKEPKG_DIR, exist_ok=True)
 
         # Use package name as subdirectory if available, otherwise use temp name
         if pkg_hint:
-            builddir = os.path.join(base_dir, pkg_hint)
+            builddir = os.path.join(MAKEPKG_DIR, pkg_hint)
         else:
-            builddir = os.path.join(base_dir, f"build_{os.getpid()}")
+            builddir = os.path.join(MAKEPKG_DIR, f"build_{os.getpid()}")
 
         os.makedirs(builddir, exist_ok=True)
+        _chown_to_build_user(builddir)
+        os.chmod(builddir, stat.S_IRWXU | stat.S_IRWXG | stat.S_IROTH | stat.S_IXOTH)
+
+        _hand_off(download_dir, builddir)
+
         try:
             yield builddir
         finally:
             pass  # Keep the directory
+        return
+
+    build_location = _choose_build_location(pkg_hint, prepared["build_size_mb"])
+    prepared["details"]["build_location"] = build_location
+    log.info("Building %s in %s: %s", pkg_hint, build_location["dir"], build_location["reason"])
+
+    # Code after each yield only runs if the build succeeded
+    if os.stat(build_location["dir"]).st_dev == os.stat(download_dir).st_dev:
+        # Build in place, the download directory is temporary and already owned by the build user
+        yield download_dir
+        _record_peak_size(prepared, download_dir)
     else:
-        # Use temporary directory
-        with tempfile.TemporaryDirectory() as tmpdir:
-            yield tmpdir
+        with tempfile.TemporaryDirectory(dir=build_location["dir"]) as builddir:
+            _chown_to_build_user(builddir)
+            os.chmod(builddir, stat.S_IRWXU | stat.S_IRWXG | stat.S_IROTH | stat.S_IXOTH)
+            _hand_off(download_dir, builddir)
 
+            yield builddir
+            _record_peak_size(prepared, builddir)
 
-def _parse_pkgbuild_name(pkgbuild_content: str) -> Optional[str]:
-    """Parse the package name from PKGBUILD content.
+
+def _record_peak_size(prepared: "PreparedBuild", builddir: str) -> None:
+    """Measure a finished temporary build directory and record it for future build location decisions.
+
+    makepkg leaves the extracted sources and package contents in place, so the size
+    after a build is close to the peak size during it.
+
+    Arguments:
+        prepared: Build which finished, its build location details are updated
+        builddir: Build directory
+    """
+    size_bytes = _dir_size_bytes(builddir)
+    prepared["details"]["build_location"]["peak_mb"] = size_bytes // (1024 * 1024)
+
+    try:
+        _record_build_size(prepared["pkg_hint"], size_bytes)
+    except OSError as e:
+        log.warning("Failed to record build size of %s: %s", prepared["pkg_hint"], e)
+
+
+def _build_cache_key(build_files_dir: str, file_args: Dict[str, Any], build_flags: Dict[str, Any]) -> str:
+    """Compute the package cache key of a prepared build directory.
+
+    Arguments:
+        build_files_dir: Directory containing the PKGBUILD and any other build files, after patches were applied
+        file_args: File-managed style arguments used to render the PKGBUILD
+        build_flags: makepkg options which change the built package, e.g. check
+
+    Returns:
+        Hex digest which changes if any build file, the template context or a build flag changes
+    """
+    key_hash = hashlib.sha256()
+
+    for root, dirs, files in os.walk(build_files_dir):
+        dirs[:] = sorted(d for d in dirs if d not in BUILD_KEY_IGNORED_DIRS)
+
+        for file_name in sorted(files):
+            file_path = os.path.join(root, file_name)
+            key_hash.update(os.path.relpath(file_path, build_files_dir).encode() + b"\0")
+
+            with open(file_path, "rb") as f:
+                while chunk := f.read(65536):
+                    key_hash.update(chunk)
+            key_hash.update(b"\0")
+
+    template_key = {
+        "template": file_args.get("template"),
+        "context": file_args.get("context"),
+        "defaults": file_args.get("defaults"),
+        "build_flags": build_flags,
+    }
+    key_hash.update(json.dumps(template_key, sort_keys=True, default=str).encode())
+
+    return key_hash.hexdigest()
+
+
+def _list_package_files(directory: str) -> List[str]:
+    """List built package archives in a directory.
+
+    Arguments:
+        directory: Directory to search
+
+    Returns:
+        Sorted paths of package archives, excluding signatures
+    """
+    return sorted(
+        path for path in glob.glob(os.path.join(directory, "*.pkg.tar*"))
+        if not path.endswith(".sig")
+    )
+
+
+def _get_cached_packages(cache_key: str) -> List[str]:
+    """Get the cached packages built for a cache key.
+
+    Marks the cache entry as recently used.
+
+    Arguments:
+        cache_key: Key from _build_cache_key()
+
+    Returns:
+        Paths of cached package archives, empty if there is no cache entry
+    """
+    entry_dir = os.path.join(PACKAGE_CACHE_DIR, cache_key)
+    if not os.path.isdir(entry_dir):
+        return []
+
+    package_files = _list_package_files(entry_dir)
+    if package_files:
+        os.utime(entry_dir)
+
+    return package_files
+
+
+def _store_cached_packages(cache_key: str, package_files: List[str]) -> None:
+    """Copy built packages into the package cache, then evict old entries if the cache is too large.
+
+    Arguments:
+        cache_key: Key from _build_cache_key()
+        package_files: Paths of built package archives
+    """
+    entry_dir = os.path.join(PACKAGE_CACHE_DIR, cache_key)
+    tmp_entry_dir = f"{entry_dir}.tmp"
+
+    shutil.rmtree(tmp_entry_dir, ignore_errors=True)
+    os.makedirs(tmp_entry_dir)
+    for package_file in package_files:
+        shutil.copy2(package_file, tmp_entry_dir)
+
+    # Move into place so a partially copied entry is never used
+    shutil.rmtree(entry_dir, ignore_errors=True)
+    os.rename(tmp_entry_dir, entry_dir)
+
+    _evict_cached_packages()
+
+
+def _evict_cached_packages() -> None:
+    """Remove the least recently used package cache entries until the cache fits its size limit.
+    """
+    max_mb = __opts__.get(OPTS_PARENT_KEY, {}).get(OPTS_PACKAGE_CACHE_MAX_MB_KEY, DEFAULT_PACKAGE_CACHE_MAX_MB)
+    max_bytes = max_mb * 1024 * 1024
+
+    entries = []
+    total_bytes = 0
+    with os.scandir(PACKAGE_CACHE_DIR) as cache_entries:
+        for entry in cache_entries:
+            if not entry.is_dir() or entry.name.endswith(".tmp"):
+                continue
+
+            entry_bytes = sum(os.path.getsize(path) for path in _list_package_files(entry.path))
+            entries.append((entry.stat().st_mtime, entry_bytes, entry.path))
+            total_bytes += entry_bytes
+
+    # Oldest first
+    entries.sort()
+
+    # Always keep the most recently used entry, even if it alone is over the limit
+    for _, entry_bytes, entry_path in entries[:-1]:
+        if total_bytes <= max_bytes:
+            break
+
+        log.info("Evicting %s from makepkg package cache", entry_path)
+        shutil.rmtree(entry_path, ignore_errors=True)
+        total_bytes -= entry_bytes
+
+
+def _install_package_files(package_files: List[str]) -> None:
+    """Install package archives with pacman.
+
+    Arguments:
+        package_files: Paths of package archives
+
+    Raises:
+        CommandExecutionError: If pacman fails
+    """
+    cmd = ["pacman", "--upgrade", "--noconfirm", "--needed", *package_files]
+    with trace_span(__opts__, __context__, __salt__, cmd, "makepkg"):
+        __salt__["cmd.run"](
+            cmd=cmd,
+            python_shell=False,
+            raise_err=True,
+        )
+
+
+def clear_render_cache() -> int:
+    """Forget PKGBUILDs and patches rendered earlier in this Salt run.
+
+    Rendered files are cached by salt_file_utils, which also drops other modules' files.
+
+    Returns:
+        Number of rendered files forgotten
+    """
+    return __salt__["salt_file_utils.clear_cache"]()
+
+
+def _parse_pkgbuild_names(pkgbuild_content: str) -> Optional[List[str]]:
+    """Parse the package names from PKGBUILD content.
+
+    Supports a single pkgname value and pkgname arrays of split packages. References to
+    pkgbase in the array are expanded.
 
     Arguments:
         pkgbuild_content: The content of the PKGBUILD file
 
     Returns:
-        The package name, or None if not found
+        The package names, or None if not found or if they need other shell expansion
     """
+    # Look for pkgname=( ... ), which may span multiple lines
+    array_match = re.search(r'^pkgname\s*=\s*\((.*?)\)', pkgbuild_content, re.MULTILINE | re.DOTALL)
+    if array_match:
+        try:
+            names = shlex.split(array_match.group(1), comments=True)
+        except ValueError:
+            return None
+
+        pkgbase = _parse_pkgbuild_var(pkgbuild_content, "pkgbase")
+        if pkgbase:
+            names = [re.sub(r'\$\{pkgbase\}|\$pkgbase\b', pkgbase, name) for name in names]
+
+        if not names or any("$" in name for name in names):
+            return None
+        return names
+
     # Look for pkgname= or pkgname =
     match = re.search(r'^pkgname\s*=\s*["\']?([^"\')\s]+)["\']?', pkgbuild_content, re.MULTILINE)
-    if match:
-        return match.group(1)
+    if match and "$" not in match.group(1):
+        return [match.group(1)]
+    return None
+
+
+def _parse_pkgbuild_name(pkgbuild_content: str) -> Optional[str]:
+    """Parse the package name from PKGBUILD content.
+
+    Arguments:
+        pkgbuild_content: The content of the PKGBUILD file
+
+    Returns:
+        The package name, the first package for split packages, or None if not found
+    """
+    names = _parse_pkgbuild_names(pkgbuild_content)
+    if names:
+        return names[0]
+    return None
+
+
+def _package_file_name(package_file: str) -> str:
+    """Get the package name from a package archive's file name.
+
+    Arguments:
+        package_file: Path like foo-docs-1:1.2-3-x86_64.pkg.tar.zst
+
+    Returns:
+        Package name, like foo-docs
+    """
+    base_name = re.sub(r'\.pkg\.tar(\.\w+)?$', '', os.path.basename(package_file))
+    return base_name.rsplit("-", 3)[0]
+
+
+def _parse_pkgbuild_var(pkgbuild_content: str, var: str) -> Optional[str]:
+    """Parse a literal single-value variable assignment from PKGBUILD content.
+
+    Arguments:
+        pkgbuild_content: The content of the PKGBUILD file
+        var: Name of the variable
+
+    Returns:
+        The value, or None if not assigned or if the value needs shell expansion
+    """
+    match = re.search(rf'^{var}\s*=\s*["\']?([^"\'()\s]+)["\']?\s*(#.*)?$', pkgbuild_content, re.MULTILINE)
+    if not match or "$" in match.group(1):
+        return None
+    return match.group(1)
+
+
+def _parse_srcinfo(srcinfo_content: str) -> Dict[str, List[str]]:
+    """Parse .SRCINFO content.
+
+    Values from the pkgbase section and every split package section are combined.
+
+    Arguments:
+        srcinfo_content: The content of a .SRCINFO file or the output of makepkg --printsrcinfo
+
+    Returns:
+        Maps each key to its values in the order they appear
+    """
+    values: Dict[str, List[str]] = {}
+
+    for line in srcinfo_content.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#") or "=" not in line:
+            continue
+
+        key, _, value = line.partition("=")
+        values.setdefault(key.strip(), []).append(value.strip())
+
+    return values
+
+
+def _format_version(pkgver: str, pkgrel: str, epoch: Optional[str] = None) -> str:
+    """Format a package version the same way pacman does.
+
+    Arguments:
+        pkgver: Upstream version
+        pkgrel: Package release
+        epoch: Optional epoch, omitted if 0
+
+    Returns:
+        Full version string epoch:pkgver-pkgrel
+    """
+    version = f"{pkgver}-{pkgrel}"
+    if epoch and epoch != "0":
+        version = f"{epoch}:{version}"
+    return version
+
+
+def _get_srcinfo(build_files_dir: str, pkgbuild_content: str, patched: bool) -> Dict[str, List[str]]:
+    """Get the parsed .SRCINFO of a prepared build directory.
+
+    Uses the .SRCINFO shipped with the build files if the PKGBUILD was not patched,
+    otherwise asks makepkg to generate it from the PKGBUILD. The generated .SRCINFO
+    is memoized by pacman_build.query for as long as the PKGBUILD content is unchanged.
+
+    Arguments:
+        build_files_dir: Directory containing the PKGBUILD
+        pkgbuild_content: The content of the PKGBUILD file
+        patched: If patches were applied, which makes any shipped .SRCINFO stale
+
+    Returns:
+        Parsed .SRCINFO, see _parse_srcinfo()
+
+    Raises:
+        CommandExecutionError: If makepkg fails to print the .SRCINFO
+    """
+    srcinfo_path = os.path.join(build_files_dir, ".SRCINFO")
+    if not patched and os.path.isfile(srcinfo_path):
+        with open(srcinfo_path, "r") as f:
+            return _parse_srcinfo(f.read())
+
+    pkgbuild_hash = hashlib.sha256(pkgbuild_content.encode()).hexdigest()
+    return _parse_srcinfo(__salt__["pacman_build.query"](
+        "makepkg --printsrcinfo",
+        scope=f"pkgbuild:{pkgbuild_hash}",
+        cwd=build_files_dir,
+    ))
+
+
+def _parse_pkgbuild_version(pkgbuild_content: str) -> Optional[str]:
+    """Parse the full version from literal assignments in PKGBUILD content.
+
+    Arguments:
+        pkgbuild_content: The content of the PKGBUILD file
+
+    Returns:
+        Version as epoch:pkgver-pkgrel, or None if it needs shell expansion
+    """
+    pkgver = _parse_pkgbuild_var(pkgbuild_content, "pkgver")
+    pkgrel = _parse_pkgbuild_var(pkgbuild_content, "pkgrel")
+    epoch = _parse_pkgbuild_var(pkgbuild_content, "epoch")
+    epoch_assigned = re.search(r'^epoch\s*=', pkgbuild_content, re.MULTILINE) is not None
+
+    if pkgver and pkgrel and (epoch or not epoch_assigned):
+        return _format_version(pkgver, pkgrel, epoch)
+
     return None
 
 
+def _get_pkgbuild_version(build_files_dir: str, pkgbuild_content: str, patched: bool) -> Optional[str]:
+    """Get the full version a PKGBUILD will build.
+
+    Literal assignments in the PKGBUILD are used when possible, avoiding a makepkg process.
+
+    Arguments:
+        build_files_dir: Directory containing the PKGBUILD
+        pkgbuild_content: The content of the PKGBUILD file
+        patched: If patches were applied to the build files
+
+    Returns:
+        Version as epoch:pkgver-pkgrel, or None if it could not be determined
+    """
+    version = _parse_pkgbuild_version(pkgbuild_content)
+    if version is not None:
+        return version
+
+    try:
+        srcinfo = _get_srcinfo(build_files_dir, pkgbuild_content, patched)
+    except CommandExecutionError as e:
+        log.warning("Failed to determine PKGBUILD version: %s", e)
+        return None
+
+    if not srcinfo.get("pkgver") or not srcinfo.get("pkgrel"):
+        return None
+
+    return _format_version(
+        srcinfo["pkgver"][0],
+        srcinfo["pkgrel"][0],
+        srcinfo.get("epoch", [None])[0],
+    )
+
+
+def _has_pkgver_function(pkgbuild_content: str) -> bool:
+    """Check if a PKGBUILD computes its version at build time, as VCS packages do.
+
+    Arguments:
+        pkgbuild_content: The content of the PKGBUILD file
+
+    Returns:
+        True if the PKGBUILD defines a pkgver() function
+    """
+    return re.search(r'^\s*(function\s+)?pkgver\s*\(\s*\)', pkgbuild_content, re.MULTILINE) is not None
+
+
+def _has_vcs_sources(pkgbuild_content: str) -> bool:
+    """Check if a PKGBUILD checks out any of its sources from version control.
+
+    Arguments:
+        pkgbuild_content: The content of the PKGBUILD file
+
+    Returns:
+        True if a source uses a VCS protocol like git+https://
+    """
+    return VCS_SOURCE_PATTERN.search(pkgbuild_content) is not None
+
+
 def get_pkgname(source: str, **file_args) -> Optional[str]:
     """Get the package name from a PKGBUILD source.
 
@@ -89,70 +822,518 @@ def get_pkgname(source: str, **file_args) -> Optional[str]:
     return _parse_pkgbuild_name(pkgbuild_content)
 
 
-def is_installed(pkgname: str) -> bool:
-    """Check if a package is installed.
+def get_pkgnames(source: str, **file_args) -> Optional[List[str]]:
+    """Get the package names from a PKGBUILD source, more than one for split packages.
+
+    Arguments:
+        source: Path to PKGBUILD file (can be salt:// URI or local path)
+        **file_args: File-managed style arguments (template, context, defaults, etc.)
+
+    Returns:
+        The package names, or None if not found
+
+    Raises:
+        SaltInvocationError: If the PKGBUILD cannot be retrieved
+    """
+    pkgbuild_content = __salt__["salt_file_utils.get_managed_file_content"](
+        source=source,
+        **file_args
+    )
+    return _parse_pkgbuild_names(pkgbuild_content)
+
+
+def get_version(source: str, **file_args) -> Optional[str]:
+    """Get the full version a PKGBUILD source will build.
+
+    Arguments:
+        source: Path to PKGBUILD file (can be salt:// URI or local path)
+        **file_args: File-managed style arguments (template, context, defaults, etc.)
+
+    Returns:
+        Version as epoch:pkgver-pkgrel, or None if it could not be determined
+        without running makepkg, or if the version is computed at build time
+
+    Raises:
+        SaltInvocationError: If the PKGBUILD cannot be retrieved
+    """
+    pkgbuild_content = __salt__["salt_file_utils.get_managed_file_content"](
+        source=source,
+        **file_args
+    )
+    if _has_pkgver_function(pkgbuild_content):
+        return None
+
+    return _parse_pkgbuild_version(pkgbuild_content)
+
+
+def is_installed(pkgname: str) -> bool:
+    """Check if a package is installed.
+
+    Arguments:
+        pkgname: The name of the package to check
+
+    Returns:
+        True if the package is installed, False otherwise
+    """
+    return __salt__["pacman_index.is_installed"](pkgname)
+
+
+def _update_git_mirror(upstream_source: str) -> str:
+    """Create or update the local bare mirror of a package's upstream git repository.
+
+    The mirror is only fetched if it was last fetched longer than git_mirror_ttl seconds ago.
+    New mirrors are cloned from the upstream_git_url minion option if set, otherwise
+    the repository yay -G clones is mirrored.
+
+    Arguments:
+        upstream_source: Name of the package in the AUR or ABS
+
+    Returns:
+        Path of the mirror
+
+    Raises:
+        CommandExecutionError: If git or yay fail
+    """
+    opts = __opts__.get(OPTS_PARENT_KEY, {})
+    mirror_dir = os.path.join(GIT_MIRROR_DIR, f"{upstream_source}.git")
+    stamp_path = os.path.join(mirror_dir, GIT_MIRROR_STAMP_FILE)
+
+    if os.path.isdir(mirror_dir):
+        ttl = opts.get(OPTS_GIT_MIRROR_TTL_KEY, DEFAULT_GIT_MIRROR_TTL)
+        if os.path.isfile(stamp_path) and time.time() - os.stat(stamp_path).st_mtime < ttl:
+            log.debug("Git mirror of %s fetched within %ds, not fetching", upstream_source, ttl)
+            return mirror_dir
+
+        __salt__["pacman_build.run_cmd"](
+            f"git --git-dir={shlex.quote(mirror_dir)} fetch --prune --quiet origin"
+        )
+    else:
+        os.makedirs(GIT_MIRROR_DIR, exist_ok=True)
+        _chown_to_build_user(GIT_MIRROR_DIR)
+
+        url_template = opts.get(OPTS_UPSTREAM_GIT_URL_KEY)
+        if url_template:
+            url = url_template.format(pkg=upstream_source)
+            __salt__["pacman_build.run_cmd"](
+                f"git clone --mirror --quiet {shlex.quote(url)} {shlex.quote(mirror_dir)}"
+            )
+        else:
+            # Let yay work out if the package is from the AUR or ABS, then mirror its clone
+            with tempfile.TemporaryDirectory() as bootstrap_dir:
+                _chown_to_build_user(bootstrap_dir)
+                __salt__["pacman_build.run_cmd"](f"yay -G --force {upstream_source}", cwd=bootstrap_dir)
+
+                clone_dir = os.path.join(bootstrap_dir, upstream_source)
+                url = __salt__["pacman_build.run_cmd"]("git config --get remote.origin.url", cwd=clone_dir).strip()
+
+                __salt__["pacman_build.run_cmd"](
+                    f"git clone --mirror --quiet {shlex.quote(clone_dir)} {shlex.quote(mirror_dir)}"
+                )
+                __salt__["pacman_build.run_cmd"](
+                    f"git --git-dir={shlex.quote(mirror_dir)} remote set-url origin {shlex.quote(url)}"
+                )
+
+    with open(stamp_path, "w"):
+        pass
+    _chown_to_build_user(stamp_path)
+
+    return mirror_dir
+
+
+def _fetch_upstream(upstream_source: str, download_dir: str) -> None:
+    """Get the build files of a package from the AUR or ABS into download_dir/upstream_source.
+
+    Files are checked out from a local mirror, which shares its objects with the checkout.
+    If the mirror can't be used the files are downloaded with yay -G.
+
+    Arguments:
+        upstream_source: Name of the package in the AUR or ABS
+        download_dir: Directory owned by the build user
+
+    Raises:
+        CommandExecutionError: If the files can't be downloaded
+    """
+    checkout_dir = os.path.join(download_dir, upstream_source)
+
+    try:
+        mirror_dir = _update_git_mirror(upstream_source)
+        __salt__["pacman_build.run_cmd"](
+            f"git clone --shared --quiet {shlex.quote(mirror_dir)} {shlex.quote(checkout_dir)}"
+        )
+        return
+    except CommandExecutionError as e:
+        log.warning("Failed to use git mirror of %s, downloading with yay -G: %s", upstream_source, e)
+        shutil.rmtree(checkout_dir, ignore_errors=True)
+
+    __salt__["pacman_build.run_cmd"](f"yay -G --force {upstream_source}", cwd=download_dir)
+
+
+def _read_git_head(git_dir: str) -> Optional[str]:
+    """Read the commit HEAD points to in a git repository, without running git.
+
+    Arguments:
+        git_dir: Path of the repository's git directory
+
+    Returns:
+        Commit hash, or None if it could not be read
+    """
+    try:
+        with open(os.path.join(git_dir, "HEAD"), "r") as f:
+            head = f.read().strip()
+    except OSError:
+        return None
+
+    if not head.startswith("ref: "):
+        return head
+    ref = head[len("ref: "):]
+
+    try:
+        with open(os.path.join(git_dir, ref), "r") as f:
+            return f.read().strip()
+    except OSError:
+        pass
+
+    # Refs of freshly cloned mirrors are only in packed-refs
+    try:
+        with open(os.path.join(git_dir, "packed-refs"), "r") as f:
+            for line in f:
+                commit, _, packed_ref = line.strip().partition(" ")
+                if packed_ref == ref:
+                    return commit
+    except OSError:
+        pass
+
+    return None
+
+
+class BuildMetadata(TypedDict):
+    """Package names and version of a PKGBUILD, known without preparing its build files.
+
+    Fields:
+    - pkgnames: Names of the packages to install, a subset of the split packages the PKGBUILD builds
+    - version: Version the PKGBUILD builds, None for VCS packages
+    - vcs: If the PKGBUILD computes its version at build time
+    """
+    pkgnames: List[str]
+    version: Optional[str]
+    vcs: bool
+
+
+def _read_build_metadata() -> Dict[str, Dict[str, Any]]:
+    """Read the recorded metadata of prepared builds.
+
+    Returns:
+        Maps source or upstream_source to the resolve key of the build files last
+        prepared for it (key), and their pkgnames, version and vcs flag
+    """
+    try:
+        with open(BUILD_METADATA_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _record_build_metadata(origin: str, resolve_key: str, all_pkgnames: List[str], version: Optional[str], vcs: bool) -> None:
+    """Record the metadata of prepared build files, replacing the record of earlier build files of the same origin.
+
+    Arguments:
+        origin: source or upstream_source of the build
+        resolve_key: Key of the build files, see _resolve_key()
+        all_pkgnames: Every package the PKGBUILD builds
+        version: Version the PKGBUILD builds, None for VCS packages
+        vcs: If the PKGBUILD computes its version at build time
+    """
+    with _build_metadata_lock:
+        metadata = _read_build_metadata()
+        metadata[origin] = {
+            "key": resolve_key,
+            "pkgnames": all_pkgnames,
+            "version": version,
+            "vcs": vcs,
+        }
+
+        os.makedirs(MAKEPKG_DIR, exist_ok=True)
+        tmp_path = f"{BUILD_METADATA_FILE}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(metadata, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, BUILD_METADATA_FILE)
+
+
+def _resolve_key(
+    source: Optional[str],
+    upstream_source: Optional[str],
+    patches: Optional[list],
+    offline: bool,
+    **file_args
+) -> Optional[str]:
+    """Identify the build files of a package without downloading them.
+
+    Arguments:
+        source: See installed()
+        upstream_source: See installed()
+        patches: See installed()
+        offline: If True an upstream_source's git mirror is used as is, instead of being fetched when stale
+        **file_args: File-managed style arguments (template, context, defaults, etc.)
+
+    Returns:
+        Hex digest which changes if the build files change, or None if they can't be identified
+
+    Raises:
+        SaltInvocationError: If the PKGBUILD or a patch cannot be retrieved or rendered
+        CommandExecutionError: If the git mirror cannot be fetched
+    """
+    def file_key(file_source: str) -> str:
+        key = __salt__["salt_file_utils.get_managed_file_key"](source=file_source, **file_args)
+        if key is None:
+            # Sources the file server can't hash, like http:// URLs, are identified by their content
+            content = __salt__["salt_file_utils.get_managed_file_content"](source=file_source, **file_args)
+            key = hashlib.sha256(content.encode()).hexdigest()
+        return key
+
+    if source:
+        parts = ["source", file_key(source)]
+    else:
+        mirror_dir = os.path.join(GIT_MIRROR_DIR, f"{upstream_source}.git")
+        if not offline:
+            mirror_dir = _update_git_mirror(upstream_source)
+
+        commit = _read_git_head(mirror_dir)
+        if commit is None:
+            return None
+        parts = ["upstream_source", upstream_source, commit]
+
+    for patch_source in patches or []:
+        parts.append(file_key(patch_source))
+
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+def _lookup_metadata(
+    resolve_key: str,
+    source: Optional[str],
+    upstream_source: Optional[str],
+    patches: Optional[list],
+    pkgnames: Optional[List[str]],
+    **file_args
+) -> Optional[BuildMetadata]:
+    """Find the package names and version of build files without preparing them.
+
+    Arguments:
+        resolve_key: Key of the build files, see _resolve_key()
+        See installed() for other arguments
+
+    Returns:
+        The metadata, or None if the build files must be prepared to know it
+    """
+    recorded = _read_build_metadata().get(upstream_source or source)
+
+    if recorded is not None and recorded.get("key") == resolve_key:
+        all_pkgnames = recorded["pkgnames"]
+        version = recorded["version"]
+        vcs = recorded["vcs"]
+    elif source and not patches:
+        pkgbuild_content = __salt__["salt_file_utils.get_managed_file_content"](source=source, **file_args)
+        all_pkgnames = _parse_pkgbuild_names(pkgbuild_content)
+        vcs = _has_pkgver_function(pkgbuild_content)
+        version = None if vcs else _parse_pkgbuild_version(pkgbuild_content)
+    else:
+        return None
+
+    if not all_pkgnames or (version is None and not vcs):
+        return None
+    if pkgnames and any(name not in all_pkgnames for name in pkgnames):
+        return None
+
+    return BuildMetadata(
+        pkgnames=pkgnames or all_pkgnames,
+        version=version,
+        vcs=vcs,
+    )
+
+
+def resolve(
+    source: Optional[str] = None,
+    upstream_source: Optional[str] = None,
+    patches: Optional[list] = None,
+    pkgnames: Optional[List[str]] = None,
+    **file_args
+) -> Optional[Dict[str, Any]]:
+    """Get the package names and version a build would install, without downloading or building.
+
+    Git mirrors of upstream_source packages are not fetched.
+
+    Arguments:
+        See installed()
+
+    Returns:
+        Dictionary with keys pkgnames, version (None for VCS packages) and vcs,
+        or None if the build files must be prepared to know them
+    """
+    try:
+        resolve_key = _resolve_key(source, upstream_source, patches, True, **file_args)
+    except (SaltInvocationError, CommandExecutionError) as e:
+        log.debug("Failed to resolve build files: %s", e)
+        return None
+
+    if resolve_key is None:
+        return None
+
+    return _lookup_metadata(resolve_key, source, upstream_source, patches, pkgnames, **file_args)
+
+
+def _check_metadata(metadata: BuildMetadata, timings: Dict[str, float]) -> Optional[Dict[str, Any]]:
+    """Check if every package of resolved metadata is already installed, see _check_installed().
+
+    Arguments:
+        metadata: Resolved metadata of the build
+        timings: Stage timings of the build
+
+    Returns:
+        Result if no build is needed, None if the build files must be prepared
+    """
+    with timed_phase(timings, "check"):
+        installed_versions = [__salt__["pacman_index.version"](name) for name in metadata["pkgnames"]]
+        if any(version is None for version in installed_versions):
+            return None
+        if not metadata["vcs"] and any(__salt__["pacman_index.vercmp"](version, metadata["version"]) < 0 for version in installed_versions):
+            return None
+
+    return {
+        "success": True,
+        "pkgname": metadata["pkgnames"][0],
+        "pkgnames": metadata["pkgnames"],
+        "message": f"Package {', '.join(metadata['pkgnames'])} is already installed",
+        "old_version": installed_versions[0],
+        "new_version": installed_versions[0],
+        "timings": timings,
+    }
+
+
+class PreparedBuild(TypedDict):
+    """Build files of a package which are ready to be checked and built.
+
+    Fields:
+    - pkgname: Name of the package, the first selected package for split packages
+    - pkgnames: Names of the packages to install, a subset of the split packages the PKGBUILD builds
+    - pkg_hint: Name used for the persistent build directory
+    - download_dir: Directory containing the PKGBUILD and other build files, after patches were applied
+    - pkgbuild_content: The content of the PKGBUILD, after patches were applied
+    - patched: If patches were applied to the build files
+    - file_args: File-managed style arguments used to render the PKGBUILD
+    - keep_builddir: If the build directory should be kept after building
+    - install_deps: Whether makepkg should install missing dependencies
+    - check: Whether to run makepkg's check function
+    - incremental: If builds reuse the kept build directory's sources and a compiler cache
+    - build_size_mb: Declared size of the build directory during a build, None to use the recorded size
+    - old_version: Version of the package installed before building, None if not installed
+    - version: Version the PKGBUILD builds, None for VCS packages or if it could not be determined
+    - cache_key: Package cache key, see _build_cache_key(), None if the package must not be cached
+    - timings: Maps build stages to the seconds spent in them
+    - details: Extra information about the build to include in the result
+    """
+    pkgname: str
+    pkgnames: List[str]
+    pkg_hint: str
+    download_dir: str
+    pkgbuild_content: str
+    patched: bool
+    file_args: Dict[str, Any]
+    keep_builddir: bool
+    install_deps: bool
+    check: bool
+    incremental: bool
+    build_size_mb: Optional[int]
+    old_version: Optional[str]
+    version: Optional[str]
+    cache_key: Optional[str]
+    timings: Dict[str, float]
+    details: Dict[str, Any]
+
+
+def _mk_build_user_dir(stack: contextlib.ExitStack, parent: Optional[str] = None) -> str:
+    """Create a temporary directory owned by the build user.
+
+    Arguments:
+        stack: The directory is removed when this stack is closed
+        parent: Directory to create the temporary directory in, the system default if None
+
+    Returns:
+        Path to the directory
+    """
+    tmpdir = stack.enter_context(tempfile.TemporaryDirectory(dir=parent))
+    _chown_to_build_user(tmpdir)
+    os.chmod(tmpdir, stat.S_IRWXU | stat.S_IRWXG | stat.S_IROTH | stat.S_IXOTH)
+
+    return tmpdir
+
+
+def _mk_result(prepared: PreparedBuild, success: bool, message: str) -> Dict[str, Any]:
+    """Create the result of an installed() call.
 
     Arguments:
-        pkgname: The name of the package to check
+        prepared: Build the result is for
+        success: If the package is installed
+        message: Human-readable message about the result
 
     Returns:
-        True if the package is installed, False otherwise
+        Result dictionary, see installed()
     """
-    try:
-        __salt__["pacman_build.run_cmd"](f"pacman --query --info {pkgname}")
-        return True
-    except CommandExecutionError:
-        return False
+    return {
+        "success": success,
+        "pkgname": prepared["pkgname"],
+        "pkgnames": prepared["pkgnames"],
+        "message": message,
+        "old_version": prepared["old_version"],
+        "new_version": __salt__["pacman_index.version"](prepared["pkgname"]),
+        "timings": prepared["timings"],
+        **prepared["details"],
+    }
 
 
-def installed(
+def _prepare(
+    stack: contextlib.ExitStack,
+    timings: Dict[str, float],
+    resolve_key: Optional[str] = None,
     source: Optional[str] = None,
     upstream_source: Optional[str] = None,
     patches: Optional[list] = None,
     keep_builddir: bool = False,
     install_deps: bool = True,
     check: bool = True,
+    incremental: bool = False,
+    build_size_mb: Optional[int] = None,
+    pkgnames: Optional[List[str]] = None,
     **file_args
-) -> Dict[str, Any]:
-    """Build and install a package from a PKGBUILD file.
+) -> PreparedBuild:
+    """Download the build files of a package, apply patches and read metadata.
+
+    The metadata is recorded for the resolve stage of later runs.
 
     Arguments:
-        source: Path to PKGBUILD file (can be salt:// URI or local path)
-        upstream_source: Package name to fetch from ABS/AUR using yay -G
-        patches: List of patch files (salt:// URIs) to apply to the PKGBUILD
-        keep_builddir: If True, use persistent directory at /var/cache/salt/makepkg/<pkgname>
-        install_deps: Whether makepkg should install missing dependencies
-        check: Whether to run makepkg's check function
-        **file_args: File-managed style arguments (template, context, defaults, etc.)
+        stack: Temporary directories are removed when this stack is closed
+        timings: Stage timings of the build
+        resolve_key: Key of the build files, see _resolve_key(). Metadata is not recorded if None
+        See installed() for other arguments
 
     Returns:
-        Dictionary with keys:
-        - success: Boolean indicating if the operation succeeded
-        - pkgname: The name of the package
-        - message: Human-readable message about the result
+        The prepared build
 
     Raises:
-        SaltInvocationError: If parameters are invalid
-        CommandExecutionError: If makepkg command fails
+        SaltInvocationError: If parameters are invalid or the PKGBUILD cannot be parsed
+        CommandExecutionError: If downloading or patching fails
     """
-    # Validate that exactly one of source or upstream_source is provided
-    if source and upstream_source:
-        raise SaltInvocationError("Cannot specify both 'source' and 'upstream_source'")
-    if not source and not upstream_source:
-        raise SaltInvocationError("Must specify either 'source' or 'upstream_source'")
-
-    # Get package hint for directory name
-    pkg_hint = upstream_source if upstream_source else None
-
     # Step 1: Download/prepare PKGBUILD in a temporary directory
-    with tempfile.TemporaryDirectory() as download_dir:
-        build_user = __salt__["pacman_build.get_build_user"]()
+    # Incremental builds reuse the persistent build directory
+    keep_builddir = keep_builddir or incremental
 
-        if build_user:
-            uid = pwd.getpwnam(build_user).pw_uid
-            gid = pwd.getpwnam(build_user).pw_gid
-            os.chown(download_dir, uid, gid)
-            os.chmod(download_dir, stat.S_IRWXU | stat.S_IRWXG | stat.S_IROTH | stat.S_IXOTH)
+    with timed_phase(timings, "fetch"):
+        # Persistent build directories are filled by renaming, so download on the same filesystem
+        download_parent = None
+        if keep_builddir:
+            os.makedirs(MAKEPKG_DIR, exist_ok=True)
+            download_parent = MAKEPKG_DIR
+
+        download_dir = _mk_build_user_dir(stack, parent=download_parent)
 
         if source:
             # Get PKGBUILD content from source
@@ -164,16 +1345,16 @@ def installed(
             pkgbuild_path = os.path.join(download_dir, "PKGBUILD")
             with open(pkgbuild_path, 'w') as f:
                 f.write(pkgbuild_content)
+            _chown_to_build_user(pkgbuild_path)
         else:
-            # Download from upstream using yay -G in temp dir
-            cmd = f"yay -G --force {upstream_source}"
-            __salt__["pacman_build.run_cmd"](cmd, cwd=download_dir)
+            # Check out from the local git mirror of upstream, or download with yay -G in temp dir
+            _fetch_upstream(upstream_source, download_dir)
 
-            # yay -G creates a subdirectory with the package name
+            # Both create a subdirectory with the package name
             pkg_subdir = os.path.join(download_dir, upstream_source)
             if not os.path.isdir(pkg_subdir):
                 raise SaltInvocationError(
-                    f"Internal error: 'yay -G {upstream_source}' did not create expected "
+                    f"Internal error: fetching '{upstream_source}' did not create expected "
                     f"subdirectory '{upstream_source}' in {download_dir}"
                 )
 
@@ -187,19 +1368,19 @@ def installed(
             with open(pkgbuild_path, 'r') as f:
                 pkgbuild_content = f.read()
 
-        # Step 2: Apply patches in download directory
-        if patches:
+    # Step 2: Apply patches in download directory
+    if patches:
+        with timed_phase(timings, "patch"):
             pkgbuild_path = os.path.join(download_dir, "PKGBUILD")
             for patch_source in patches:
-                # Get patch content
-                patch_content = __salt__["salt_file_utils.get_managed_file_content"](
+                # Write patch to temp file
+                patch_path = os.path.join(download_dir, f"patch_{patches.index(patch_source)}.patch")
+                __salt__["salt_file_utils.get_managed_file_path"](
                     source=patch_source,
+                    dest=patch_path,
                     **file_args
                 )
-                # Write patch to temp file
-                patch_path = os.path.join(download_dir, f"patch_{patches.index(patch_source)}.patch")
-                with open(patch_path, 'w') as f:
-                    f.write(patch_content)
+                _chown_to_build_user(patch_path)
 
                 # Apply patch
                 cmd = f"patch {pkgbuild_path} {patch_path}"
@@ -212,70 +1393,656 @@ def installed(
             with open(pkgbuild_path, 'r') as f:
                 pkgbuild_content = f.read()
 
-        # Step 3: Get metadata from PKGBUILD
-        pkgname = _parse_pkgbuild_name(pkgbuild_content)
-        if not pkgname:
+    # Step 3: Get metadata from PKGBUILD
+    with timed_phase(timings, "resolve"):
+        all_pkgnames = _parse_pkgbuild_names(pkgbuild_content)
+        if not all_pkgnames:
+            # Names use shell expansion, let makepkg resolve them
+            try:
+                all_pkgnames = _get_srcinfo(download_dir, pkgbuild_content, bool(patches)).get("pkgname")
+            except CommandExecutionError as e:
+                log.warning("Failed to read .SRCINFO: %s", e)
+
+        if not all_pkgnames:
             raise SaltInvocationError(
                 "Could not parse 'pkgname=' from PKGBUILD. "
                 "Check that the PKGBUILD contains a valid pkgname definition."
             )
 
-        # Step 4: Check if already installed
-        try:
-            __salt__["pacman_build.run_cmd"](f"pacman --query --info {pkgname}")
-            return {
-                "success": True,
-                "pkgname": pkgname,
-                "message": f"Package {pkgname} is already installed"
-            }
-        except CommandExecutionError:
-            pass
-
-        # Step 5: Create build directory and sync content from download_dir
-        with _build_directory(keep_builddir, pkg_hint) as builddir:
-            cmd = f"rsync -a {download_dir}/ {builddir}/"
-            try:
-                __salt__["cmd.run"](cmd, raise_err=True)
-            except CommandExecutionError as e:
-                raise CommandExecutionError(
-                    f"Failed to sync downloaded files to build directory: {e}"
+        if pkgnames:
+            unknown_pkgnames = [name for name in pkgnames if name not in all_pkgnames]
+            if unknown_pkgnames:
+                raise SaltInvocationError(
+                    f"PKGBUILD does not build {', '.join(unknown_pkgnames)}, it builds {', '.join(all_pkgnames)}"
                 )
+        else:
+            pkgnames = all_pkgnames
+
+        # VCS packages compute pkgver at build time, so the PKGBUILD's pkgver is usually older than the installed one
+        vcs = _has_pkgver_function(pkgbuild_content)
+        version = None if vcs else _get_pkgbuild_version(download_dir, pkgbuild_content, bool(patches))
+
+        if resolve_key is not None and (vcs or version is not None):
+            try:
+                _record_build_metadata(upstream_source or source, resolve_key, all_pkgnames, version, vcs)
+            except OSError as e:
+                log.warning("Failed to record metadata of %s: %s", pkgnames[0], e)
+
+    return PreparedBuild(
+        pkgname=pkgnames[0],
+        pkgnames=pkgnames,
+        pkg_hint=upstream_source if upstream_source else all_pkgnames[0],
+        download_dir=download_dir,
+        pkgbuild_content=pkgbuild_content,
+        patched=bool(patches),
+        file_args=file_args,
+        keep_builddir=keep_builddir,
+        install_deps=install_deps,
+        check=check,
+        incremental=incremental,
+        build_size_mb=build_size_mb,
+        old_version=__salt__["pacman_index.version"](pkgnames[0]),
+        version=version,
+        # What VCS packages build changes with upstream, so they are never cached
+        cache_key=None if vcs or _has_vcs_sources(pkgbuild_content) else _build_cache_key(
+            download_dir,
+            file_args,
+            {"install_deps": install_deps, "check": check},
+        ),
+        timings=timings,
+        details={},
+    )
+
+
+def _resolve_and_prepare(
+    stack: contextlib.ExitStack,
+    timings: Dict[str, float],
+    source: Optional[str] = None,
+    upstream_source: Optional[str] = None,
+    patches: Optional[list] = None,
+    pkgnames: Optional[List[str]] = None,
+    **build_args
+) -> Tuple[Optional[Dict[str, Any]], Optional[PreparedBuild]]:
+    """Run the resolve, check, fetch and patch stages of a build, stopping once the package is known to be installed.
+
+    Arguments:
+        stack: Temporary directories are removed when this stack is closed
+        timings: Stage timings of the build
+        See installed() for other arguments
+
+    Returns:
+        Result if no build is needed, otherwise None and the prepared build
+
+    Raises:
+        SaltInvocationError: If parameters are invalid or the PKGBUILD cannot be parsed
+        CommandExecutionError: If downloading or patching fails
+    """
+    # Validate that exactly one of source or upstream_source is provided
+    if source and upstream_source:
+        raise SaltInvocationError("Cannot specify both 'source' and 'upstream_source'")
+    if not source and not upstream_source:
+        raise SaltInvocationError("Must specify either 'source' or 'upstream_source'")
+
+    file_args = {arg: value for arg, value in build_args.items() if arg in FileManagedArgs.__annotations__}
+
+    metadata = None
+    with timed_phase(timings, "resolve"):
+        try:
+            resolve_key = _resolve_key(source, upstream_source, patches, False, **file_args)
+            if resolve_key is not None:
+                metadata = _lookup_metadata(resolve_key, source, upstream_source, patches, pkgnames, **file_args)
+        except (SaltInvocationError, CommandExecutionError) as e:
+            # The fetch stage reports the error if it persists
+            log.debug("Failed to resolve build files: %s", e)
+            resolve_key = None
+
+    if metadata is not None:
+        result = _check_metadata(metadata, timings)
+        if result is not None:
+            return result, None
+
+    prepared = _prepare(
+        stack,
+        timings,
+        resolve_key=resolve_key,
+        source=source,
+        upstream_source=upstream_source,
+        patches=patches,
+        pkgnames=pkgnames,
+        **build_args
+    )
+
+    return _check_installed(prepared), prepared
+
+
+def _check_installed(prepared: PreparedBuild) -> Optional[Dict[str, Any]]:
+    """Check if every selected package is already installed at the version the PKGBUILD builds, or a newer one.
+
+    Arguments:
+        prepared: Build to check
+
+    Returns:
+        Result if no build is needed, None if the package must be built
+    """
+    with timed_phase(prepared["timings"], "check"):
+        installed_versions = {name: __salt__["pacman_index.version"](name) for name in prepared["pkgnames"]}
+        missing_pkgnames = [name for name, version in installed_versions.items() if version is None]
+        if missing_pkgnames:
+            if len(missing_pkgnames) < len(prepared["pkgnames"]):
+                log.info("Building %s, split packages not installed: %s", prepared["pkgname"], ", ".join(missing_pkgnames))
+            return None
+
+        new_version = prepared["version"]
+        outdated = {}
+        if new_version is not None:
+            outdated = {name: version for name, version in installed_versions.items() if __salt__["pacman_index.vercmp"](version, new_version) < 0}
+        if outdated:
+            log.info("Rebuilding %s, installed versions %s are older than PKGBUILD version %s", prepared["pkgname"], outdated, new_version)
+            return None
+
+    return _mk_result(prepared, True, f"Package {', '.join(prepared['pkgnames'])} is already installed")
+
+
+def _select_package_files(prepared: PreparedBuild, package_files: List[str]) -> List[str]:
+    """Pick the archives of the selected packages from everything a build produced.
+
+    Arguments:
+        prepared: Build which produced the packages
+        package_files: Paths of package archives
+
+    Returns:
+        Paths of archives for packages in prepared["pkgnames"]
+
+    Raises:
+        CommandExecutionError: If a selected package was not produced
+    """
+    selected = [path for path in package_files if _package_file_name(path) in prepared["pkgnames"]]
+
+    missing_pkgnames = set(prepared["pkgnames"]) - set(_package_file_name(path) for path in selected)
+    if missing_pkgnames:
+        raise CommandExecutionError(f"Build did not produce packages: {', '.join(sorted(missing_pkgnames))}")
+
+    return selected
+
+
+def _install_cached(prepared: PreparedBuild) -> Optional[Dict[str, Any]]:
+    """Install the package from the package cache if this exact build was done before.
+
+    Arguments:
+        prepared: Build to install
+
+    Returns:
+        Result if installed from the cache, None if the package must be built
+    """
+    if prepared["cache_key"] is None:
+        return None
+
+    with timed_phase(prepared["timings"], "install"):
+        cached_packages = _get_cached_packages(prepared["cache_key"])
+        if not cached_packages:
+            return None
+
+        try:
+            _install_package_files(_select_package_files(prepared, cached_packages))
+        except CommandExecutionError as e:
+            log.warning("Failed to install %s from package cache, rebuilding: %s", prepared["pkgname"], e)
+            return None
+
+    return _mk_result(prepared, True, f"Installed {', '.join(prepared['pkgnames'])} from package cache")
+
+
+def _source_signature(prepared: PreparedBuild) -> str:
+    """Identify the sources a build extracts.
+
+    Arguments:
+        prepared: Build to identify, before its files are handed to the build directory
+
+    Returns:
+        Hex digest which changes if the PKGBUILD, its source array or its checksums change
+    """
+    try:
+        srcinfo = _get_srcinfo(prepared["download_dir"], prepared["pkgbuild_content"], prepared["patched"])
+    except CommandExecutionError as e:
+        log.warning("Failed to read sources of %s, extracting: %s", prepared["pkgname"], e)
+        srcinfo = {}
+
+    sources = {
+        key: values
+        for key, values in srcinfo.items()
+        if key.startswith("source") or re.match(r'^[a-z0-9]+sums', key)
+    }
+    signature = json.dumps(
+        {"pkgbuild": prepared["pkgbuild_content"], "sources": sources},
+        sort_keys=True,
+    )
+
+    return hashlib.sha256(signature.encode()).hexdigest()
+
+
+def _compiler_cache_env(prepared: PreparedBuild, builddir: str) -> Optional[Dict[str, str]]:
+    """Get environment variables which make a build use ccache with a per-package cache.
+
+    Arguments:
+        prepared: Build to configure
+        builddir: Build directory, compiler paths are made relative to it
+
+    Returns:
+        Environment variables, or None if ccache is not installed
+    """
+    if not shutil.which("ccache"):
+        log.warning("ccache is not installed, building %s without a compiler cache", prepared["pkgname"])
+        return None
+
+    cache_dir = os.path.join(COMPILER_CACHE_DIR, prepared["pkg_hint"])
+    os.makedirs(cache_dir, exist_ok=True)
+    _chown_to_build_user(COMPILER_CACHE_DIR)
+    _chown_to_build_user(cache_dir)
+
+    return {
+        "CCACHE_DIR": cache_dir,
+        "CCACHE_BASEDIR": builddir,
+    }
+
+
+def _read_compiler_cache_stats(env: Dict[str, str]) -> Dict[str, Any]:
+    """Read ccache's statistics since they were last zeroed.
+
+    Arguments:
+        env: Environment from _compiler_cache_env()
 
-            # Set ownership on build directory
-            if build_user:
-                uid = pwd.getpwnam(build_user).pw_uid
-                gid = pwd.getpwnam(build_user).pw_gid
-                os.chown(builddir, uid, gid)
-                os.chmod(builddir, stat.S_IRWXU | stat.S_IRWXG | stat.S_IROTH | stat.S_IXOTH)
+    Returns:
+        Dictionary with hits, misses and hit_rate (percent, None if nothing was compiled)
+    """
+    output = __salt__["pacman_build.run_cmd"]("ccache --print-stats", env=env)
+
+    stats = {}
+    for line in output.splitlines():
+        key, _, value = line.partition("\t")
+        if value.strip().isdigit():
+            stats[key.strip()] = int(value)
+
+    hits = stats.get("direct_cache_hit", 0) + stats.get("preprocessed_cache_hit", 0)
+    misses = stats.get("cache_miss", 0)
+
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(100 * hits / (hits + misses), 1) if hits + misses > 0 else None,
+    }
+
+
+def _build(prepared: PreparedBuild, pkgdest: str) -> List[str]:
+    """Build a package with makepkg, timing the build stage, see _run_makepkg().
+
+    Arguments:
+        prepared: Build to run
+        pkgdest: Directory owned by the build user which built packages are written to
+
+    Returns:
+        Paths of built package archives
+
+    Raises:
+        CommandExecutionError: If the build fails
+    """
+    with timed_phase(prepared["timings"], "build"):
+        return _run_makepkg(prepared, pkgdest)
+
+
+def _run_makepkg(prepared: PreparedBuild, pkgdest: str) -> List[str]:
+    """Run makepkg for a prepared build.
+
+    Does not install the package, so builds can run concurrently.
+
+    For incremental builds sources are not re-extracted if they are unchanged since the
+    last successful build in the kept build directory, and ccache is used with a cache
+    dedicated to the package. Cache statistics are recorded in the build's details.
+
+    Arguments:
+        prepared: Build to run
+        pkgdest: Directory owned by the build user which built packages are written to
+
+    Returns:
+        Paths of built package archives
+
+    Raises:
+        CommandExecutionError: If the build fails
+    """
+    # Must be computed before the build files are handed to the build directory
+    source_signature = _source_signature(prepared) if prepared["incremental"] else None
+
+    # Get build directory containing the content of download_dir
+    with _build_directory(prepared) as builddir:
+        # Build makepkg command
+        makepkg_args = ["makepkg", "--noconfirm"]
+        if prepared["install_deps"]:
+            makepkg_args.append("--syncdeps")
+        if not prepared["check"]:
+            makepkg_args.append("--nocheck")
+
+        env = {"PKGDEST": pkgdest}
+        run_kwargs = {}
+        compiler_cache_env = None
+        signature_path = os.path.join(builddir, INCREMENTAL_SIGNATURE_FILE)
+
+        if prepared["incremental"]:
+            previous_signature = None
+            if os.path.isfile(signature_path):
+                with open(signature_path, "r") as f:
+                    previous_signature = f.read().strip()
+
+            if previous_signature == source_signature and os.path.isdir(os.path.join(builddir, "src")):
+                makepkg_args.append("--noextract")
+                prepared["details"]["extracted"] = False
+            else:
+                prepared["details"]["extracted"] = True
+
+            compiler_cache_env = _compiler_cache_env(prepared, builddir)
+            if compiler_cache_env is not None:
+                env.update(compiler_cache_env)
+                run_kwargs["prepend_path"] = CCACHE_BIN_DIR
+                __salt__["pacman_build.run_cmd"]("ccache --zero-stats", env=compiler_cache_env)
+
+        # Run makepkg, built packages are written to a separate directory so they can be cached
+        cmd = " ".join(makepkg_args)
+        __salt__["pacman_build.run_cmd"](cmd, cwd=builddir, env=env, **run_kwargs)
+
+        package_files = _list_package_files(pkgdest)
+        if not package_files:
+            raise CommandExecutionError(f"'{cmd}' did not produce any packages in {pkgdest}")
 
-                cmd = f"chown -R {build_user}:{build_user} {builddir}"
+        if prepared["incremental"]:
+            with open(signature_path, "w") as f:
+                f.write(source_signature)
+
+            if compiler_cache_env is not None:
                 try:
-                    __salt__["cmd.run"](cmd, raise_err=True)
+                    prepared["details"]["compiler_cache"] = _read_compiler_cache_stats(compiler_cache_env)
                 except CommandExecutionError as e:
-                    raise CommandExecutionError(
-                        f"Failed to set ownership of build directory to {build_user}: {e}"
-                    )
-
-            # Build makepkg command
-            makepkg_args = ["makepkg", "--noconfirm", "--install"]
-            if install_deps:
-                makepkg_args.append("--syncdeps")
-            if not check:
-                makepkg_args.append("--nocheck")
-
-            # Run makepkg
-            cmd = " ".join(makepkg_args)
+                    log.warning("Failed to read ccache statistics for %s: %s", prepared["pkgname"], e)
+
+        return package_files
+
+
+def _install_built(prepared: PreparedBuild, package_files: List[str]) -> Dict[str, Any]:
+    """Install built packages and store them in the package cache.
+
+    Arguments:
+        prepared: Build which produced the packages
+        package_files: Paths of built package archives
+
+    Returns:
+        Result dictionary, see installed()
+    """
+    with timed_phase(prepared["timings"], "install"):
+        try:
+            _install_package_files(_select_package_files(prepared, package_files))
+        except CommandExecutionError as e:
+            return _mk_result(prepared, False, str(e))
+
+        try:
+            if prepared["cache_key"] is not None:
+                _store_cached_packages(prepared["cache_key"], package_files)
+        except OSError as e:
+            log.warning("Failed to store %s in package cache: %s", prepared["pkgname"], e)
+
+    return _mk_result(prepared, True, f"Successfully built and installed {', '.join(prepared['pkgnames'])}")
+
+
+def installed(
+    source: Optional[str] = None,
+    upstream_source: Optional[str] = None,
+    patches: Optional[list] = None,
+    keep_builddir: bool = False,
+    install_deps: bool = True,
+    check: bool = True,
+    incremental: bool = False,
+    build_size_mb: Optional[int] = None,
+    pkgnames: Optional[List[str]] = None,
+    **file_args
+) -> Dict[str, Any]:
+    """Build and install a package from a PKGBUILD file.
+
+    Arguments:
+        source: Path to PKGBUILD file (can be salt:// URI or local path)
+        upstream_source: Package name to fetch from ABS/AUR using yay -G
+        patches: List of patch files (salt:// URIs) to apply to the PKGBUILD
+        keep_builddir: If True, use persistent directory at /var/cache/salt/makepkg/<pkgname>
+        install_deps: Whether makepkg should install missing dependencies
+        check: Whether to run makepkg's check function
+        incremental: If True, implies keep_builddir. Sources are only re-extracted if the PKGBUILD,
+                     its sources or checksums changed, and ccache is used with a per-package cache
+        build_size_mb: Expected size of the build directory, used to decide if a temporary build fits on tmpfs.
+                       If None the size recorded on the package's last build is used
+        pkgnames: For split packages, which of the packages to install. All are installed if None
+        **file_args: File-managed style arguments (template, context, defaults, etc.)
+
+    Returns:
+        Dictionary with keys:
+        - success: Boolean indicating if the operation succeeded
+        - pkgname: The name of the package, the first selected package for split packages
+        - pkgnames: The names of the installed packages
+        - message: Human-readable message about the result
+        - old_version: Version installed before, None if it was not installed
+        - new_version: Version installed after, None if it is not installed
+        - extracted: For incremental builds, if sources were extracted
+        - compiler_cache: For incremental builds, ccache hits, misses and hit_rate
+        - build_location: For temporary build directories, where the build ran (dir, tmpfs,
+                          estimate_mb, reason) and the size it reached (peak_mb)
+        - timings: Seconds spent in each stage which ran (resolve, check, fetch, patch, build, install)
+
+    Raises:
+        SaltInvocationError: If parameters are invalid
+        CommandExecutionError: If makepkg command fails
+    """
+    with contextlib.ExitStack() as stack:
+        result, prepared = _resolve_and_prepare(
+            stack,
+            {},
+            source=source,
+            upstream_source=upstream_source,
+            patches=patches,
+            keep_builddir=keep_builddir,
+            install_deps=install_deps,
+            check=check,
+            incremental=incremental,
+            build_size_mb=build_size_mb,
+            pkgnames=pkgnames,
+            **file_args
+        )
+
+        result = result or _install_cached(prepared)
+        if result is not None:
+            return result
+
+        try:
+            package_files = _build(prepared, _mk_build_user_dir(stack))
+        except CommandExecutionError as e:
+            # Pass through the full error - it already includes command context from pacman_build.run_cmd
+            return _mk_result(prepared, False, str(e))
+
+        return _install_built(prepared, package_files)
+
+
+def _max_parallel_builds() -> int:
+    """Determine how many builds can run at once on this machine.
+
+    Uses the max_parallel_builds minion option if set, otherwise the number of
+    CPU cores, limited by how many builds of build_memory_mb fit in available memory.
+
+    Returns:
+        Number of concurrent builds, at least 1
+    """
+    opts = __opts__.get(OPTS_PARENT_KEY, {})
+    if opts.get(OPTS_MAX_PARALLEL_BUILDS_KEY):
+        return max(1, int(opts[OPTS_MAX_PARALLEL_BUILDS_KEY]))
+
+    workers = os.cpu_count() or 1
+
+    available_bytes = _available_memory_bytes()
+    if available_bytes is not None:
+        build_mb = opts.get(OPTS_BUILD_MEMORY_MB_KEY, DEFAULT_BUILD_MEMORY_MB)
+        workers = min(workers, available_bytes // (build_mb * 1024 * 1024))
+
+    return max(1, workers)
+
+
+def _strip_dep_version(dep: str) -> str:
+    """Remove a version constraint from a dependency.
+
+    Arguments:
+        dep: Dependency like foo>=1.2
+
+    Returns:
+        Name of the dependency
+    """
+    return re.split(r'[<>=]', dep, maxsplit=1)[0]
+
+
+def build_many(builds: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Build and install many packages, running independent builds concurrently.
+
+    The depends, makedepends and checkdepends of each package are read from its .SRCINFO.
+    Packages which depend on another package in the list are built after it is installed.
+    Missing dependencies from the repositories are installed up front in one transaction.
+    Builds run in a pool sized by _max_parallel_builds(), installs are always one at a time
+    because of pacman's database lock.
+
+    Arguments:
+        builds: Arguments of installed() for each package
+
+    Returns:
+        Result of each build, in the same order as builds, see installed()
+    """
+    results: List[Optional[Dict[str, Any]]] = [None] * len(builds)
+
+    with contextlib.ExitStack() as stack:
+        # Prepare every build, skipping packages which are already installed
+        pending: Dict[int, PreparedBuild] = {}
+        for i, build_args in enumerate(builds):
             try:
-                output = __salt__["pacman_build.run_cmd"](cmd, cwd=builddir)
-                return {
-                    "success": True,
-                    "pkgname": pkgname,
-                    "message": f"Successfully built and installed {pkgname}"
-                }
-            except CommandExecutionError as e:
-                # Pass through the full error - it already includes command context from pacman_build.run_cmd
-                return {
+                results[i], prepared = _resolve_and_prepare(stack, {}, **build_args)
+            except Exception as e:
+                if not isinstance(e, (SaltInvocationError, CommandExecutionError)):
+                    log.exception("Failed to prepare build of %s", build_args.get("upstream_source") or build_args.get("source"))
+                results[i] = {
                     "success": False,
-                    "pkgname": pkgname,
-                    "message": str(e)
+                    "pkgname": build_args.get("upstream_source") or build_args.get("source"),
+                    "pkgnames": [],
+                    "message": str(e),
+                    "old_version": None,
+                    "new_version": None,
                 }
+                continue
+
+            results[i] = results[i] or _install_cached(prepared)
+            if results[i] is None:
+                pending[i] = prepared
+
+        # Build dependency graph between pending builds
+        produced_by: Dict[str, int] = {}
+        build_deps: Dict[int, List[str]] = {}
+        for i, prepared in pending.items():
+            try:
+                srcinfo = _get_srcinfo(prepared["download_dir"], prepared["pkgbuild_content"], prepared["patched"])
+            except CommandExecutionError as e:
+                log.warning("Failed to read dependencies of %s, building without them: %s", prepared["pkgname"], e)
+                srcinfo = {}
+
+            for produced in srcinfo.get("pkgname", [prepared["pkgname"]]) + srcinfo.get("provides", []):
+                produced_by.setdefault(_strip_dep_version(produced), i)
+
+            build_deps[i] = [
+                _strip_dep_version(dep)
+                for dep in srcinfo.get("depends", []) + srcinfo.get("makedepends", []) + srcinfo.get("checkdepends", [])
+            ]
+
+        depends_on: Dict[int, set] = {
+            i: set(produced_by[dep] for dep in deps if dep in produced_by and produced_by[dep] != i)
+            for i, deps in build_deps.items()
+        }
+
+        # Install dependencies from outside the list first, so concurrent builds don't need pacman's lock
+        workers = _max_parallel_builds()
+        if any(prepared["install_deps"] for prepared in pending.values()):
+            external_deps = sorted(set(
+                dep
+                for deps in build_deps.values()
+                for dep in deps
+                if dep not in produced_by and not __salt__["pacman_index.is_installed"](dep, provides=True)
+            ))
+
+            if external_deps:
+                cmd = ["pacman", "--sync", "--needed", "--noconfirm", "--asdeps", *external_deps]
+                try:
+                    with trace_span(__opts__, __context__, __salt__, cmd, "makepkg"):
+                        __salt__["cmd.run"](
+                            cmd=cmd,
+                            python_shell=False,
+                            raise_err=True,
+                        )
+                except CommandExecutionError as e:
+                    # Likely an AUR dependency, let each makepkg --syncdeps handle dependencies one build at a time
+                    log.warning("Failed to install build dependencies up front, building serially: %s", e)
+                    workers = 1
+
+        # Run builds as their dependencies are installed
+        remaining = set(pending.keys())
+        succeeded = set()
+        failed = set()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            running: Dict[concurrent.futures.Future, int] = {}
+
+            while remaining or running:
+                # Fail builds whose dependencies failed, until failures stop propagating down dependency chains
+                propagated = True
+                while propagated:
+                    propagated = False
+                    for i in sorted(remaining):
+                        failed_deps = depends_on[i] & failed
+                        if failed_deps:
+                            failed_names = ", ".join(pending[dep]["pkgname"] for dep in sorted(failed_deps))
+                            results[i] = _mk_result(pending[i], False, f"Not built because dependencies failed: {failed_names}")
+                            failed.add(i)
+                            remaining.remove(i)
+                            propagated = True
+
+                for i in sorted(remaining):
+                    if depends_on[i] <= succeeded:
+                        remaining.remove(i)
+                        try:
+                            # Salt's loader dunders are context variables, which threads don't inherit, so each build runs in a copy of this context
+                            running[executor.submit(contextvars.copy_context().run, _build, pending[i], _mk_build_user_dir(stack))] = i
+                        except OSError as e:
+                            results[i] = _mk_result(pending[i], False, f"Failed to create build directory: {e}")
+                            failed.add(i)
+
+                if not running:
+                    if any(depends_on[i] & failed for i in remaining):
+                        # A build failed to start, fail the builds depending on it first
+                        continue
+
+                    # Nothing can start, the remaining builds depend on each other
+                    for i in remaining:
+                        results[i] = _mk_result(pending[i], False, "Not built because of a dependency cycle")
+                    break
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    i = running.pop(future)
+
+                    # Any error only fails its own build, the other builds keep running
+                    try:
+                        results[i] = _install_built(pending[i], future.result())
+                    except CommandExecutionError as e:
+                        results[i] = _mk_result(pending[i], False, str(e))
+                    except Exception as e:
+                        log.exception("Failed to build %s", pending[i]["pkgname"])
+                        results[i] = _mk_result(pending[i], False, f"Failed to build {pending[i]['pkgname']}: {e}")
+
+                    if results[i]["success"]:
+                        succeeded.add(i)
+                    else:
+                        failed.add(i)
+
+    return results
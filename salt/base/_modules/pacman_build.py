@@ -12,16 +12,154 @@ Configure the build user via the Salt minion configuration file:
 pacman:
   nonroot_builder: <USER>
 ```
+
+Sync database refreshes are coordinated so they happen at most once per Salt
+run, and are skipped when the sync databases were refreshed within a time
+window. The time of the last refresh is recorded in
+`/var/cache/salt/pacman_build/last-refresh`. The window (in seconds) and Pacman's database directory can also be
+configured:
+
+```yaml
+pacman:
+  refresh_ttl: 3600
+  db_path: /var/lib/pacman
+```
+
+Commands can be run by a long-lived worker process which runs as the build
+user, instead of by `cmd.run` with `runas`, which starts a new login context
+and shell for every command. The worker receives each command's arguments
+over a pipe and runs it without a shell, in the environment of a login as the
+build user read once when it starts, like `runas` does. Commands which need a
+shell, or `cmd.run` arguments the worker doesn't support, are still run with
+`cmd.run`. So is everything while the worker can't be started, after a
+failure the worker is started again after a delay which doubles with each
+failure in a row:
+
+```yaml
+pacman:
+  build_worker: True
+```
+
+Read-only commands run with `query` are memoized for the Salt run. Each result
+belongs to a scope, which identifies everything the command reads, like a hash
+of the PKGBUILD for `makepkg --printsrcinfo`. So results never go stale, and
+the same command run in different directories with the same inputs shares one
+result. How many commands the memoization avoided is returned by `query_stats`
+and recorded in the command trace.
 """
-from typing import Optional
+from typing import Optional, Dict, List, Any, Tuple
+import atexit
+import concurrent.futures
+import json
 import logging
+import glob
+import os
+import pwd
+import re
+import shlex
+import subprocess
+import sys
+import threading
+import time
 
 from salt.exceptions import CommandExecutionError
+from salt_trace import trace_span
 
 log = logging.getLogger(__name__)
 
 OPTS_PARENT_KEY = "pacman"
 OPTS_BUILD_USER_KEY = "nonroot_builder"
+OPTS_REFRESH_TTL_KEY = "refresh_ttl"
+OPTS_DB_PATH_KEY = "db_path"
+OPTS_BUILD_WORKER_KEY = "build_worker"
+
+DEFAULT_REFRESH_TTL = 3600
+DEFAULT_DB_PATH = "/var/lib/pacman"
+
+# Touched after each successful refresh. The sync databases' own modification times are set to the mirror's Last-Modified time, so can't tell when they were refreshed
+REFRESH_STAMP_PATH = "/var/cache/salt/pacman_build/last-refresh"
+
+CONTEXT_REFRESHED_KEY = "pacman_build.sync_refreshed"
+CONTEXT_QUERIES_KEY = "pacman_build.queries"
+CONTEXT_QUERY_STATS_KEY = "pacman_build.query_stats"
+
+# run_cmd arguments the build worker supports, others are run with cmd.run
+WORKER_RUN_ARGS = ["cwd", "env", "stdin", "prepend_path"]
+
+# Characters which only mean something to a shell, commands containing them are run with cmd.run
+SHELL_SYNTAX_PATTERN = re.compile(r'[|&;<>()$`\\*?~{}\[\]!#\n]')
+
+# Reads one JSON request per line from stdin, runs each in a thread, writes one JSON response per line to stdout
+WORKER_SCRIPT = """
+import json, os, subprocess, sys, threading
+
+write_lock = threading.Lock()
+
+def handle(request):
+    env = dict(os.environ)
+    env.update(request.get("env") or {})
+    if request.get("prepend_path"):
+        env["PATH"] = request["prepend_path"] + os.pathsep + env.get("PATH", "")
+
+    try:
+        proc = subprocess.Popen(
+            request["argv"],
+            cwd=request.get("cwd"),
+            env=env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+    except OSError as e:
+        response = {"id": request["id"], "retcode": None, "output": str(e)}
+    else:
+        def write_stdin():
+            with proc.stdin:
+                proc.stdin.write((request.get("stdin") or "").encode())
+
+        threading.Thread(target=write_stdin).start()
+        output = proc.stdout.read()
+
+        # Reap the command with wait4 to get the resources it and its children used
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+
+        response = {
+            "id": request["id"],
+            "retcode": proc.returncode,
+            "output": output.decode(errors="replace"),
+            "cpu_user": round(usage.ru_utime, 3),
+            "cpu_system": round(usage.ru_stime, 3),
+            "max_rss_kb": usage.ru_maxrss,
+        }
+
+    with write_lock:
+        sys.stdout.write(json.dumps(response) + "\\n")
+        sys.stdout.flush()
+
+for line in sys.stdin:
+    threading.Thread(target=handle, args=(json.loads(line),)).start()
+"""
+
+# Shell run as a login shell to read the build user's login environment, like cmd.run's runas
+WORKER_LOGIN_SHELL = "/bin/bash"
+
+# Prints the environment as NUL separated keys and values
+LOGIN_ENV_SCRIPT = 'import itertools, os, sys; sys.stdout.write("\\0".join(itertools.chain(*os.environ.items())))'
+
+# Seconds before starting a build worker again after it failed, doubled on each failure up to the maximum
+WORKER_RETRY_DELAY = 30
+WORKER_RETRY_MAX_DELAY = 1800
+
+# Build workers of this process, by build user
+_workers: Dict[str, "_BuildWorker"] = {}
+_workers_lock = threading.Lock()
+
+# Failures to start or use a build worker, by build user: number of failures in a row and when to try again
+_worker_failures: Dict[str, Tuple[int, float]] = {}
+
+# Concurrent builds share the query cache
+_queries_lock = threading.Lock()
 
 
 def get_build_user() -> Optional[str]:
@@ -33,11 +171,332 @@ def get_build_user() -> Optional[str]:
     return __opts__.get(OPTS_PARENT_KEY, {}).get(OPTS_BUILD_USER_KEY, None)
 
 
+def get_db_path() -> str:
+    """Get Pacman's database directory from minion configuration.
+
+    Returns:
+        Path of the database directory, Pacman's default if not configured
+    """
+    return __opts__.get(OPTS_PARENT_KEY, {}).get(OPTS_DB_PATH_KEY, DEFAULT_DB_PATH)
+
+
+def sync_dbs_age() -> Optional[float]:
+    """Get how long ago the sync databases were last refreshed by refresh_sync_dbs.
+
+    Returns:
+        Age in seconds of the last refresh, or None if there are no sync databases or
+        they have never been refreshed by refresh_sync_dbs
+    """
+    if not glob.glob(os.path.join(get_db_path(), "sync", "*.db")):
+        return None
+
+    try:
+        return time.time() - os.stat(REFRESH_STAMP_PATH).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def _touch_refresh_stamp() -> None:
+    """Record that the sync databases were just refreshed.
+    """
+    try:
+        os.makedirs(os.path.dirname(REFRESH_STAMP_PATH), exist_ok=True)
+        with open(REFRESH_STAMP_PATH, "w"):
+            pass
+    except OSError as e:
+        log.warning("Failed to write sync database refresh stamp %s: %s", REFRESH_STAMP_PATH, e)
+
+
+def refresh_sync_dbs(force: bool = False) -> bool:
+    """Refresh the sync databases if they have not been refreshed recently.
+
+    Refreshes at most once per Salt run, and not at all if the last refresh was
+    within the configured refresh_ttl. Commands which install from the sync
+    databases should call this instead of passing --refresh themselves.
+
+    Arguments:
+        force: Refresh even if the databases are fresh or were already refreshed this run
+
+    Returns:
+        True if the databases were refreshed, False if the refresh was skipped
+
+    Raises:
+        CommandExecutionError: If the refresh fails
+    """
+    if not force:
+        if __context__.get(CONTEXT_REFRESHED_KEY, False):
+            return False
+
+        ttl = __opts__.get(OPTS_PARENT_KEY, {}).get(OPTS_REFRESH_TTL_KEY, DEFAULT_REFRESH_TTL)
+        age = sync_dbs_age()
+        if age is not None and age < ttl:
+            log.debug("Sync databases refreshed %ds ago, within %ds window, skipping refresh", age, ttl)
+            __context__[CONTEXT_REFRESHED_KEY] = True
+            return False
+
+    # Pacman must be run as root to write the sync databases
+    cmd = "pacman --sync --refresh --noconfirm"
+    try:
+        with trace_span(__opts__, __context__, __salt__, cmd, "pacman_build"):
+            __salt__["cmd.run"](cmd=cmd, raise_err=True)
+    except CommandExecutionError as e:
+        raise CommandExecutionError(f"Failed to refresh sync databases: {e}")
+
+    __context__[CONTEXT_REFRESHED_KEY] = True
+    _touch_refresh_stamp()
+
+    return True
+
+
+def _login_environment(build_user: str) -> Dict[str, str]:
+    """Read the environment of a login shell of the build user, the way cmd.run's runas does.
+
+    So the build user's profile, e.g. changes to PATH or GNUPGHOME, applies to commands run
+    by the build worker like it does to commands run with cmd.run.
+
+    Arguments:
+        build_user: User to log in as
+
+    Returns:
+        Environment variables of the login
+
+    Raises:
+        OSError: If the login fails
+    """
+    try:
+        proc = subprocess.run(
+            ["su", "-s", WORKER_LOGIN_SHELL, "-", build_user, "-c", sys.executable],
+            input=LOGIN_ENV_SCRIPT,
+            capture_output=True,
+            text=True,
+            timeout=60,
+        )
+    except subprocess.TimeoutExpired as e:
+        raise OSError(f"Timed out reading login environment of {build_user}") from e
+
+    if proc.returncode != 0:
+        raise OSError(f"Failed to read login environment of {build_user}: {proc.stderr.strip()}")
+
+    fields = proc.stdout.split("\0")
+    return dict(zip(fields[0::2], fields[1::2]))
+
+
+class _BuildWorker:
+    """Long-lived process running as the build user which runs commands without a shell.
+
+    Requests may be sent from many threads, the worker runs them concurrently.
+    """
+
+    def __init__(self, build_user: str):
+        """Start the worker.
+
+        Arguments:
+            build_user: User to run the worker as
+
+        Raises:
+            OSError: If the worker cannot be started
+            KeyError: If the build user does not exist
+        """
+        pw = pwd.getpwnam(build_user)
+
+        self._proc = subprocess.Popen(
+            [sys.executable, "-c", WORKER_SCRIPT],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=pw.pw_dir if os.path.isdir(pw.pw_dir) else "/",
+            env=_login_environment(build_user),
+            user=pw.pw_uid,
+            group=pw.pw_gid,
+            extra_groups=os.getgrouplist(build_user, pw.pw_gid),
+            text=True,
+        )
+
+        self._write_lock = threading.Lock()
+        self._pending: Dict[int, concurrent.futures.Future] = {}
+        self._next_id = 0
+
+        self._reader = threading.Thread(target=self._read_responses, daemon=True)
+        self._reader.start()
+
+        log.debug("Started build worker %d as %s", self._proc.pid, build_user)
+
+    def _read_responses(self) -> None:
+        """Pass each response from the worker to the request waiting for it, until the worker exits."""
+        for line in self._proc.stdout:
+            response = json.loads(line)
+            future = self._pending.pop(response["id"], None)
+            if future is not None:
+                future.set_result(response)
+
+        for request_id in list(self._pending):
+            self._pending.pop(request_id).set_exception(OSError("Build worker exited"))
+
+    def run(self, argv: List[str], **kwargs) -> Dict[str, Any]:
+        """Run a command in the worker.
+
+        Arguments:
+            argv: Command and arguments
+            **kwargs: Arguments from WORKER_RUN_ARGS
+
+        Returns:
+            Dictionary with keys retcode (None if the command could not be started), output
+            (combined stdout and stderr), and the cpu_user, cpu_system and max_rss_kb used
+            by the command if it ran
+
+        Raises:
+            OSError: If the worker has exited
+        """
+        future = concurrent.futures.Future()
+
+        with self._write_lock:
+            if self._proc.poll() is not None:
+                raise OSError("Build worker exited")
+
+            request_id = self._next_id
+            self._next_id += 1
+            self._pending[request_id] = future
+
+            try:
+                self._proc.stdin.write(json.dumps({"id": request_id, "argv": argv, **kwargs}) + "\n")
+                self._proc.stdin.flush()
+            except (OSError, ValueError) as e:
+                self._pending.pop(request_id, None)
+                raise OSError(f"Failed to send command to build worker: {e}")
+
+        return future.result()
+
+    def close(self) -> None:
+        """Stop the worker once its running commands have finished."""
+        try:
+            self._proc.stdin.close()
+            self._proc.wait()
+        except OSError:
+            pass
+
+
+def _close_workers() -> None:
+    """Stop every build worker of this process."""
+    with _workers_lock:
+        for worker in _workers.values():
+            worker.close()
+        _workers.clear()
+
+
+atexit.register(_close_workers)
+
+
+def _worker_failed(build_user: str) -> float:
+    """Record that the build worker failed, so it is not started again for a while.
+
+    Must be called with _workers_lock held.
+
+    Arguments:
+        build_user: User the worker runs as
+
+    Returns:
+        Seconds until the worker may be started again
+    """
+    failures = _worker_failures.get(build_user, (0, 0.0))[0] + 1
+    delay = min(WORKER_RETRY_DELAY * 2 ** (failures - 1), WORKER_RETRY_MAX_DELAY)
+    _worker_failures[build_user] = (failures, time.monotonic() + delay)
+
+    return delay
+
+
+def _get_worker(build_user: str) -> Optional[_BuildWorker]:
+    """Get the build worker, starting it if it is not running.
+
+    After the worker fails to start or exits it isn't started again until a backoff
+    delay, which doubles with each failure in a row, has passed.
+
+    Arguments:
+        build_user: User the worker runs as
+
+    Returns:
+        The worker, or None if it could not be started or is backing off
+    """
+    with _workers_lock:
+        if build_user in _workers:
+            return _workers[build_user]
+
+        failures, retry_at = _worker_failures.get(build_user, (0, 0.0))
+        if failures > 0 and time.monotonic() < retry_at:
+            return None
+
+        try:
+            _workers[build_user] = _BuildWorker(build_user)
+        except (OSError, KeyError, ValueError) as e:
+            delay = _worker_failed(build_user)
+            log.warning("Failed to start build worker as %s, running commands with cmd.run for %ds: %s", build_user, delay, e)
+            return None
+
+        _worker_failures.pop(build_user, None)
+        return _workers[build_user]
+
+
+def _run_in_worker(build_user: str, cmd: str, kwargs: Dict[str, Any], span: Dict[str, Any]) -> Optional[str]:
+    """Run a command in the build worker if the worker can run it.
+
+    Arguments:
+        build_user: User the worker runs as
+        cmd: Command to run
+        kwargs: Arguments for cmd.run
+        span: Command trace span, filled with the resources the command used
+
+    Returns:
+        Output of the command with trailing whitespace removed, like cmd.run,
+        or None if the command must be run with cmd.run
+
+    Raises:
+        CommandExecutionError: If the command exits with a non-zero exit code
+    """
+    if not __opts__.get(OPTS_PARENT_KEY, {}).get(OPTS_BUILD_WORKER_KEY, False):
+        return None
+    if any(arg not in WORKER_RUN_ARGS for arg in kwargs) or SHELL_SYNTAX_PATTERN.search(cmd):
+        return None
+
+    worker = _get_worker(build_user)
+    if worker is None:
+        return None
+
+    try:
+        argv = shlex.split(cmd)
+        log.debug("Running in build worker: %s", argv)
+        response = worker.run(argv, **kwargs)
+    except ValueError as e:
+        log.debug("Failed to split command '%s', running with cmd.run: %s", cmd, e)
+        return None
+    except OSError as e:
+        with _workers_lock:
+            if _workers.get(build_user) is worker:
+                del _workers[build_user]
+                delay = _worker_failed(build_user)
+                log.warning("Build worker failed, running commands with cmd.run for %ds: %s", delay, e)
+        worker.close()
+        return None
+
+    retcode = response["retcode"]
+    output = response["output"]
+    span.update(
+        retcode=retcode,
+        output_bytes=len(output),
+        **{field: response[field] for field in ["cpu_user", "cpu_system", "max_rss_kb"] if field in response},
+    )
+
+    if retcode is None:
+        raise CommandExecutionError(f"Command '{cmd}' could not be started: {output}")
+    if retcode != 0:
+        raise CommandExecutionError(f"Command '{cmd}' failed with return code: {retcode}\noutput: {output}")
+
+    return output.rstrip()
+
+
 def run_cmd(cmd: str, **kwargs) -> str:
     """Run a command as the configured build user.
 
     This function inspects the minion configuration to determine what user to run
-    the command as, then executes it using cmd.run.
+    the command as, then executes it using the build worker if it is enabled and
+    can run the command, otherwise using cmd.run.
 
     Arguments:
         cmd: Command to run
@@ -61,13 +520,106 @@ def run_cmd(cmd: str, **kwargs) -> str:
     # Figure out if we want to run as a specific user
     build_user = get_build_user()
 
-    if build_user is not None:
-        run_kwargs["runas"] = build_user
-        run_kwargs["group"] = build_user
+    with trace_span(__opts__, __context__, __salt__, cmd, "pacman_build") as span:
+        if build_user is not None:
+            output = _run_in_worker(build_user, cmd, kwargs, span)
+            if output is not None:
+                return output
 
-    # Run command and wrap errors with command context
-    try:
-        return __salt__["cmd.run"](**run_kwargs)
-    except CommandExecutionError as e:
-        # Re-raise with command context if not already included
-        raise CommandExecutionError(f"Command '{cmd}' failed: {e}")
+            run_kwargs["runas"] = build_user
+            run_kwargs["group"] = build_user
+
+        # Run command and wrap errors with command context
+        try:
+            output = __salt__["cmd.run"](**run_kwargs)
+        except CommandExecutionError as e:
+            # Re-raise with command context if not already included
+            raise CommandExecutionError(f"Command '{cmd}' failed: {e}")
+
+        span["output_bytes"] = len(output)
+        return output
+
+
+def _query_stats() -> Dict[str, int]:
+    """Get the run's query statistics, creating them if needed.
+
+    Returns:
+        Mutable statistics, see query_stats()
+    """
+    return __context__.setdefault(CONTEXT_QUERY_STATS_KEY, {"run": 0, "avoided": 0, "invalidated": 0})
+
+
+def query(cmd: str, scope: str, **kwargs) -> str:
+    """Run a read-only command as the build user, memoized for the Salt run.
+
+    Identical commands with identical arguments in the same scope are only run once.
+    The working directory is not part of the key, as the scope identifies the files the
+    command reads from it. Failed commands are not memoized.
+
+    Arguments:
+        cmd: Command to run, must not change anything
+        scope: Value which changes when the command's inputs change, like a hash of the
+               files the command reads
+        **kwargs: Additional keyword arguments to pass to run_cmd
+
+    Returns:
+        String output of command
+
+    Raises:
+        CommandExecutionError: If the command exits with a non-zero exit code
+    """
+    key = json.dumps([scope, cmd, {arg: value for arg, value in kwargs.items() if arg != "cwd"}], sort_keys=True, default=str)
+
+    with _queries_lock:
+        queries = __context__.setdefault(CONTEXT_QUERIES_KEY, {})
+        if key in queries:
+            _query_stats()["avoided"] += 1
+            output = queries[key]
+        else:
+            output = None
+
+    if output is not None:
+        log.debug("Using memoized output of '%s'", cmd)
+        with trace_span(__opts__, __context__, __salt__, cmd, "pacman_build") as span:
+            span.update(cached=True, cpu_user=0.0, cpu_system=0.0, output_bytes=len(output))
+        return output
+
+    output = run_cmd(cmd, **kwargs)
+
+    with _queries_lock:
+        __context__.setdefault(CONTEXT_QUERIES_KEY, {})[key] = output
+        _query_stats()["run"] += 1
+
+    return output
+
+
+def invalidate_queries(scope: Optional[str] = None) -> int:
+    """Forget memoized query results.
+
+    Only needed if a command's inputs changed without changing its scope.
+
+    Arguments:
+        scope: Scope to forget, every scope if None
+
+    Returns:
+        Number of results forgotten
+    """
+    with _queries_lock:
+        queries = __context__.get(CONTEXT_QUERIES_KEY, {})
+        keys = [key for key in queries if scope is None or json.loads(key)[0] == scope]
+        for key in keys:
+            del queries[key]
+
+        _query_stats()["invalidated"] += len(keys)
+
+    return len(keys)
+
+
+def query_stats() -> Dict[str, int]:
+    """Get how well queries were memoized in this Salt run.
+
+    Returns:
+        Dictionary with keys run (commands run by query), avoided (duplicate commands served
+        from memory) and invalidated (results forgotten because something changed)
+    """
+    return dict(_query_stats())
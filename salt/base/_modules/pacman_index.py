@@ -0,0 +1,317 @@
+"""
+Execution module providing an index of installed Pacman packages.
+
+The index is built by reading Pacman's local database directly instead of
+running `pacman --query` for every package. It is loaded lazily once per
+Salt run and shared by every custom module and state through `__context__`.
+The index is reloaded whenever the local database directory's modification
+time changes, which happens each time a package is installed, upgraded or
+removed.
+
+The database location is configured by `pacman_build.get_db_path`.
+"""
+from typing import Optional, Dict, List, Tuple, TypedDict
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+CONTEXT_KEY = "pacman_index.index"
+
+
+class PkgIndex(TypedDict):
+    """Installed packages read from the local database.
+
+    Fields:
+    - mtime_ns: Modification time of the local database directory when the index was read
+    - packages: Maps installed package names to their version
+    - provides: Maps names provided by installed packages to the provided version,
+                or the providing package's version if the provision is unversioned
+    """
+    mtime_ns: int
+    packages: Dict[str, str]
+    provides: Dict[str, str]
+
+
+def _local_db_dir() -> str:
+    """Get the path of Pacman's local database directory.
+
+    Returns:
+        Path to the local database directory
+    """
+    return os.path.join(__salt__["pacman_build.get_db_path"](), "local")
+
+
+def _parse_desc(desc_content: str) -> Dict[str, List[str]]:
+    """Parse a local database desc file.
+
+    Desc files are made up of sections with a %HEADER% line followed by one value per line,
+    separated by blank lines.
+
+    Arguments:
+        desc_content: Content of the desc file
+
+    Returns:
+        Maps section names (without % signs) to their values
+    """
+    sections: Dict[str, List[str]] = {}
+    current: Optional[List[str]] = None
+
+    for line in desc_content.splitlines():
+        line = line.strip()
+        if not line:
+            current = None
+        elif line.startswith("%") and line.endswith("%") and current is None:
+            current = sections.setdefault(line.strip("%"), [])
+        elif current is not None:
+            current.append(line)
+
+    return sections
+
+
+def _load(local_dir: str, mtime_ns: int) -> PkgIndex:
+    """Read every package entry in the local database.
+
+    Arguments:
+        local_dir: Path to the local database directory
+        mtime_ns: Modification time of local_dir to record in the index
+
+    Returns:
+        The index of installed packages
+    """
+    index = PkgIndex(mtime_ns=mtime_ns, packages={}, provides={})
+
+    with os.scandir(local_dir) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+
+            try:
+                with open(os.path.join(entry.path, "desc"), "r") as f:
+                    sections = _parse_desc(f.read())
+            except OSError as e:
+                log.warning("Failed to read local database entry %s: %s", entry.path, e)
+                continue
+
+            if not sections.get("NAME") or not sections.get("VERSION"):
+                continue
+
+            name = sections["NAME"][0]
+            version = sections["VERSION"][0]
+            index["packages"][name] = version
+
+            for provision in sections.get("PROVIDES", []):
+                provided_name, _, provided_version = provision.partition("=")
+                index["provides"][provided_name] = provided_version or version
+
+    log.debug("Loaded %d packages from %s", len(index["packages"]), local_dir)
+
+    return index
+
+
+def get_index() -> PkgIndex:
+    """Get the index of installed packages, reading the local database if it has changed.
+
+    Returns:
+        The index of installed packages
+    """
+    local_dir = _local_db_dir()
+
+    try:
+        mtime_ns = os.stat(local_dir).st_mtime_ns
+    except FileNotFoundError:
+        return PkgIndex(mtime_ns=0, packages={}, provides={})
+
+    index = __context__.get(CONTEXT_KEY)
+    if index is None or index["mtime_ns"] != mtime_ns:
+        index = _load(local_dir, mtime_ns)
+        __context__[CONTEXT_KEY] = index
+
+    return index
+
+
+def invalidate() -> None:
+    """Drop the loaded index so the next lookup re-reads the local database.
+
+    Only needed if the database may have changed within the modification time's resolution.
+    """
+    __context__.pop(CONTEXT_KEY, None)
+
+
+def version(pkgname: str, provides: bool = False) -> Optional[str]:
+    """Get the installed version of a package.
+
+    Arguments:
+        pkgname: Name of the package
+        provides: If True also match names provided by installed packages
+
+    Returns:
+        Installed version, or None if not installed
+    """
+    index = get_index()
+
+    if pkgname in index["packages"]:
+        return index["packages"][pkgname]
+    if provides:
+        return index["provides"].get(pkgname)
+
+    return None
+
+
+def is_installed(pkgname: str, provides: bool = False) -> bool:
+    """Check if a package is installed.
+
+    Arguments:
+        pkgname: Name of the package
+        provides: If True also match names provided by installed packages
+
+    Returns:
+        True if installed, False otherwise
+    """
+    return version(pkgname, provides=provides) is not None
+
+
+def missing(pkgs: List[str], provides: bool = False) -> List[str]:
+    """Find which packages of a list are not installed.
+
+    Arguments:
+        pkgs: Names of packages
+        provides: If True also match names provided by installed packages
+
+    Returns:
+        Packages from pkgs which are not installed, in the same order
+    """
+    return [pkg for pkg in pkgs if not is_installed(pkg, provides=provides)]
+
+
+def _split_version(full_version: str) -> Tuple[str, str, Optional[str]]:
+    """Split a version into its epoch, version and release, as libalpm does.
+
+    Arguments:
+        full_version: Version as [epoch:]pkgver[-pkgrel]
+
+    Returns:
+        Epoch ("0" if not set), version and release (None if not set)
+    """
+    digits_end = 0
+    while digits_end < len(full_version) and full_version[digits_end].isdigit():
+        digits_end += 1
+
+    epoch = "0"
+    rest = full_version
+    if digits_end < len(full_version) and full_version[digits_end] == ":":
+        epoch = full_version[:digits_end] or "0"
+        rest = full_version[digits_end + 1:]
+
+    pkgver, sep, pkgrel = rest.rpartition("-")
+    if not sep:
+        return epoch, rest, None
+
+    return epoch, pkgver, pkgrel
+
+
+def _is_alnum(char: str) -> bool:
+    """Check if a character is an ASCII letter or digit, like C's isalnum.
+    """
+    return char.isascii() and char.isalnum()
+
+
+def _compare_segments(a: str, b: str) -> int:
+    """Compare two version strings segment by segment, a port of libalpm's rpmvercmp.
+
+    Arguments:
+        a: First version string
+        b: Second version string
+
+    Returns:
+        -1 if a is older than b, 0 if equal, 1 if newer
+    """
+    if a == b:
+        return 0
+
+    one = 0
+    two = 0
+    while one < len(a) and two < len(b):
+        start_one = one
+        start_two = two
+
+        # Skip separators
+        while one < len(a) and not _is_alnum(a[one]):
+            one += 1
+        while two < len(b) and not _is_alnum(b[two]):
+            two += 1
+
+        if one >= len(a) or two >= len(b):
+            break
+
+        # Differently sized separators decide the comparison
+        if one - start_one != two - start_two:
+            return -1 if one - start_one < two - start_two else 1
+
+        # Take a numeric or alphabetic segment from each
+        end_one = one
+        end_two = two
+        is_num = a[one].isdigit()
+        if is_num:
+            while end_one < len(a) and a[end_one].isascii() and a[end_one].isdigit():
+                end_one += 1
+            while end_two < len(b) and b[end_two].isascii() and b[end_two].isdigit():
+                end_two += 1
+        else:
+            while end_one < len(a) and a[end_one].isascii() and a[end_one].isalpha():
+                end_one += 1
+            while end_two < len(b) and b[end_two].isascii() and b[end_two].isalpha():
+                end_two += 1
+
+        segment_one = a[one:end_one]
+        segment_two = b[two:end_two]
+
+        # Segments of different types, numbers are newer
+        if not segment_two:
+            return 1 if is_num else -1
+
+        if is_num:
+            segment_one = segment_one.lstrip("0")
+            segment_two = segment_two.lstrip("0")
+            if len(segment_one) != len(segment_two):
+                return 1 if len(segment_one) > len(segment_two) else -1
+
+        if segment_one != segment_two:
+            return 1 if segment_one > segment_two else -1
+
+        one = end_one
+        two = end_two
+
+    if one >= len(a) and two >= len(b):
+        return 0
+
+    # A remaining alphabetic segment (e.g. 1.0alpha) is older, anything else remaining is newer
+    if (one >= len(a) and not (b[two].isascii() and b[two].isalpha())) or (one < len(a) and a[one].isascii() and a[one].isalpha()):
+        return -1
+
+    return 1
+
+
+def vercmp(version_a: str, version_b: str) -> int:
+    """Compare two package versions the way Pacman's vercmp does, without running it.
+
+    Arguments:
+        version_a: Version as [epoch:]pkgver[-pkgrel]
+        version_b: Version as [epoch:]pkgver[-pkgrel]
+
+    Returns:
+        A negative number if version_a is older than version_b, 0 if they are the same, a positive number if newer
+    """
+    if version_a == version_b:
+        return 0
+
+    epoch_a, pkgver_a, pkgrel_a = _split_version(version_a)
+    epoch_b, pkgver_b, pkgrel_b = _split_version(version_b)
+
+    result = _compare_segments(epoch_a, epoch_b)
+    if result == 0:
+        result = _compare_segments(pkgver_a, pkgver_b)
+    if result == 0 and pkgrel_a is not None and pkgrel_b is not None:
+        result = _compare_segments(pkgrel_a, pkgrel_b)
+
+    return result
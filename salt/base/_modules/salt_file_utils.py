@@ -3,15 +3,65 @@ Utility functions for file handling in Salt modules.
 
 This module provides common file operations like retrieving and rendering
 files from salt:// URIs, following Salt's standard patterns.
+
+Rendered files are cached by the hash of the source file, the template engine,
+the function which rendered it and the template variables. Source hashes are
+asked from the file server once per Salt run with `cp.hash_file`, so unchanged
+files are not downloaded or rendered again. Templated files are also keyed by
+the pillar and grains they could read, and are only cached for the rest of the
+run since the files they include or import aren't part of the key. Sources
+without a hash, like http:// URLs, are only cached by their URL for the rest
+of the run.
+
+`get_managed_file_path` writes a file to a path instead of returning its
+contents, so large and binary files are never held in memory as a string.
+
+Configuration
+=============
+The most recently used rendered files are kept in memory for the Salt run.
+Set `cache_dir` to also keep files which aren't templates on disk across runs:
+
+```yaml
+salt_file_utils:
+  cache_size: 64
+  cache_dir: /var/cache/salt/salt_file_utils
+  disk_cache_size: 256
+```
 """
 from typing import Optional, Dict, Any
+from collections import OrderedDict
+import hashlib
+import json
 import logging
+import os
+import shutil
+import tempfile
+import threading
 
 from salt.exceptions import SaltInvocationError
 from salt_types import FileManagedArgs
 
 log = logging.getLogger(__name__)
 
+OPTS_PARENT_KEY = "salt_file_utils"
+OPTS_CACHE_SIZE_KEY = "cache_size"
+OPTS_CACHE_DIR_KEY = "cache_dir"
+OPTS_DISK_CACHE_SIZE_KEY = "disk_cache_size"
+
+DEFAULT_CACHE_SIZE = 64
+DEFAULT_DISK_CACHE_SIZE = 256
+
+CONTEXT_CACHE_KEY = "salt_file_utils.rendered"
+CONTEXT_SOURCE_HASHES_KEY = "salt_file_utils.source_hashes"
+CONTEXT_ENVIRONMENT_HASH_KEY = "salt_file_utils.environment_hash"
+
+# Functions which render templates, cached renders are keyed by the function since they may not render identically
+RENDERER_CONTENT = "slsutil.renderer"
+RENDERER_PATH = "cp.get_template"
+
+# Concurrent builds render files at the same time
+_cache_lock = threading.Lock()
+
 
 def extract_file_managed_args(**kwargs) -> FileManagedArgs:
     """Extract file.managed-style arguments from kwargs.
@@ -41,22 +91,241 @@ def extract_file_managed_args(**kwargs) -> FileManagedArgs:
     return file_args
 
 
+def _source_hash(source: str, saltenv: Optional[str]) -> Optional[str]:
+    """Get the hash of a source file from the file server, once per Salt run.
+
+    Arguments:
+        source: File source (salt://, http://, or local path)
+        saltenv: Salt environment of the source, the minion's default if None
+
+    Returns:
+        Hash type and sum, or None if the source can't be hashed without downloading it
+    """
+    hashes = __context__.setdefault(CONTEXT_SOURCE_HASHES_KEY, {})
+    if (source, saltenv) not in hashes:
+        source_hash = None
+        if not source.startswith(("http://", "https://", "ftp://", "s3://", "swift://")):
+            try:
+                hash_info = __salt__["cp.hash_file"](source, **({"saltenv": saltenv} if saltenv else {}))
+                if hash_info and hash_info.get("hsum"):
+                    source_hash = f"{hash_info['hash_type']}:{hash_info['hsum']}"
+            except Exception as e:
+                log.debug("Failed to hash %s, not caching it across runs: %s", source, e)
+
+        hashes[(source, saltenv)] = source_hash
+
+    return hashes[(source, saltenv)]
+
+
+def _environment_hash() -> str:
+    """Hash the pillar and grains templates can read, once per Salt run.
+
+    Returns:
+        Hash of the pillar and grains
+    """
+    if CONTEXT_ENVIRONMENT_HASH_KEY not in __context__:
+        environment = json.dumps({"pillar": __pillar__, "grains": __grains__}, sort_keys=True, default=str)
+        __context__[CONTEXT_ENVIRONMENT_HASH_KEY] = hashlib.sha256(environment.encode()).hexdigest()
+
+    return __context__[CONTEXT_ENVIRONMENT_HASH_KEY]
+
+
+def _cache_key(
+    source: str,
+    source_hash: Optional[str],
+    saltenv: Optional[str],
+    template: Optional[str],
+    template_vars: Dict[str, Any],
+    renderer: Optional[str],
+) -> str:
+    """Build the cache key of a rendered file.
+
+    Arguments:
+        source: File source, identifies the file if source_hash is None
+        source_hash: Hash of the source file from _source_hash()
+        saltenv: Salt environment of the source
+        template: Template engine, None for raw files
+        template_vars: Merged template variables
+        renderer: Function which renders the template, RENDERER_CONTENT or RENDERER_PATH, None to identify
+            the rendered file whichever function renders it
+
+    Returns:
+        Hex digest identifying the rendered content
+    """
+    parts = {
+        "source": source_hash or source,
+        "saltenv": saltenv,
+        "template": template,
+        "renderer": renderer if template else None,
+        "vars": template_vars if template else None,
+        "environment": _environment_hash() if template else None,
+    }
+
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _disk_cache_dir() -> Optional[str]:
+    """Get the directory rendered files are kept in across runs.
+
+    Returns:
+        Directory path, or None if the disk cache is not configured
+    """
+    return __opts__.get(OPTS_PARENT_KEY, {}).get(OPTS_CACHE_DIR_KEY)
+
+
+def _read_disk_cache(key: str) -> Optional[str]:
+    """Read a rendered file from the disk cache, marking it as recently used.
+
+    Arguments:
+        key: Cache key from _cache_key()
+
+    Returns:
+        Rendered content, or None if not cached on disk
+    """
+    cache_dir = _disk_cache_dir()
+    if not cache_dir:
+        return None
+
+    path = os.path.join(cache_dir, key)
+    try:
+        with open(path, "r") as f:
+            content = f.read()
+        os.utime(path)
+    except OSError:
+        return None
+
+    return content
+
+
+def _write_disk_cache(key: str, content: Optional[str] = None, path: Optional[str] = None) -> None:
+    """Write a rendered file to the disk cache, evicting the least recently used files over the size limit.
+
+    Arguments:
+        key: Cache key from _cache_key()
+        content: Rendered content
+        path: File holding the rendered content, used if content is None
+    """
+    cache_dir = _disk_cache_dir()
+    if not cache_dir:
+        return
+
+    max_entries = __opts__.get(OPTS_PARENT_KEY, {}).get(OPTS_DISK_CACHE_SIZE_KEY, DEFAULT_DISK_CACHE_SIZE)
+
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".tmp-")
+        try:
+            if content is not None:
+                with os.fdopen(fd, "w") as f:
+                    f.write(content)
+            else:
+                os.close(fd)
+                shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, os.path.join(cache_dir, key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        with os.scandir(cache_dir) as entries:
+            cached = [entry for entry in entries if entry.is_file() and not entry.name.startswith(".")]
+
+        cached.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in cached[:max(0, len(cached) - max_entries)]:
+            os.unlink(entry.path)
+    except OSError as e:
+        log.warning("Failed to write rendered file cache in %s: %s", cache_dir, e)
+
+
+def clear_cache(disk: bool = False) -> int:
+    """Forget rendered files.
+
+    Arguments:
+        disk: Also delete the files cached on disk across runs
+
+    Returns:
+        Number of rendered files forgotten
+
+    CLI Example:
+        salt-call --local salt_file_utils.clear_cache disk=True
+    """
+    with _cache_lock:
+        count = len(__context__.pop(CONTEXT_CACHE_KEY, {}))
+        __context__.pop(CONTEXT_SOURCE_HASHES_KEY, None)
+
+        cache_dir = _disk_cache_dir()
+        if disk and cache_dir and os.path.isdir(cache_dir):
+            with os.scandir(cache_dir) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        os.unlink(entry.path)
+                        count += 1
+
+    return count
+
+
+def get_managed_file_key(
+    source: str,
+    template: Optional[str] = None,
+    context: Optional[dict] = None,
+    defaults: Optional[dict] = None,
+    saltenv: Optional[str] = None,
+    **kwargs
+) -> Optional[str]:
+    """Identify the contents of a source, rendered if it is a template, without retrieving or rendering it.
+
+    The key is built like the rendered file cache's, from the source file's hash, the
+    template engine and variables, and the pillar and grains for templates. Like the
+    cache it doesn't cover files a template includes or imports.
+
+    Arguments:
+        source: File source (salt://, http://, or local path)
+        template: Template engine to use (e.g., 'jinja', 'mako'). None for no templating.
+        context: Dictionary of variables to pass to the template
+        defaults: Dictionary of default values for template variables
+        saltenv: Salt environment to get the source from, the minion's default if None
+        **kwargs: Additional arguments
+
+    Returns:
+        Hex digest which changes if the rendered contents change, or None if the source
+        can't be hashed without downloading it, like http:// URLs
+    """
+    if context is None:
+        context = {}
+    if defaults is None:
+        defaults = {}
+
+    # Merge defaults and context
+    template_vars = {}
+    template_vars.update(defaults)
+    template_vars.update(context)
+
+    source_hash = _source_hash(source, saltenv)
+    if source_hash is None:
+        return None
+
+    return _cache_key(source, source_hash, saltenv, template, template_vars, None)
+
+
 def get_managed_file_content(
     source: str,
     template: Optional[str] = None,
     context: Optional[dict] = None,
     defaults: Optional[dict] = None,
+    saltenv: Optional[str] = None,
     **kwargs
 ) -> str:
     """Get file contents from a source, with optional template rendering.
 
     This follows the same pattern as file.managed for the source and template parameters.
+    Results are cached, see the module documentation.
 
     Arguments:
         source: File source (salt://, http://, or local path)
         template: Template engine to use (e.g., 'jinja', 'mako'). None for no templating.
         context: Dictionary of variables to pass to the template
         defaults: Dictionary of default values for template variables
+        saltenv: Salt environment to get the source from, the minion's default if None
         **kwargs: Additional arguments
 
     Returns:
@@ -75,11 +344,58 @@ def get_managed_file_content(
     template_vars.update(defaults)
     template_vars.update(context)
 
+    source_hash = _source_hash(source, saltenv)
+    key = _cache_key(source, source_hash, saltenv, template, template_vars, RENDERER_CONTENT)
+
+    with _cache_lock:
+        cache = __context__.setdefault(CONTEXT_CACHE_KEY, OrderedDict())
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+    # Templates may include files the key doesn't cover, so they are only cached for the run
+    disk_cacheable = source_hash is not None and not template
+    content = _read_disk_cache(key) if disk_cacheable else None
+    if content is None:
+        content = _render(source, template, template_vars, saltenv)
+        if disk_cacheable:
+            _write_disk_cache(key, content)
+    else:
+        log.debug("Using rendered %s from disk cache", source)
+
+    max_entries = __opts__.get(OPTS_PARENT_KEY, {}).get(OPTS_CACHE_SIZE_KEY, DEFAULT_CACHE_SIZE)
+    with _cache_lock:
+        cache = __context__.setdefault(CONTEXT_CACHE_KEY, OrderedDict())
+        cache[key] = content
+        cache.move_to_end(key)
+        while len(cache) > max_entries:
+            cache.popitem(last=False)
+
+    return content
+
+
+def _render(source: str, template: Optional[str], template_vars: Dict[str, Any], saltenv: Optional[str]) -> str:
+    """Retrieve a file and render it if it is a template, without caching.
+
+    Arguments:
+        source: File source (salt://, http://, or local path)
+        template: Template engine to use, None for no templating
+        template_vars: Variables to pass to the template
+        saltenv: Salt environment to get the source from, the minion's default if None
+
+    Returns:
+        The file contents (rendered if template is specified)
+
+    Raises:
+        SaltInvocationError: If the file cannot be retrieved or rendered
+    """
+    env_args = {"saltenv": saltenv} if saltenv else {}
+
     try:
         if template:
             # Use Salt's template rendering
             # First cache the file
-            cached_path = __salt__["cp.cache_file"](source)
+            cached_path = __salt__["cp.cache_file"](source, **env_args)
             if not cached_path:
                 raise SaltInvocationError(f"Failed to cache file: {source}")
 
@@ -92,9 +408,124 @@ def get_managed_file_content(
             return rendered
         else:
             # Get raw file contents
-            content = __salt__["cp.get_file_str"](source)
+            content = __salt__["cp.get_file_str"](source, **env_args)
             if content is False:
                 raise SaltInvocationError(f"Failed to retrieve file: {source}")
             return content
     except Exception as e:
         raise SaltInvocationError(f"Error retrieving/rendering {source}: {e}")
+
+
+def get_managed_file_path(
+    source: str,
+    dest: str,
+    template: Optional[str] = None,
+    context: Optional[dict] = None,
+    defaults: Optional[dict] = None,
+    saltenv: Optional[str] = None,
+    **kwargs
+) -> str:
+    """Write file contents from a source to a path, with optional template rendering.
+
+    Like get_managed_file_content but the contents are not returned. Raw files are
+    copied from the minion's file cache and templates are rendered straight to dest
+    with cp.get_template, so large and binary files are never read into memory.
+    Files which aren't templates are written from the rendered file cache if they are in it.
+
+    Arguments:
+        source: File source (salt://, http://, or local path)
+        dest: Path to write the file to, overwritten if it exists
+        template: Template engine to use (e.g., 'jinja', 'mako'). None for no templating.
+        context: Dictionary of variables to pass to the template
+        defaults: Dictionary of default values for template variables
+        saltenv: Salt environment to get the source from, the minion's default if None
+        **kwargs: Additional arguments
+
+    Returns:
+        dest
+
+    Raises:
+        SaltInvocationError: If the file cannot be retrieved or rendered
+    """
+    if context is None:
+        context = {}
+    if defaults is None:
+        defaults = {}
+
+    # Merge defaults and context
+    template_vars = {}
+    template_vars.update(defaults)
+    template_vars.update(context)
+
+    source_hash = _source_hash(source, saltenv)
+    key = _cache_key(source, source_hash, saltenv, template, template_vars, RENDERER_PATH)
+
+    with _cache_lock:
+        cache = __context__.setdefault(CONTEXT_CACHE_KEY, OrderedDict())
+        content = cache.get(key)
+        if content is not None:
+            cache.move_to_end(key)
+
+    if content is not None:
+        with open(dest, "w") as f:
+            f.write(content)
+        return dest
+
+    # Templates may include files the key doesn't cover, so they are not cached on disk
+    cache_dir = _disk_cache_dir()
+    disk_path = os.path.join(cache_dir, key) if cache_dir and source_hash and not template else None
+    if disk_path is not None and os.path.isfile(disk_path):
+        log.debug("Using rendered %s from disk cache", source)
+        try:
+            shutil.copyfile(disk_path, dest)
+            os.utime(disk_path)
+            return dest
+        except OSError as e:
+            log.warning("Failed to copy %s from disk cache: %s", source, e)
+
+    _render_to_file(source, dest, template, template_vars, saltenv)
+    if disk_path is not None:
+        _write_disk_cache(key, path=dest)
+
+    return dest
+
+
+def _render_to_file(
+    source: str,
+    dest: str,
+    template: Optional[str],
+    template_vars: Dict[str, Any],
+    saltenv: Optional[str],
+) -> None:
+    """Retrieve a file and render it if it is a template straight to a path, without caching.
+
+    Arguments:
+        source: File source (salt://, http://, or local path)
+        dest: Path to write the file to
+        template: Template engine to use, None for no templating
+        template_vars: Variables to pass to the template
+        saltenv: Salt environment to get the source from, the minion's default if None
+
+    Raises:
+        SaltInvocationError: If the file cannot be retrieved or rendered
+    """
+    env_args = {"saltenv": saltenv} if saltenv else {}
+
+    try:
+        if template:
+            rendered_path = __salt__["cp.get_template"](
+                source,
+                dest,
+                template=template,
+                **env_args,
+                **template_vars
+            )
+            if not rendered_path:
+                raise SaltInvocationError(f"Failed to render file: {source}")
+        else:
+            cached_path = __salt__["cp.cache_file"](source, **env_args)
+            if not cached_path:
+                raise SaltInvocationError(f"Failed to cache file: {source}")
+            shutil.copyfile(cached_path, dest)
+    except Exception as e:
+        raise SaltInvocationError(f"Error retrieving/rendering {source}: {e}")
@@ -6,9 +6,14 @@ This module provides declarative state management for AppImages.
 
 import os
 import re
-from typing import Optional, Dict, Any, List, Union
+import concurrent.futures
+import contextvars
+from typing import Optional, Dict, Any, List, Union, Tuple
 from urllib.parse import urlparse
 
+from salt_phases import timed_phase, merge_phases
+from salt_trace import traced_state
+
 
 def _extract_name_from_source(source: str) -> str:
     """
@@ -31,6 +36,39 @@ def _extract_name_from_source(source: str) -> str:
     return name
 
 
+def _check_single(
+    name: str,
+    target_dir: str = "/usr/local/bin",
+    checksum: Optional[str] = None,
+    checksum_type: str = "sha256",
+    **kwargs
+) -> Tuple[bool, Dict[str, float]]:
+    """
+    Check if an AppImage is installed, with the expected checksum if one is given.
+
+    :param name: The name of the AppImage
+    :type name: str
+    :param target_dir: Directory where the AppImage is installed
+    :type target_dir: str
+    :param checksum: Optional checksum the installed file must have
+    :type checksum: str or None
+    :param checksum_type: Type of checksum
+    :type checksum_type: str
+    :return: If the AppImage is installed, and the phases of the check
+    :rtype: tuple
+    """
+    phases = {}
+    with timed_phase(phases, "check"):
+        is_installed = __salt__["appimage.is_installed"](
+            name,
+            target_dir=target_dir,
+            checksum=checksum,
+            checksum_type=checksum_type,
+        )
+
+    return is_installed, phases
+
+
 def _install_single(
     name: str,
     source: str,
@@ -38,6 +76,8 @@ def _install_single(
     checksum: Optional[str] = None,
     checksum_type: str = "sha256",
     force: bool = False,
+    download: Optional[Dict[str, Any]] = None,
+    checked: Optional[Tuple[bool, Dict[str, float]]] = None,
 ) -> Dict[str, Any]:
     """
     Install a single AppImage.
@@ -54,18 +94,28 @@ def _install_single(
     :type checksum_type: str
     :param force: Force download even if file exists
     :type force: bool
-    :return: Salt state result dictionary
+    :param download: Result of appimage.download_many for the source, the source is downloaded
+                     by appimage.installed if None
+    :type download: dict or None
+    :param checked: Result of _check_single for the AppImage, checked if None
+    :type checked: tuple or None
+    :return: Salt state result dictionary, with the phases of appimage.installed
     :rtype: dict
     """
+    phases = {}
     ret = {
         "name": name,
         "result": True,
         "changes": {},
         "comment": "",
+        "phases": phases,
     }
 
     # Check if already installed
-    is_installed = __salt__["appimage.is_installed"](name, target_dir=target_dir)
+    if checked is None:
+        checked = _check_single(name, target_dir=target_dir, checksum=checksum, checksum_type=checksum_type)
+    is_installed, check_phases = checked
+    merge_phases(phases, check_phases)
 
     if is_installed and not force:
         ret["comment"] = f"AppImage {name} is already installed"
@@ -85,6 +135,13 @@ def _install_single(
         }
         return ret
 
+    if download is not None:
+        merge_phases(phases, download["phases"])
+        if download["error"] is not None:
+            ret["result"] = False
+            ret["comment"] = f"Failed to install AppImage {name}: Failed to download AppImage from {source}: {download['error']}"
+            return ret
+
     # Install the AppImage
     try:
         install_result = __salt__["appimage.installed"](
@@ -94,7 +151,10 @@ def _install_single(
             checksum=checksum,
             checksum_type=checksum_type,
             force=force,
+            downloaded_path=download["path"] if download is not None else None,
+            downloaded_sha256=download["sha256"] if download is not None else None,
         )
+        merge_phases(phases, install_result.get("phases", {}))
 
         if install_result["result"]:
             ret["changes"] = install_result["changes"]
@@ -110,6 +170,7 @@ def _install_single(
     return ret
 
 
+@traced_state
 def installed(
     name: str,
     source: Optional[str] = None,
@@ -132,15 +193,20 @@ def installed(
     :type source: str or None
     :param target_dir: Directory where the AppImage will be installed
     :type target_dir: str
-    :param checksum: Optional checksum to verify the download
+    :param checksum: Optional checksum to verify the download. An installed AppImage with a
+                     different checksum is reinstalled
     :type checksum: str or None
     :param checksum_type: Type of checksum
     :type checksum_type: str
     :param force: Force download even if file exists
     :type force: bool
-    :param pkgs: List of package definitions for installing multiple AppImages
+    :param pkgs: List of package definitions for installing multiple AppImages. Their
+                 downloads run concurrently, see appimage.download_many, then they are
+                 installed one at a time in the order listed
     :type pkgs: list of dict or None
-    :return: Salt state result dictionary
+    :return: Salt state result dictionary. Its phases are the seconds spent checking the
+             installed file, downloading, hashing and copying, summed over every package.
+             Concurrent downloads overlap, so their sum can exceed the state's duration
     :rtype: dict
 
     Example (single package):
@@ -172,6 +238,8 @@ def installed(
         results = []
         all_changes = {}
         all_comments = []
+        all_phases = {}
+        pkg_args = []
 
         for pkg_def in pkgs:
             if not isinstance(pkg_def, dict):
@@ -190,26 +258,52 @@ def installed(
                     "comment": "Package definition must include 'source' field",
                 }
 
-            pkg_source = pkg_def["source"]
-            pkg_name = pkg_def.get("name") or _extract_name_from_source(pkg_source)
-            pkg_target_dir = pkg_def.get("target_dir", target_dir)
-            pkg_checksum = pkg_def.get("checksum")
-            pkg_checksum_type = pkg_def.get("checksum_type", checksum_type)
-            pkg_force = pkg_def.get("force", force)
-
-            result = _install_single(
-                name=pkg_name,
-                source=pkg_source,
-                target_dir=pkg_target_dir,
-                checksum=pkg_checksum,
-                checksum_type=pkg_checksum_type,
-                force=pkg_force,
-            )
+            pkg_args.append({
+                "name": pkg_def.get("name") or _extract_name_from_source(pkg_def["source"]),
+                "source": pkg_def["source"],
+                "target_dir": pkg_def.get("target_dir", target_dir),
+                "checksum": pkg_def.get("checksum"),
+                "checksum_type": pkg_def.get("checksum_type", checksum_type),
+                "force": pkg_def.get("force", force),
+            })
+
+        # Check every AppImage concurrently, installed files are only hashed if they changed
+        checks = []
+        if pkg_args:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(pkg_args), os.cpu_count() or 1)) as executor:
+                # Salt's loader dunders are context variables, which threads don't inherit, so each check runs in a copy of this context
+                futures = [executor.submit(contextvars.copy_context().run, _check_single, **args) for args in pkg_args]
+                checks = [future.result() for future in futures]
+
+        # Download everything which will be installed up front, concurrently
+        downloads = {}
+        if not __opts__["test"]:
+            to_download = [
+                i
+                for i, args in enumerate(pkg_args)
+                if args["force"] or not checks[i][0]
+            ]
+            download_results = __salt__["appimage.download_many"]([
+                {
+                    "source": pkg_args[i]["source"],
+                    "checksum": pkg_args[i]["checksum"],
+                    "checksum_type": pkg_args[i]["checksum_type"],
+                }
+                for i in to_download
+            ])
+            downloads = dict(zip(to_download, download_results))
+
+        for i, args in enumerate(pkg_args):
+            result = _install_single(download=downloads.get(i), checked=checks[i], **args)
 
             results.append(result)
+            merge_phases(all_phases, result["phases"])
             if result["changes"]:
-                all_changes[pkg_name] = result["changes"]
-            all_comments.append(f"{pkg_name}: {result['comment']}")
+                all_changes[args["name"]] = result["changes"]
+            all_comments.append(f"{args['name']}: {result['comment']}")
+
+        if downloads:
+            __salt__["appimage.clean_downloads"]()
 
         # Aggregate results
         all_succeeded = all(r["result"] for r in results)
@@ -220,6 +314,7 @@ def installed(
             "result": False if any_failed else (None if any(r["result"] is None for r in results) else True),
             "changes": all_changes,
             "comment": "\n".join(all_comments),
+            "phases": all_phases,
         }
 
     # Handle single package
@@ -241,6 +336,7 @@ def installed(
     )
 
 
+@traced_state
 def removed(name: str, target_dir: str = "/usr/local/bin") -> Dict[str, Any]:
     """
     Ensure an AppImage is removed.
@@ -267,8 +363,8 @@ def removed(name: str, target_dir: str = "/usr/local/bin") -> Dict[str, Any]:
         "comment": "",
     }
 
-    # Check if installed
-    is_installed = __salt__["appimage.is_installed"](name, target_dir=target_dir)
+    # Check if installed, a version store link whose version was garbage collected is still removed
+    is_installed = os.path.lexists(os.path.join(target_dir, name))
 
     if not is_installed:
         ret["comment"] = f"AppImage {name} is not installed"
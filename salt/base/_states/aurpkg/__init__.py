@@ -15,40 +15,53 @@ pacman:
   nonroot_builder: <USER>
 ```
 """
-from typing import Optional, List
+from typing import Optional, List, Dict
 import logging
 
 from salt.exceptions import CommandExecutionError
 from salt_types import SaltStateRes, SaltStateResChanges
+from salt_phases import timed_phase
+from salt_trace import traced_state
 
 log = logging.getLogger(__name__)
     
 
-def _installed(name: str, pkgs: List[str]) -> SaltStateRes:
+def _installed(name: str, pkgs: List[str], phases: Dict[str, float]) -> SaltStateRes:
     """ Ensure packages are installed. Actual business logic behind installed state.
     Arguments:
     - name: ID of state block
-    - pkgs: Packages to install
+    - pkgs: Packages to install, should only contain packages which are not yet installed
+    - phases: Timings of the state's phases, the refresh and install phases are added
 
-    Returns: Install result
+    Returns: Install result, with changes keyed by package name
     """
     pkgs_space_sep_str = " ".join(pkgs)
 
     res = SaltStateRes(
-            name=name,
+        name=name,
         result=True,
-        changes=SaltStateResChanges(
-            old=f"not all of {pkgs} installed",
-            new=f"{pkgs} installed",
-        ),
-        comment="",
+        changes={},
+        comment=f"installed {', '.join(pkgs)}",
+        phases=phases,
     )
 
     try:
-        __salt__["pacman_build.run_cmd"](f"yay --sync --refresh --noconfirm {pkgs_space_sep_str}")
-    except CommandExecutionError:
+        with timed_phase(phases, "refresh"):
+            __salt__["pacman_build.refresh_sync_dbs"]()
+        with timed_phase(phases, "install"):
+            __salt__["pacman_build.run_cmd"](f"yay --sync --noconfirm {pkgs_space_sep_str}")
+    except CommandExecutionError as e:
         res["result"] = False
-        res["changes"]["new"] = f"{pkgs} failed to installed"
+        res["comment"] = f"failed to install {', '.join(pkgs)}: {e}"
+
+    # Report what actually got installed, a failed transaction may have installed some packages
+    for pkg in pkgs:
+        new_version = __salt__["pacman_index.version"](pkg)
+        if new_version is not None:
+            res["changes"][pkg] = SaltStateResChanges(
+                old="",
+                new=new_version,
+            )
 
     return res
 
@@ -60,16 +73,11 @@ def _check_installed(name: str, pkgs: List[str]) -> SaltStateRes:
 
     Returns: Check result
     """
-    pkgs_space_sep_str = " ".join(pkgs)
-    is_installed = True
-
-    try:
-        __salt__["pacman_build.run_cmd"](f"yay --query --info {pkgs_space_sep_str}")
-    except CommandExecutionError:
-        is_installed = False
+    missing_pkgs = __salt__["pacman_index.missing"](pkgs, provides=True)
+    is_installed = len(missing_pkgs) == 0
 
     pkgs_str = ", ".join(pkgs)
-    installed_comment = f"{pkgs_str} installed" if is_installed else f"{pkgs_str} not installed",
+    installed_comment = f"{pkgs_str} installed" if is_installed else f"{', '.join(missing_pkgs)} not installed"
 
     return SaltStateRes(
         name=name,
@@ -93,43 +101,49 @@ def check_installed(name: str, pkgs: Optional[List[str]]=None) -> SaltStateRes:
     return _check_installed(name=name, pkgs=pkgs if pkgs is not None else [name])
 
 
+@traced_state
 def installed(name: str, pkgs: Optional[List[str]]=None) -> SaltStateRes:
     """ Ensures AUR packages are installed.
+
+    Only packages which are not already installed, or provided by an installed package, are passed to Yay.
+
     Arguments:
     - name: Either package to install or just name of state if pkgs is set
     - pkgs: If set then this is used as a list of packages to install over name
 
-    Returns: Install result
+    Returns: Install result, changes are keyed by the name of each package installed. Phases are check, refresh (of the sync databases) and install
     """
-    # Check if already installed
-    pkgs_str = ", ".join(pkgs) if pkgs is not None else name
-    check_res = check_installed(name=name, pkgs=pkgs)
-    
-    # Check if in test mode
-    if __opts__["test"]:
-        res = SaltStateRes(
-            name=name,
-            result=None,
-            changes=SaltStateResChanges(
-                old=f"{pkgs_str} not installed",
-                new=f"{pkgs_str} installed",
-            ),
-            comment=f"would have installed {pkgs_str}",
-        )
-            
-        if check_res["result"]:
-            res["result"] = True
-            res["changes"] = {}
-            res["comment"] = f"{pkgs_str} already installed"
+    pkgs_list = pkgs if pkgs is not None else [name]
+    pkgs_str = ", ".join(pkgs_list)
 
-        return res
+    # Find which packages still need installing
+    phases: Dict[str, float] = {}
+    with timed_phase(phases, "check"):
+        missing_pkgs = __salt__["pacman_index.missing"](pkgs_list, provides=True)
 
-    if check_res["result"] is True:
+    if len(missing_pkgs) == 0:
         return SaltStateRes(
             name=name,
             result=True,
             changes={},
             comment=f"already installed {pkgs_str}",
+            phases=phases,
+        )
+    
+    # Check if in test mode
+    if __opts__["test"]:
+        return SaltStateRes(
+            name=name,
+            result=None,
+            changes={
+                pkg: SaltStateResChanges(
+                    old="",
+                    new="installed",
+                )
+                for pkg in missing_pkgs
+            },
+            comment=f"would have installed {', '.join(missing_pkgs)}",
+            phases=phases,
         )
 
-    return _installed(name=name, pkgs=pkgs if pkgs is not None else [name])
+    return _installed(name=name, pkgs=missing_pkgs, phases=phases)
@@ -3,13 +3,219 @@ Salt state module for building and installing Arch Linux packages with makepkg.
 
 This state module provides the `installed` state for building packages from PKGBUILD files.
 """
-from typing import Optional, Dict, Any, Union
+from typing import Optional, Dict, Any, List
 import logging
-from salt_types import SaltStateRes, SaltStateResChanges
+from salt_types import SaltStateRes, SaltStateResChanges, FileManagedArgs
+from salt_phases import timed_phase
+from salt_trace import traced_state
+from salt_lowstate import thaw, chunk_key, following_chunks
 
 log = logging.getLogger(__name__)
 
+OPTS_PARENT_KEY = "makepkg"
+OPTS_PARALLEL_BUILDS_KEY = "parallel_builds"
 
+# State arguments passed through to makepkg.build_many
+BUILD_ARGS = [
+    "source",
+    "upstream_source",
+    "patches",
+    "keep_builddir",
+    "install_deps",
+    "check",
+    "incremental",
+    "build_size_mb",
+    "pkgnames",
+]
+BUILD_ARGS += [arg for arg in FileManagedArgs.__annotations__ if arg not in BUILD_ARGS]
+
+CONTEXT_RESULTS_KEY = "makepkg.parallel_results"
+
+
+def _result_to_state_res(name: str, pkgname: str, result: Dict[str, Any]) -> SaltStateRes:
+    """Convert the result of the makepkg execution module into a state result.
+
+    Arguments:
+        name: Name of the state
+        pkgname: Name of the package
+        result: Result from makepkg.installed or makepkg.build_many
+
+    Returns:
+        Salt state result dictionary
+    """
+    # The execution module knows the package names for sure
+    if result.get("pkgnames"):
+        pkgname = ", ".join(result["pkgnames"])
+
+    if result["success"]:
+        message = result["message"]
+
+        # Check if package was already installed (no changes)
+        if "already installed" in message:
+            return SaltStateRes(
+                name=name,
+                result=True,
+                changes={},
+                comment=message,
+            )
+
+        # Package was built and installed
+        old_version = result.get("old_version")
+        new_version = result.get("new_version")
+
+        compiler_cache = result.get("compiler_cache")
+        if compiler_cache and compiler_cache["hit_rate"] is not None:
+            message += f" (compiler cache hit rate {compiler_cache['hit_rate']}%, {compiler_cache['hits']} hits, {compiler_cache['misses']} misses)"
+        build_location = result.get("build_location")
+        if build_location:
+            message += f" (built on {'tmpfs' if build_location['tmpfs'] else 'disk'} in {build_location['dir']}: {build_location['reason']})"
+        if result.get("extracted") is False:
+            message += " (sources not re-extracted)"
+
+        return SaltStateRes(
+            name=name,
+            result=True,
+            changes=SaltStateResChanges(
+                old=f"{pkgname} {old_version} installed" if old_version else f"{pkgname} not installed",
+                new=f"{pkgname} {new_version} installed" if new_version else f"{pkgname} installed"
+            ),
+            comment=message,
+        )
+    else:
+        # Build/install failed
+        return SaltStateRes(
+            name=name,
+            result=False,
+            changes={},
+            comment=result["message"],
+        )
+
+
+def _parallel_enabled(parallel: Optional[bool]) -> bool:
+    """Determine if builds should be scheduled together with other makepkg states.
+
+    Arguments:
+        parallel: Value from state arguments, None to use the minion configuration
+
+    Returns:
+        True if builds should run in parallel
+    """
+    if parallel is not None:
+        return bool(parallel)
+
+    return bool(__opts__.get(OPTS_PARENT_KEY, {}).get(OPTS_PARALLEL_BUILDS_KEY, False))
+
+
+def _run_parallel_builds() -> None:
+    """Build the current state's package together with the makepkg states which can be built now.
+
+    See salt_lowstate.following_chunks for which states are built together. Results are
+    stored in the run's context for when each state's turn comes.
+    """
+    results = __context__.setdefault(CONTEXT_RESULTS_KEY, {})
+    chunks = following_chunks(__low__, __lowstate__, lambda chunk: _parallel_enabled(chunk.get("parallel")))
+    chunks = [chunks[0]] + [chunk for chunk in chunks[1:] if chunk_key(chunk) not in results]
+
+    builds = [
+        {arg: thaw(chunk[arg]) for arg in BUILD_ARGS if arg in chunk}
+        for chunk in chunks
+    ]
+
+    log.info("Building %d makepkg states in parallel", len(builds))
+    for chunk, result in zip(chunks, __salt__["makepkg.build_many"](builds)):
+        results[chunk_key(chunk)] = result
+
+
+def _test_installed(
+    name: str,
+    source: Optional[str],
+    upstream_source: Optional[str],
+    patches: Optional[list],
+    pkgnames: Optional[List[str]],
+    **file_args
+) -> SaltStateRes:
+    """Report what installed() would do, without downloading or building.
+
+    Arguments:
+        See installed()
+
+    Returns:
+        Salt state result dictionary
+    """
+    # Package names and version recorded by an earlier build or parsed from the PKGBUILD
+    metadata = __salt__["makepkg.resolve"](
+        source=source,
+        upstream_source=upstream_source,
+        patches=patches,
+        pkgnames=pkgnames,
+        **file_args
+    )
+
+    pkgbuild_version = None
+    if metadata is not None:
+        state_pkgnames = metadata["pkgnames"]
+        pkgbuild_version = metadata["version"]
+    elif pkgnames:
+        state_pkgnames = pkgnames
+    elif upstream_source:
+        state_pkgnames = [upstream_source]
+    else:
+        try:
+            state_pkgnames = __salt__["makepkg.get_pkgnames"](
+                source=source,
+                **file_args
+            )
+
+            if not state_pkgnames:
+                return SaltStateRes(
+                    name=name,
+                    result=False,
+                    changes={},
+                    comment=f"Could not parse package name from PKGBUILD at {source}",
+                )
+        except Exception as e:
+            return SaltStateRes(
+                name=name,
+                result=False,
+                changes={},
+                comment=f"Error retrieving PKGBUILD from {source}: {e}",
+            )
+    pkgname = ", ".join(state_pkgnames)
+
+    # Check if packages are already installed, and at what version
+    installed_version = __salt__["pacman_index.version"](state_pkgnames[0])
+    is_installed = len(__salt__["pacman_index.missing"](state_pkgnames)) == 0
+
+    if is_installed and (pkgbuild_version is None or __salt__["pacman_index.vercmp"](installed_version, pkgbuild_version) >= 0):
+        return SaltStateRes(
+            name=name,
+            result=True,
+            changes={},
+            comment=f"Package {pkgname} is already installed",
+        )
+    elif is_installed:
+        return SaltStateRes(
+            name=name,
+            result=None,
+            changes=SaltStateResChanges(
+                old=f"{pkgname} {installed_version} installed",
+                new=f"{pkgname} {pkgbuild_version} installed"
+            ),
+            comment=f"Would rebuild {pkgname} {pkgbuild_version} from {upstream_source or source}",
+        )
+    else:
+        return SaltStateRes(
+            name=name,
+            result=None,
+            changes=SaltStateResChanges(
+                old=f"{pkgname} not installed",
+                new=f"{pkgname} installed"
+            ),
+            comment=f"Would build and install {pkgname} from {upstream_source or source}",
+        )
+
+
+@traced_state
 def installed(
     name: str,
     source: Optional[str] = None,
@@ -18,6 +224,10 @@ def installed(
     keep_builddir: bool = False,
     install_deps: bool = True,
     check: bool = True,
+    incremental: bool = False,
+    build_size_mb: Optional[int] = None,
+    pkgnames: Optional[List[str]] = None,
+    parallel: Optional[bool] = None,
     **file_args
 ) -> SaltStateRes:
     """Build and install a package from a PKGBUILD file.
@@ -30,10 +240,17 @@ def installed(
         keep_builddir: If True, use persistent directory at /var/cache/salt/makepkg/<pkgname>
         install_deps: Whether makepkg should install missing dependencies
         check: Whether to run makepkg's check function
-        **file_args: File-managed style arguments (template, context, defaults, etc.)
+        incremental: If True, implies keep_builddir. Unchanged sources are not re-extracted and ccache is used with a per-package cache
+        build_size_mb: Expected size of the build directory in MB, decides if a temporary build fits on tmpfs. Defaults to the size recorded on the last build
+        pkgnames: For PKGBUILDs which build split packages, which of the packages to install. Defaults to all of them
+        parallel: If True the package is built together with the makepkg states which directly follow this one in the run and can be built at the same time, see makepkg.build_many. If None the makepkg:parallel_builds minion configuration value is used
+        **file_args: File-managed style arguments (template, context, defaults and saltenv), others are rejected
 
     Returns:
-        Salt state result dictionary
+        Salt state result dictionary. Its phases are the seconds spent in each stage of the
+        build which ran: resolve, check, fetch, patch, build (including makepkg --syncdeps)
+        and install. Its duplicates_avoided is the number of memoized pacman_build queries
+        used, for parallel builds counted by the state which ran them
 
     Example:
         .. code-block:: yaml
@@ -51,6 +268,14 @@ def installed(
                     version: 1.2.3
                 - install_deps: True
                 - check: True
+
+            # Installing some of a PKGBUILD's split packages
+            my-split-package:
+              makepkg.installed:
+                - upstream_source: my-split-package
+                - pkgnames:
+                    - my-split-package
+                    - my-split-package-docs
     """
     # Validate that exactly one of source or upstream_source is provided
     if source and upstream_source:
@@ -69,98 +294,58 @@ def installed(
             comment="Must specify either 'source' or 'upstream_source'",
         )
 
-    # Get package name from PKGBUILD (for test mode and validation)
-    # For upstream_source, we'll use the package name directly
-    if upstream_source:
-        pkgname = upstream_source
-    else:
-        try:
-            pkgname = __salt__["makepkg.get_pkgname"](
-                source=source,
-                **file_args
-            )
-
-            if not pkgname:
-                return SaltStateRes(
-                    name=name,
-                    result=False,
-                    changes={},
-                    comment=f"Could not parse package name from PKGBUILD at {source}",
-                )
-        except Exception as e:
-            return SaltStateRes(
-                name=name,
-                result=False,
-                changes={},
-                comment=f"Error retrieving PKGBUILD from {source}: {e}",
-            )
+    # Salt's own keywords start with __
+    unknown_args = [arg for arg in file_args if arg not in FileManagedArgs.__annotations__ and not arg.startswith("__")]
+    if unknown_args:
+        return SaltStateRes(
+            name=name,
+            result=False,
+            changes={},
+            comment=f"Unknown arguments: {', '.join(sorted(unknown_args))}, file-managed style arguments must be one of: {', '.join(FileManagedArgs.__annotations__)}",
+        )
 
-    # Check if package is already installed
-    is_installed = __salt__["makepkg.is_installed"](pkgname)
+    # Generated .SRCINFOs are memoized, so builds of the same PKGBUILD only run makepkg --printsrcinfo once
+    avoided = __salt__["pacman_build.query_stats"]()["avoided"]
 
     # Check if in test mode
     if __opts__["test"]:
-        if is_installed:
-            return SaltStateRes(
-                name=name,
-                result=True,
-                changes={},
-                comment=f"Package {pkgname} is already installed",
-            )
-        else:
-            return SaltStateRes(
-                name=name,
-                result=None,
-                changes=SaltStateResChanges(
-                    old=f"{pkgname} not installed",
-                    new=f"{pkgname} installed"
-                ),
-                comment=f"Would build and install {pkgname} from {source}",
-            )
+        phases = {}
+        with timed_phase(phases, "resolve"):
+            res = _test_installed(name, source, upstream_source, patches, pkgnames, **file_args)
 
-    # Call the execution module
-    try:
-        result = __salt__["makepkg.installed"](
-            source=source,
-            upstream_source=upstream_source,
-            patches=patches,
-            keep_builddir=keep_builddir,
-            install_deps=install_deps,
-            check=check,
-            **file_args
-        )
+        res["phases"] = phases
+        res["duplicates_avoided"] = __salt__["pacman_build.query_stats"]()["avoided"] - avoided
+        return res
 
-        if result["success"]:
-            message = result["message"]
+    # The execution module decides if anything needs to be done, the package names are only known for sure once it ran
+    pkgname = ", ".join(pkgnames) if pkgnames else upstream_source or source
 
-            # Check if package was already installed (no changes)
-            if "already installed" in message:
-                return SaltStateRes(
-                    name=name,
-                    result=True,
-                    changes={},
-                    comment=message,
-                )
+    # Call the execution module
+    try:
+        if _parallel_enabled(parallel):
+            results = __context__.setdefault(CONTEXT_RESULTS_KEY, {})
+            if chunk_key(__low__) not in results:
+                _run_parallel_builds()
 
-            # Package was built and installed
-            return SaltStateRes(
-                name=name,
-                result=True,
-                changes=SaltStateResChanges(
-                    old=f"{pkgname} not installed",
-                    new=f"{pkgname} installed"
-                ),
-                comment=message,
-            )
+            result = results.pop(chunk_key(__low__))
         else:
-            # Build/install failed
-            return SaltStateRes(
-                name=name,
-                result=False,
-                changes={},
-                comment=result["message"],
+            result = __salt__["makepkg.installed"](
+                source=source,
+                upstream_source=upstream_source,
+                patches=patches,
+                keep_builddir=keep_builddir,
+                install_deps=install_deps,
+                check=check,
+                incremental=incremental,
+                build_size_mb=build_size_mb,
+                pkgnames=pkgnames,
+                **file_args
             )
 
+        res = _result_to_state_res(name, pkgname, result)
+        res["phases"] = result.get("timings", {})
+        res["duplicates_avoided"] = __salt__["pacman_build.query_stats"]()["avoided"] - avoided
+        return res
     except Exception as e:
         return SaltStateRes(
             name=name,
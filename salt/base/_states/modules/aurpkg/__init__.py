@@ -2,13 +2,20 @@ from typing import Optional, List
 import subprocess
 import logging
 
+from salt.exceptions import CommandExecutionError
+
 log = logging.getLogger(__name__)
 
 def _installed(pkgs: List[str]) -> bool:
+    try:
+        __salt__["pacman_build.refresh_sync_dbs"]()
+    except CommandExecutionError as e:
+        log.error(e)
+        return False
+
     cmds = [
         "yay",
         "--sync",
-        "--refresh",
         "--noconfirm",
     ] + pkgs
     log.info(cmds)
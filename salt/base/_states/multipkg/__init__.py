@@ -4,7 +4,14 @@ Overview
 Allows installing of a variety of packages from different sources.
 """
 
-from typing import TypedDict, Optional, Dict, Union, List
+from typing import TypedDict, Optional, Dict, Union, List, Tuple, Any
+import logging
+
+from salt_phases import timed_phase, merge_phases
+from salt_lowstate import thaw, chunk_key, following_chunks
+from salt_trace import traced_state
+
+log = logging.getLogger(__name__)
 
 class SaltStateResChanges(TypedDict):
     """ Describes changes.
@@ -15,48 +22,61 @@ class SaltStateResChanges(TypedDict):
     old: str
     new: str
 
-class SaltStateRes(TypedDict):
+class _SaltStateResOptional(TypedDict, total=False):
+    """ Optional fields of SaltStateRes.
+    Fields:
+    - phases: Maps the phases the state ran through to the seconds spent in them, see salt_phases
+    """
+    phases: Dict[str, float]
+
+class SaltStateRes(_SaltStateResOptional):
     """ Describes the result of a salt state execution.
     Fields:
     - name: Identifier of state block
     - result: Indicates if the state was successful, failed, or shouldn't run, see for more details: https://docs.saltproject.io/en/latest/ref/states/writing.html#return-data
-    - changes: Describes what changed due to this state running, SaltStateResChanges if changes were made, an empty dict if no changes were made
+    - changes: Describes what changed due to this state running, SaltStateResChanges and/or the changes of each package keyed by package name if changes were made, an empty dict if no changes were made
     - comment: Single line descibing what changed
     """
     name: str
     result: Optional[bool]
-    changes: Union[SaltStateResChanges, Dict[str, str]]
+    changes: Union[SaltStateResChanges, Dict[str, Any]]
     comment: str
 
 PkgDef = Union[str, List[str], Dict[str, Union[str, List[str]]]]
 
+OPTS_PARENT_KEY = "multipkg"
+OPTS_DEFER_KEY = "defer"
+
+# Package states which report changes keyed by package name, so one batched transaction's result can be split back out per multipkg state
+BATCHABLE_STATES = ["pkg", "aurpkg"]
+
+CONTEXT_RESULTS_KEY = "multipkg.deferred_results"
+
 class InvalidPkgDefError(Exception):
     pass
 
-def installed(name: str, pkgs: List[PkgDef]) -> SaltStateRes:
-    """ Installs packages from many different sources.
+def _parse_pkg_defs(pkgs: List[PkgDef]) -> List[Tuple[str, List[str]]]:
+    """ Normalize package definitions into (state, packages) pairs.
     Arguments:
-    - name: Name of state
-    - pkgs: Must be one of the following formats:
-      - List of dictionaries with only one key. Where the key is the name of the Salt state used to install the package named by value. The value can either be a single package or a list of packages. In this list a dictionary key can only appear once
-      - List of strings or single string. The default `pkg` state is used to install these packages
+    - pkgs: Package definitions, see installed()
+
+    Returns: List of the Salt state used to install and the packages it should install
 
     Raises:
     - InvalidPkgDefError: If an item of the pkgs argument does not meet the format laid out
     """
-    results: List[SaltStateRes] = []
-
     if not isinstance(pkgs, list):
         raise InvalidPkgDefError(f"Package definitions must be a list")
 
-    
+    parsed: List[Tuple[str, List[str]]] = []
+
     for pkg_def in pkgs:
         pkg_state = "pkg"
         pkgs_list = []
 
         # Allow a pkg def to either be a list
         if isinstance(pkg_def, list):
-            pkgs_list = pkg_def
+            pkgs_list = list(pkg_def)
         elif isinstance(pkg_def, str): # Single string
             pkgs_list = [pkg_def]
         elif isinstance(pkg_def, dict): # Or a dict
@@ -64,12 +84,13 @@ def installed(name: str, pkgs: List[PkgDef]) -> SaltStateRes:
             if len(pkg_def) != 1:
                 raise InvalidPkgDefError(f"A package definition must have only one key, had: {len(pkg_def)}")
 
-            pkg_state, pkgs_value = pkg_def.popitem()
+            # Don't pop, the definition may be shared with the state compiler's low data
+            pkg_state, pkgs_value = next(iter(pkg_def.items()))
 
             # Determine if one or many packages to install
             pkgs_list = []
             if isinstance(pkgs_value, list):
-                pkgs_list = pkgs_value
+                pkgs_list = list(pkgs_value)
             elif isinstance(pkgs_value, str):
                 pkgs_list = [pkgs_value]
             else:
@@ -78,16 +99,41 @@ def installed(name: str, pkgs: List[PkgDef]) -> SaltStateRes:
             # pkg def was not one of the allowed formats
             raise InvalidPkgDefError(f"A package definition must either be a dict or a list, was: {type(pkg_def)}")
 
-        # Run install
-        res = __states__[f"{pkg_state}.installed"](name=f"{name}.{pkg_state}", pkgs=pkgs_list)
-        results.append(res)
+        parsed.append((pkg_state, pkgs_list))
 
-    # Aggregate results
+    return parsed
+
+def _run_pkg_state(pkg_state: str, name: str, pkgs_list: List[str], phases: Dict[str, float]) -> SaltStateRes:
+    """ Run a package state, timing it as a phase named after the package state.
+    Arguments:
+    - pkg_state: Salt state used to install the packages
+    - name: Name to give the package state
+    - pkgs_list: Packages to install
+    - phases: Timings of the multipkg state, the package state's own phases are added prefixed by its name
+
+    Returns: Result of the package state
+    """
+    with timed_phase(phases, pkg_state):
+        res = __states__[f"{pkg_state}.installed"](name=name, pkgs=pkgs_list)
+
+    merge_phases(phases, res.get("phases", {}), prefix=f"{pkg_state}.")
+
+    return res
+
+def _aggregate_results(name: str, results: List[SaltStateRes], phases: Optional[Dict[str, float]]=None) -> SaltStateRes:
+    """ Combine the results of each package state into one multipkg result.
+    Arguments:
+    - name: Name of multipkg state
+    - results: Result of each package state run for the multipkg state
+    - phases: Timings of the multipkg state's phases, included in the result if set
+
+    Returns: Combined result
+    """
     changed_state_results = len(list(filter(lambda res: res['result'], results)))
     old_changes_results = list(filter(lambda res: 'old' in res['changes'], results))
     new_changes_results = list(filter(lambda res: 'new' in res['changes'], results))
 
-    changes = {}
+    changes: Dict[str, Any] = {}
     if len(old_changes_results) > 0 or len(new_changes_results) > 0:
         old_changes = list(map(lambda res: f"{res['name']}: {res['changes']['old']}", old_changes_results))
         new_changes = list(map(lambda res: f"{res['name']}: {res['changes']['new']}", new_changes_results))
@@ -97,14 +143,172 @@ def installed(name: str, pkgs: List[PkgDef]) -> SaltStateRes:
             new=", ".join(new_changes),
         )
 
+    # Package states like pkg and aurpkg, and batched transactions, report changes keyed by package name
+    for res in results:
+        for pkg, pkg_changes in res['changes'].items():
+            if pkg not in ("old", "new") and isinstance(pkg_changes, dict):
+                changes[pkg] = pkg_changes
+
     comments = list(map(lambda res: f"{res['name']}: {res['comment']}", results))
     
-    return SaltStateRes(
+    res = SaltStateRes(
         name=name,
         result= changed_state_results > 0,
         changes=changes,
         comment="\n".join(comments),
     )
+    if phases is not None:
+        res["phases"] = phases
+
+    return res
+
+def _defer_enabled(defer: Optional[bool]) -> bool:
+    """ Determine if deferred batch installs should be used.
+    Arguments:
+    - defer: Value from state arguments, None to use the minion configuration
+
+    Returns: True if installs should be batched
+    """
+    if defer is not None:
+        return bool(defer)
+
+    return bool(__opts__.get(OPTS_PARENT_KEY, {}).get(OPTS_DEFER_KEY, False))
+
+def _batch_candidates() -> List[Dict]:
+    """ Find the multipkg states which can be installed in the current batch, see salt_lowstate.following_chunks.
+
+    Returns: Low chunks of states to install in the batch, the current state first
+    """
+    results = __context__.setdefault(CONTEXT_RESULTS_KEY, {})
+    chunks = following_chunks(__low__, __lowstate__, lambda chunk: _defer_enabled(chunk.get("defer")))
+
+    return [chunks[0]] + [chunk for chunk in chunks[1:] if chunk_key(chunk) not in results]
+
+def _run_batch(chunks: List[Dict]) -> SaltStateRes:
+    """ Install the packages of many multipkg states using one transaction per package state.
+
+    The result of each other state is stored in the run's context for when that state's turn comes. Only successful results are stored, a state whose packages failed to install is run normally on its turn. If a batched transaction fails the current state's packages are re-run alone so the failure is attributed to the right state.
+
+    The time of each batched transaction is reported in the phases of the first state, the state which ran the batch.
+
+    Arguments:
+    - chunks: Low chunks of the multipkg states to install, the current state first
+
+    Returns: Result of the current state
+
+    Raises:
+    - InvalidPkgDefError: If the current state's pkgs argument does not meet the format laid out in installed()
+    """
+    results = __context__.setdefault(CONTEXT_RESULTS_KEY, {})
+    current_key = chunk_key(chunks[0])
+
+    # Group package lists by the state which installs them
+    state_results: Dict[Tuple[str, str], List[SaltStateRes]] = {}
+    state_phases: Dict[Tuple[str, str], Dict[str, float]] = {}
+    batches: Dict[str, List[Tuple[Dict, List[str]]]] = {}
+
+    for chunk in chunks:
+        key = chunk_key(chunk)
+
+        try:
+            pkg_defs = _parse_pkg_defs(thaw(chunk["pkgs"]))
+        except InvalidPkgDefError:
+            if key == current_key:
+                raise
+            # Leave the state to report its own error on its turn
+            continue
+
+        state_results[key] = []
+        state_phases[key] = {}
+
+        for pkg_state, pkgs_list in pkg_defs:
+            batchable = pkg_state in BATCHABLE_STATES and all(isinstance(pkg, str) for pkg in pkgs_list)
+            if not batchable:
+                state_results[key].append(_run_pkg_state(pkg_state, f"{chunk['name']}.{pkg_state}", pkgs_list, state_phases[key]))
+                continue
+
+            batches.setdefault(pkg_state, []).append((chunk, pkgs_list))
+
+    # Run one transaction per package state
+    for pkg_state, members in batches.items():
+        batch_pkgs: List[str] = []
+        for _, pkgs_list in members:
+            batch_pkgs.extend(pkg for pkg in pkgs_list if pkg not in batch_pkgs)
+
+        log.info("batch installing %d packages for %d states using %s", len(batch_pkgs), len(members), pkg_state)
+        batch_res = _run_pkg_state(pkg_state, f"multipkg.batch.{pkg_state}", batch_pkgs, state_phases[current_key])
+
+        for chunk, pkgs_list in members:
+            key = chunk_key(chunk)
+            res_name = f"{chunk['name']}.{pkg_state}"
+
+            if batch_res["result"] is False:
+                if key == current_key:
+                    # Re-run alone so the state gets its own failure
+                    state_results[key].append(_run_pkg_state(pkg_state, res_name, pkgs_list, state_phases[key]))
+                else:
+                    state_results[key].append(SaltStateRes(
+                        name=res_name,
+                        result=False,
+                        changes={},
+                        comment=f"Batched {pkg_state} transaction failed",
+                    ))
+                continue
+
+            pkg_changes = { pkg: batch_res["changes"][pkg] for pkg in pkgs_list if pkg in batch_res["changes"] }
+            comment = f"{len(pkg_changes)} of {len(pkgs_list)} packages installed in batched {pkg_state} transaction" if len(pkg_changes) > 0 else "All specified packages are already installed"
+
+            state_results[key].append(SaltStateRes(
+                name=res_name,
+                result=batch_res["result"],
+                changes=pkg_changes,
+                comment=comment,
+            ))
+
+    for chunk in chunks[1:]:
+        key = chunk_key(chunk)
+        if key not in state_results:
+            continue
+        if any(res["result"] is False for res in state_results[key]):
+            continue
+
+        results[key] = _aggregate_results(chunk["name"], state_results[key], state_phases[key])
+
+    return _aggregate_results(chunks[0]["name"], state_results[current_key], state_phases[current_key])
+
+@traced_state
+def installed(name: str, pkgs: List[PkgDef], defer: Optional[bool]=None) -> SaltStateRes:
+    """ Installs packages from many different sources.
+    Arguments:
+    - name: Name of state
+    - pkgs: Must be one of the following formats:
+      - List of dictionaries with only one key. Where the key is the name of the Salt state used to install the package named by value. The value can either be a single package or a list of packages. In this list a dictionary key can only appear once
+      - List of strings or single string. The default `pkg` state is used to install these packages
+    - defer: If True packages are installed in one transaction per package state, shared with the multipkg states which directly follow this one in the run and can safely be installed at the same time. If None the multipkg:defer minion configuration value is used
+
+    Returns: Combined result. Its phases are the seconds spent in each package state, plus the phases package states report themselves prefixed with the package state's name
+
+    Raises:
+    - InvalidPkgDefError: If an item of the pkgs argument does not meet the format laid out
+    """
+    if _defer_enabled(defer) and not __opts__["test"]:
+        results = __context__.setdefault(CONTEXT_RESULTS_KEY, {})
+        key = chunk_key(__low__)
+
+        if key in results:
+            return results.pop(key)
+
+        return _run_batch(_batch_candidates())
+
+    results: List[SaltStateRes] = []
+    phases: Dict[str, float] = {}
+
+    for pkg_state, pkgs_list in _parse_pkg_defs(pkgs):
+        # Run install
+        res = _run_pkg_state(pkg_state, f"{name}.{pkg_state}", pkgs_list, phases)
+        results.append(res)
+
+    return _aggregate_results(name, results, phases)
 
 def enabled(name: str, user: str) -> SaltStateRes:
     systemctl_cmd = [
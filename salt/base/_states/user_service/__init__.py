@@ -4,15 +4,41 @@ Overview
 Manages user specific services.
 
 Tools like systemd offer this capability.
+
+Service status queries are memoized for the Salt run, so states checking the
+same service share one systemctl call. A service's memoized status is
+forgotten when a state changes it. Every memoized status of a user is
+forgotten when the user's unit files change, or systemd's runtime unit
+directory changes, as it does on daemon-reload, e.g. after a file.managed or
+cmd.run state. Queries answered from the memo are recorded in the command
+trace as cached spans, and counted in each state result's duplicates_avoided.
 """
 
-from typing import TypedDict, Optional, Dict, Union, List, Protocol
+from typing import TypedDict, Optional, Dict, Union, List, Protocol, Tuple
 import logging
+import os
+import pwd
+
+from salt_phases import timed_phase
+from salt_trace import trace_span, traced_state
 
 log = logging.getLogger(__name__)
 
 SYSTEMD_RET_CODE_SERVICE_NOT_FOUND = 4
 
+CONTEXT_QUERIES_KEY = "user_service.queries"
+CONTEXT_UNIT_SIGNATURES_KEY = "user_service.unit_signatures"
+CONTEXT_QUERIES_AVOIDED_KEY = "user_service.queries_avoided"
+
+# Directories of user unit files shared by every user, in addition to the user's own ~/.config/systemd/user
+USER_UNIT_DIRS = [
+    "/etc/systemd/user",
+    "/usr/lib/systemd/user",
+]
+
+# Runtime unit directory of a user's service manager, its generated units are rewritten on daemon-reload
+USER_RUNTIME_UNIT_DIR = "/run/user/{uid}/systemd"
+
 class SaltStateResChanges(TypedDict):
     """ Describes changes.
     Fields:
@@ -22,7 +48,16 @@ class SaltStateResChanges(TypedDict):
     old: str
     new: str
 
-class SaltStateRes(TypedDict):
+class _SaltStateResOptional(TypedDict, total=False):
+    """ Optional fields of SaltStateRes.
+    Fields:
+    - phases: Maps the phases the state ran through to the seconds spent in them, see salt_phases
+    - duplicates_avoided: Number of systemctl queries answered from the memo instead of run
+    """
+    phases: Dict[str, float]
+    duplicates_avoided: int
+
+class SaltStateRes(_SaltStateResOptional):
     """ Describes the result of a salt state execution.
     Fields:
     - name: Identifier of state block
@@ -65,6 +100,114 @@ def __mk_systemctl_user_cmd(args: List[str], user: str) -> str:
 
     return out_cmd
 
+def __run_cmd(cmd: str, **kwargs) -> str:
+    """ Run a command with cmd.run, recording it in the command trace.
+    Arguments:
+    - cmd: Command to run
+    - kwargs: Additional arguments for cmd.run
+
+    Returns: Output of command
+    """
+    with trace_span(__opts__, __context__, __salt__, cmd, "user_service") as span:
+        res = __salt__["cmd.run"](cmd=cmd, **kwargs)
+        span["output_bytes"] = len(res)
+
+    return res
+
+def __unit_files_signature(user: str) -> Tuple:
+    """ Identify the state of a user's unit files, it changes whenever a unit file or the runtime unit directory changes.
+    Arguments:
+    - user: System user
+
+    Returns: Path, modification time and size of each entry in the user's unit directories
+
+    Raises:
+    - UserNotFoundError
+    """
+    try:
+        pw = pwd.getpwnam(user)
+    except KeyError:
+        raise UserNotFoundError(user)
+    unit_dirs = [
+        os.path.join(pw.pw_dir, ".config", "systemd", "user"),
+        *USER_UNIT_DIRS,
+        USER_RUNTIME_UNIT_DIR.format(uid=pw.pw_uid),
+    ]
+
+    signature = []
+    for unit_dir in unit_dirs:
+        try:
+            with os.scandir(unit_dir) as entries:
+                for entry in entries:
+                    stat = entry.stat(follow_symlinks=False)
+                    signature.append((entry.path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append((unit_dir, None, None))
+
+    return tuple(sorted(signature))
+
+def __query_systemctl(query: str, name: str, user: str) -> str:
+    """ Run a read only systemctl user command, memoized for the Salt run.
+    Arguments:
+    - query: systemctl sub-command which reports the service's status, like is-active
+    - name: Name of service
+    - user: System user
+
+    Returns: Output of command
+    """
+    queries = __context__.setdefault(CONTEXT_QUERIES_KEY, {})
+    key = (user, name, query)
+
+    # Unit files changed by other states, or a daemon-reload, can change any service's status
+    signatures = __context__.setdefault(CONTEXT_UNIT_SIGNATURES_KEY, {})
+    signature = __unit_files_signature(user)
+    if signatures.get(user) != signature:
+        for stale_key in [stale_key for stale_key in queries if stale_key[0] == user]:
+            del queries[stale_key]
+        signatures[user] = signature
+
+    if key in queries:
+        log.debug("Using memoized systemctl %s %s for %s", query, name, user)
+        __context__[CONTEXT_QUERIES_AVOIDED_KEY] = __context__.get(CONTEXT_QUERIES_AVOIDED_KEY, 0) + 1
+        with trace_span(__opts__, __context__, __salt__, f"systemctl --user {query} {name}", "user_service") as span:
+            span.update(cached=True, cpu_user=0.0, cpu_system=0.0, output_bytes=len(queries[key]))
+        return queries[key]
+
+    queries[key] = __run_cmd(
+        cmd=__mk_systemctl_user_cmd(
+            args=[
+                query,
+                name,
+            ],
+            user=user,
+        ),
+    )
+
+    return queries[key]
+
+def __forget_queries(name: str, user: str) -> None:
+    """ Forget the memoized status of a service, call after changing it.
+    Arguments:
+    - name: Name of service
+    - user: System user
+    """
+    queries = __context__.get(CONTEXT_QUERIES_KEY, {})
+    for key in [key for key in queries if key[:2] == (user, name)]:
+        del queries[key]
+
+class UserNotFoundError(Exception):
+    """ Indicates a system user does not exist.
+    Fields:
+    - user: Name of user
+    """
+    user: str
+
+    def __init__(self, user: str):
+        """ Initialize.
+        """
+        super().__init__(f"User '{user}' does not exist")
+        self.user = user
+
 class SystemdServiceNotFoundError(Exception):
     """ Indicates a systemd service could not be found with the name.
     Fields:
@@ -89,15 +232,7 @@ def is_running(name: str, user: str) -> bool:
     Raises:
     - SystemdServiceNotFoundError
     """
-    res = __salt__["cmd.run"](
-        cmd=__mk_systemctl_user_cmd(
-            args=[
-                "is-active",
-                name,
-            ],
-            user=user,
-        ),
-    )
+    res = __query_systemctl(query="is-active", name=name, user=user)
     if "not found" in res:
         raise SystemdServiceNotFoundError(name)
     
@@ -114,15 +249,7 @@ def is_enabled(name: str, user: str) -> bool:
     Raises:
     - SystemdServiceNotFoundError
     """
-    res = __salt__["cmd.run"](
-        cmd=__mk_systemctl_user_cmd(
-            args=[
-                "is-enabled",
-                name,
-            ],
-            user=user,
-        ),
-    )
+    res = __query_systemctl(query="is-enabled", name=name, user=user)
     if "not found" in res:
         raise SystemdServiceNotFoundError(name)
 
@@ -139,15 +266,7 @@ def is_masked(name: str, user: str) -> bool:
     Raises:
     - SystemdServiceNotFoundError
     """
-    res = __salt__["cmd.run"](
-        cmd=__mk_systemctl_user_cmd(
-            args=[
-                "is-enabled",
-                name,
-            ],
-            user=user,
-        ),
-    )
+    res = __query_systemctl(query="is-enabled", name=name, user=user)
     if "not found" in res:
         raise SystemdServiceNotFoundError(name)
 
@@ -205,6 +324,8 @@ def __change_state(
     - state_names: Used to display user interface messages
     - now: If service should have its state changes immediately
     - test: If running in test mode
+
+    Returns: State result, its phases are the seconds spent checking the service's state and changing it. Fails if the user does not exist
     """
     # Prepare command
     systemctl_cmd = [action_cmd]
@@ -216,16 +337,30 @@ def __change_state(
     systemctl_cmd.append(name)
 
     # Determine current state of command
-    needs_changing = not check_state(
-        name=name,
-        user=user,
-    )
-    needs_now_changing = False
-    if now:
-        needs_now_changing = not check_now_state(
-            name=name,
-            user=user,
-        )
+    phases: Dict[str, float] = {}
+    avoided = __context__.get(CONTEXT_QUERIES_AVOIDED_KEY, 0)
+    with timed_phase(phases, "check"):
+        try:
+            needs_changing = not check_state(
+                name=name,
+                user=user,
+            )
+            needs_now_changing = False
+            if now:
+                needs_now_changing = not check_now_state(
+                    name=name,
+                    user=user,
+                )
+        except UserNotFoundError as e:
+            # Without the user there is no service manager to query or change
+            return SaltStateRes(
+                name=name,
+                result=False,
+                changes={},
+                comment=str(e),
+                phases=phases,
+            )
+    duplicates_avoided = __context__.get(CONTEXT_QUERIES_AVOIDED_KEY, 0) - avoided
 
     work_required = needs_changing or needs_now_changing
     
@@ -245,17 +380,21 @@ def __change_state(
                 new=f"{name} for {user} " + state_names["met"],
             ),
             comment="Would be set to " + state_names["met"],
+            phases=phases,
+            duplicates_avoided=duplicates_avoided,
         )
 
     res = None
     if work_required:
-        res = __salt__["cmd.run"](
-            cmd=__mk_systemctl_user_cmd(
-                args=systemctl_cmd,
-                user=user,
-            ),
-            raise_err=True,
-        )
+        with timed_phase(phases, "change"):
+            res = __run_cmd(
+                cmd=__mk_systemctl_user_cmd(
+                    args=systemctl_cmd,
+                    user=user,
+                ),
+                raise_err=True,
+            )
+        __forget_queries(name=name, user=user)
 
     return SaltStateRes(
         name=name,
@@ -265,8 +404,11 @@ def __change_state(
             new=f"{name} for {user} " + state_names["met"],
         ) if work_required else {},
         comment=res,
+        phases=phases,
+        duplicates_avoided=duplicates_avoided,
     )
 
+@traced_state
 def enabled(name: str, user: str, start: bool=False) -> SaltStateRes:
     """ Ensure a user service is enabled.
     Arguments:
@@ -289,6 +431,7 @@ def enabled(name: str, user: str, start: bool=False) -> SaltStateRes:
         test=__opts__["test"],
     )
 
+@traced_state
 def disabled(name: str, user: str, stop: bool=False) -> SaltStateRes:
     """ Ensure a user service is disabled.
     Arguments:
@@ -317,6 +460,7 @@ def check_state_noop_true(name: str, user: str) -> bool:
     """
     return True
 
+@traced_state
 def running(name: str, user: str) -> SaltStateRes:
     """ Ensure a user service is running.
     Arguments:
@@ -338,6 +482,7 @@ def running(name: str, user: str) -> SaltStateRes:
         test=__opts__["test"],
     )
 
+@traced_state
 def stopped(name: str, user: str) -> SaltStateRes:
     """ Ensure a user service is stopped.
     Arguments:
@@ -359,6 +504,7 @@ def stopped(name: str, user: str) -> SaltStateRes:
         test=__opts__["test"],
     )
 
+@traced_state
 def masked(name: str, user: str) -> SaltStateRes:
     """ Ensure a user service is masked.
     Arguments:
@@ -380,6 +526,7 @@ def masked(name: str, user: str) -> SaltStateRes:
         test=__opts__["test"],
     )
 
+@traced_state
 def unmasked(name: str, user: str) -> SaltStateRes:
     """ Ensure a user service is not masked.
     Arguments:
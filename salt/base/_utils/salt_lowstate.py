@@ -0,0 +1,95 @@
+"""
+Helpers for custom states which run the work of several of their states at once.
+
+States like multipkg.installed and makepkg.installed can do the work of the
+states which run after them together with their own, e.g. in one package
+manager transaction. They find those states in the run's low data, which is
+available to a state as `__lowstate__`, with the currently running state's
+chunk as `__low__`.
+"""
+from typing import Any, Callable, Dict, List, Tuple
+from collections.abc import Mapping, Sequence
+
+# Requisite and conditional arguments which stop a state from running ahead of its turn
+ORDERING_ARGS = [
+    "require",
+    "watch",
+    "prereq",
+    "onchanges",
+    "onfail",
+    "use",
+    "listen",
+    "onlyif",
+    "unless",
+    "creates",
+]
+
+
+def thaw(value: Any) -> Any:
+    """Convert the state compiler's frozen low data into plain lists and dicts.
+
+    Arguments:
+        value: Value from low data
+
+    Returns:
+        Mutable copy of value
+    """
+    if isinstance(value, Mapping):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, Sequence) and not isinstance(value, str):
+        return [thaw(v) for v in value]
+
+    return value
+
+
+def chunk_key(chunk: Dict) -> Tuple[str, str]:
+    """Identify a low chunk.
+
+    Arguments:
+        chunk: Low data of a state
+
+    Returns:
+        Key unique to the state
+    """
+    return (chunk["__id__"], chunk["name"])
+
+
+def following_chunks(low: Dict, lowstate: List[Dict], include: Callable[[Dict], bool]) -> List[Dict]:
+    """Find the states which can run together with the currently running state.
+
+    The currently running state's requisites have already been met. It is grouped with
+    the states of the same function which directly follow it in the run's order,
+    stopping at the first state of another function, with requisites or conditions, or
+    which include rejects. No other state runs between the grouped states, so running
+    them early can't change the outcome of the run.
+
+    Arguments:
+        low: Low chunk of the currently running state
+        lowstate: Low chunks of the run, in the order they run
+        include: Called with each following chunk of the same function, False stops the group
+
+    Returns:
+        Low chunks of the group, low first
+    """
+    def same_function(chunk: Dict) -> bool:
+        return chunk.get("state") == low.get("state") and chunk.get("fun") == low.get("fun")
+
+    chunks = list(lowstate)
+    current = [i for i, chunk in enumerate(chunks) if same_function(chunk) and chunk_key(chunk) == chunk_key(low)]
+    if len(current) == 0:
+        return [low]
+
+    group = [low]
+    for chunk in chunks[current[0] + 1:]:
+        if not same_function(chunk):
+            break
+        if chunk.get("order", 0) < low.get("order", 0):
+            break
+        if any(arg in chunk for arg in ORDERING_ARGS):
+            break
+        if not include(chunk):
+            break
+
+        group.append(chunk)
+
+    return group
@@ -0,0 +1,42 @@
+"""
+Timing of the phases of custom state and execution module runs.
+
+Custom states return a `phases` map in their result, mapping the name of each
+phase which ran to the seconds spent in it. The maps are aggregated across a
+run by `salt-apply -r`.
+"""
+from typing import Dict
+import contextlib
+import time
+
+
+@contextlib.contextmanager
+def timed_phase(phases: Dict[str, float], name: str):
+    """Add the time spent in a with block to a phase's timing.
+
+    Arguments:
+        phases: Maps phase names to seconds
+        name: Name of the phase
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        phases[name] = round(phases.get(name, 0) + time.monotonic() - start, 3)
+
+
+def merge_phases(total: Dict[str, float], phases: Dict[str, float], prefix: str = "") -> Dict[str, float]:
+    """Add the timings of one phases map to another.
+
+    Arguments:
+        total: Phases map to add to, modified in place
+        phases: Phases map to add
+        prefix: Prepended to the names of the added phases
+
+    Returns:
+        total
+    """
+    for name, seconds in phases.items():
+        total[prefix + name] = round(total.get(prefix + name, 0) + seconds, 3)
+
+    return total
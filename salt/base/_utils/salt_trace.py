@@ -0,0 +1,156 @@
+"""
+Tracing of the external commands run by custom modules and states.
+
+Each command is recorded as a span, see the command_trace execution module for
+the fields of a span and how to configure and summarize traces. Modules trace
+a command by passing their loader dunders to trace_span:
+
+```python
+with trace_span(__opts__, __context__, __salt__, cmd, "makepkg") as fields:
+    fields["output_bytes"] = len(__salt__["cmd.run"](cmd))
+```
+
+States wrap their state functions with traced_state, so spans recorded while a
+state runs are attributed to it.
+"""
+from typing import Any, Callable, Dict
+import contextlib
+import functools
+import json
+import logging
+import resource
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+OPTS_PARENT_KEY = "command_trace"
+OPTS_FILE_KEY = "file"
+OPTS_EVENTS_KEY = "events"
+
+EVENT_TAG = "custom/command_trace/span"
+
+CONTEXT_STATE_ID_KEY = "command_trace.state_id"
+
+# Spans of concurrent commands are appended to the same file
+trace_file_lock = threading.Lock()
+
+
+def trace_enabled(opts: Dict[str, Any]) -> bool:
+    """Check if commands are traced.
+
+    Arguments:
+        opts: Minion configuration
+
+    Returns:
+        True if the trace file is configured
+    """
+    return bool(opts.get(OPTS_PARENT_KEY, {}).get(OPTS_FILE_KEY))
+
+
+def _write_span(opts: Dict[str, Any], salt: Dict[str, Callable], span: Dict[str, Any]) -> None:
+    """Append a span to the trace file and send it to the event bus if configured.
+
+    Arguments:
+        opts: Minion configuration
+        salt: Execution modules, used to send events
+        span: Span to record
+    """
+    trace_opts = opts.get(OPTS_PARENT_KEY, {})
+
+    try:
+        with trace_file_lock:
+            with open(trace_opts[OPTS_FILE_KEY], "a") as f:
+                f.write(json.dumps(span, default=str) + "\n")
+    except OSError as e:
+        log.warning("Failed to write command trace to %s: %s", trace_opts[OPTS_FILE_KEY], e)
+
+    if trace_opts.get(OPTS_EVENTS_KEY, False):
+        try:
+            salt["event.send"](EVENT_TAG, span)
+        except Exception as e:
+            log.debug("Failed to send command trace event: %s", e)
+
+
+@contextlib.contextmanager
+def trace_span(opts: Dict[str, Any], context: Dict[str, Any], salt: Dict[str, Callable], command: Any, source: str):
+    """Trace a command run in a with block.
+
+    The block fills in what it learns about the command in the yielded dictionary:
+    retcode, output_bytes, and if it measured them itself cpu_user, cpu_system and
+    max_rss_kb. If the block raises an exception without setting retcode it is recorded as None.
+
+    Arguments:
+        opts: Minion configuration, __opts__
+        context: Context of the run, __context__, which holds the running state's ID
+        salt: Execution modules, __salt__
+        command: Command being run, a string or argv list
+        source: Module running the command
+
+    Yields:
+        Dictionary of span fields
+    """
+    if not trace_enabled(opts):
+        yield {}
+        return
+
+    fields: Dict[str, Any] = {}
+    start = time.time()
+    start_monotonic = time.monotonic()
+    start_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    failed = False
+
+    try:
+        yield fields
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        end_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        record = {
+            "command": command if isinstance(command, str) else " ".join(str(arg) for arg in command),
+            "source": source,
+            "state_id": context.get(CONTEXT_STATE_ID_KEY),
+            "start": round(start, 3),
+            "end": round(time.time(), 3),
+            "duration": round(time.monotonic() - start_monotonic, 3),
+            "cpu_user": round(end_usage.ru_utime - start_usage.ru_utime, 3),
+            "cpu_system": round(end_usage.ru_stime - start_usage.ru_stime, 3),
+            "max_rss_kb": None,
+            "retcode": None if failed else 0,
+            "output_bytes": None,
+        }
+        record.update(fields)
+
+        _write_span(opts, salt, record)
+
+
+def traced_state(func: Callable) -> Callable:
+    """Decorate a state function so spans recorded while it runs are attributed to its state.
+
+    The state's ID is set from the low data Salt injects as __low__ when the function is
+    called, and the previous state ID is restored when it returns. When a state is called
+    by another state there is no low data, so the calling state's ID is kept.
+
+    Arguments:
+        func: State function
+
+    Returns:
+        Wrapped state function
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        low = func.__globals__.get("__low__")
+        if low is None:
+            return func(*args, **kwargs)
+
+        context = func.__globals__["__context__"]
+        previous_state_id = context.get(CONTEXT_STATE_ID_KEY)
+        context[CONTEXT_STATE_ID_KEY] = low.get("__id__")
+        try:
+            return func(*args, **kwargs)
+        finally:
+            context[CONTEXT_STATE_ID_KEY] = previous_state_id
+
+    return wrapper
@@ -17,7 +17,18 @@ class SaltStateResChanges(TypedDict):
     new: str
 
 
-class SaltStateRes(TypedDict):
+class _SaltStateResOptional(TypedDict, total=False):
+    """Optional fields of SaltStateRes.
+
+    Fields:
+    - phases: Maps the phases the state ran through to the seconds spent in them, see salt_phases
+    - duplicates_avoided: Number of commands the state didn't run because the memoized output of an identical earlier command was used
+    """
+    phases: Dict[str, float]
+    duplicates_avoided: int
+
+
+class SaltStateRes(_SaltStateResOptional):
     """Describes the result of a salt state execution.
 
     Fields:
@@ -27,6 +38,7 @@ class SaltStateRes(TypedDict):
     - changes: Describes what changed due to this state running
                SaltStateResChanges if changes were made, empty dict if no changes
     - comment: Single line describing what changed
+    - phases: Optional, see _SaltStateResOptional
     """
     name: str
     result: Optional[bool]
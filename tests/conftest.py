@@ -0,0 +1,70 @@
+"""
+Loads the custom modules and states outside of Salt.
+
+Salt injects its dunders (__salt__, __opts__, ...) into each module it loads, the
+load_salt_module fixture does the same with the values a test passes. Utils are
+imported directly, as Salt puts _utils on the path. If Salt is not installed the
+exceptions the custom modules import from it are provided here.
+"""
+from typing import Any, Callable
+import importlib
+import importlib.util
+import itertools
+import os
+import sys
+import types
+
+import pytest
+
+SALT_BASE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "salt", "base")
+
+sys.path.insert(0, os.path.join(SALT_BASE_DIR, "_utils"))
+
+# The repository's salt/ directory is importable as a namespace package, so probe for salt.exceptions itself
+try:
+    importlib.import_module("salt.exceptions")
+except ImportError:
+    salt_module = types.ModuleType("salt")
+    exceptions_module = types.ModuleType("salt.exceptions")
+
+    class SaltException(Exception):
+        pass
+
+    class CommandExecutionError(SaltException):
+        pass
+
+    class SaltInvocationError(SaltException):
+        pass
+
+    exceptions_module.SaltException = SaltException
+    exceptions_module.CommandExecutionError = CommandExecutionError
+    exceptions_module.SaltInvocationError = SaltInvocationError
+    salt_module.exceptions = exceptions_module
+    sys.modules["salt"] = salt_module
+    sys.modules["salt.exceptions"] = exceptions_module
+
+_module_ids = itertools.count()
+
+
+@pytest.fixture
+def load_salt_module() -> Callable[..., types.ModuleType]:
+    """Load a fresh copy of a custom module or state, with the given dunders.
+
+    Call with the path relative to salt/base, e.g. "_modules/pacman_index.py", and
+    the dunders as keyword arguments without underscores, e.g. opts={}. __opts__,
+    __salt__ and __context__ default to empty dicts.
+    """
+    def load(path: str, **dunders: Any) -> types.ModuleType:
+        name = f"salt_test_module_{next(_module_ids)}"
+        spec = importlib.util.spec_from_file_location(name, os.path.join(SALT_BASE_DIR, path))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+
+        for dunder in ("opts", "salt", "context"):
+            dunders.setdefault(dunder, {})
+        for dunder, value in dunders.items():
+            setattr(module, f"__{dunder}__", value)
+
+        return module
+
+    return load
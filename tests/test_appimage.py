@@ -0,0 +1,332 @@
+import hashlib
+import http.server
+import json
+import os
+import threading
+import time
+
+import pytest
+
+DATA = bytes(range(256)) * 4096
+ETAG = '"v1"'
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves DATA, honouring Range and If-Range, and cuts off the first `interruptions` responses halfway."""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append({"range": self.headers.get("Range"), "if_range": self.headers.get("If-Range")})
+
+        start = 0
+        range_header = self.headers.get("Range")
+        if range_header and self.headers.get("If-Range", server.etag) == server.etag:
+            start = int(range_header.split("=")[1].rstrip("-"))
+            if start >= len(DATA):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(DATA)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(DATA) - 1}/{len(DATA)}")
+        else:
+            self.send_response(200)
+
+        body = DATA[start:]
+        self.send_header("ETag", server.etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        if server.interruptions > 0:
+            server.interruptions -= 1
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    pytest.importorskip("requests")
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    server.requests = []
+    server.interruptions = 0
+    server.etag = ETAG
+    server.url = f"http://127.0.0.1:{server.server_port}/app.AppImage"
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def downloader(load_salt_module, monkeypatch):
+    appimage = load_salt_module("_modules/appimage.py")
+    monkeypatch.setattr(appimage, "_session", None)
+    monkeypatch.setattr(appimage.time, "sleep", lambda seconds: None)
+    # Chunks cut off by an interruption are lost, keep them small so most of the first attempt is resumed from
+    monkeypatch.setattr(appimage, "DOWNLOAD_CHUNK_SIZE", 64 * 1024)
+    return appimage
+
+
+def test_http_download_resumes_interrupted_download(downloader, server, tmp_path):
+    server.interruptions = 1
+    dest = str(tmp_path / "download")
+
+    downloaded, digests = downloader._http_download(server.url, dest, ["sha256", "md5"])
+
+    assert open(dest, "rb").read() == DATA
+    assert downloaded == len(DATA)
+    assert digests == {"sha256": hashlib.sha256(DATA).hexdigest(), "md5": hashlib.md5(DATA).hexdigest()}
+    assert server.requests[0] == {"range": None, "if_range": None}
+    resumed_from = int(server.requests[1]["range"].split("=")[1].rstrip("-"))
+    assert 0 < resumed_from <= len(DATA) // 2
+    assert server.requests[1]["if_range"] == ETAG
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["download"]
+
+
+def test_http_download_resumes_partial_download_of_earlier_run(downloader, server, tmp_path):
+    dest = str(tmp_path / "download")
+    offset = len(DATA) // 4
+    (tmp_path / "download.part").write_bytes(DATA[:offset])
+    (tmp_path / "download.part.validator").write_text(ETAG)
+
+    downloaded, digests = downloader._http_download(server.url, dest, ["sha256"])
+
+    assert open(dest, "rb").read() == DATA
+    assert downloaded == len(DATA) - offset
+    assert digests == {"sha256": hashlib.sha256(DATA).hexdigest()}
+    assert server.requests == [{"range": f"bytes={offset}-", "if_range": ETAG}]
+
+
+def test_http_download_restarts_when_file_changed(downloader, server, tmp_path):
+    dest = str(tmp_path / "download")
+    (tmp_path / "download.part").write_bytes(b"stale")
+    (tmp_path / "download.part.validator").write_text('"v0"')
+
+    downloaded, digests = downloader._http_download(server.url, dest, ["sha256"])
+
+    assert open(dest, "rb").read() == DATA
+    assert downloaded == len(DATA)
+    assert digests == {"sha256": hashlib.sha256(DATA).hexdigest()}
+    assert server.requests == [{"range": "bytes=5-", "if_range": '"v0"'}]
+
+
+def test_http_download_complete_partial_download(downloader, server, tmp_path):
+    dest = str(tmp_path / "download")
+    (tmp_path / "download.part").write_bytes(DATA)
+    (tmp_path / "download.part.validator").write_text(ETAG)
+
+    downloaded, digests = downloader._http_download(server.url, dest, ["sha256"])
+
+    assert open(dest, "rb").read() == DATA
+    assert downloaded == 0
+    assert digests == {"sha256": hashlib.sha256(DATA).hexdigest()}
+
+
+@pytest.fixture
+def appimage(load_salt_module, tmp_path, monkeypatch):
+    """Load appimage with its files kept in tmp_path, and a file server serving tmp_path/files. Files hashed are recorded in hashed."""
+    (tmp_path / "files").mkdir()
+
+    def load(**opts):
+        appimage = load_salt_module("_modules/appimage.py", opts={"appimage": opts}, salt={
+            "cp.cache_file": lambda source: str(tmp_path / "files" / source.replace("salt://", "")),
+        })
+        monkeypatch.setattr(appimage, "MANIFEST_PATH", str(tmp_path / "manifest.json"))
+        monkeypatch.setattr(appimage, "DOWNLOAD_DIR", str(tmp_path / "downloads"))
+        monkeypatch.setattr(appimage, "BACKUP_DIR", str(tmp_path / "backups"))
+
+        appimage.hashed = []
+        get_file_checksum = appimage._get_file_checksum
+        monkeypatch.setattr(appimage, "_get_file_checksum", lambda path, checksum_type="sha256": appimage.hashed.append(path) or get_file_checksum(path, checksum_type))
+        return appimage
+
+    return load
+
+
+def serve(tmp_path, name, data):
+    """Put a file on the file server, returning its source and sha256 checksum."""
+    (tmp_path / "files" / name).write_bytes(data)
+    return f"salt://{name}", hashlib.sha256(data).hexdigest()
+
+
+def test_installed_checksum_recorded(appimage, tmp_path):
+    appimage = appimage()
+    bin_dir = str(tmp_path / "bin")
+    source, checksum = serve(tmp_path, "app-1", b"version 1")
+    appimage.installed("app", source, bin_dir, checksum=checksum)
+    appimage.hashed.clear()
+
+    assert appimage.is_installed("app", bin_dir, checksum)
+    # A later run reads the manifest
+    appimage.__context__.clear()
+    assert appimage.is_installed("app", bin_dir, checksum)
+    assert appimage.installed("app", source, bin_dir, checksum=checksum)["changes"] == {}
+    assert appimage.hashed == []
+
+    (tmp_path / "bin" / "app").write_bytes(b"changed version 1")
+    assert not appimage.is_installed("app", bin_dir, checksum)
+    assert appimage.hashed == [str(tmp_path / "bin" / "app")]
+
+    appimage.removed("app", bin_dir)
+    assert json.loads((tmp_path / "manifest.json").read_text()) == {}
+
+
+def test_unreadable_manifest_rebuilt(appimage, tmp_path):
+    appimage = appimage()
+    (tmp_path / "bin").mkdir()
+    (tmp_path / "bin" / "app").write_bytes(b"version 1")
+    (tmp_path / "bin" / "app").chmod(0o755)
+    (tmp_path / "manifest.json").write_text("{")
+
+    assert appimage.is_installed("app", str(tmp_path / "bin"), hashlib.sha256(b"version 1").hexdigest())
+    assert list(json.loads((tmp_path / "manifest.json").read_text())) == [str(tmp_path / "bin" / "app")]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Give each backup a later timestamp."""
+    seconds = iter(range(10, 60))
+    monkeypatch.setattr(time, "strftime", lambda format: f"202601010000{next(seconds)}")
+
+
+def test_backups_kept_outside_target_dir(appimage, tmp_path, clock):
+    appimage = appimage(keep_backups=2)
+    bin_dir = tmp_path / "bin"
+    backup_dir = tmp_path / "backups" / str(bin_dir).lstrip("/")
+
+    for version in range(4):
+        source, _ = serve(tmp_path, f"app-{version}", f"version {version}".encode())
+        res = appimage.installed("app", source, str(bin_dir), force=True)
+
+    assert res["changes"]["backup"] == str(backup_dir / "app.20260101000012.bak")
+    assert sorted(os.listdir(bin_dir)) == ["app"]
+    assert [(backup_dir / name).read_bytes() for name in sorted(os.listdir(backup_dir))] == [b"version 1", b"version 2"]
+
+
+def test_legacy_backups_moved(appimage, tmp_path, clock):
+    appimage = appimage(keep_backups=2)
+    bin_dir = tmp_path / "bin"
+    backup_dir = tmp_path / "backups" / str(bin_dir).lstrip("/")
+    bin_dir.mkdir()
+    (bin_dir / "app").write_bytes(b"version 1")
+    (bin_dir / "app.bak").write_bytes(b"version 0")
+    (bin_dir / "app.20250101000000.bak").write_bytes(b"version 0.5")
+
+    source, _ = serve(tmp_path, "app-2", b"version 2")
+    appimage.installed("app", source, str(bin_dir), force=True)
+
+    assert sorted(os.listdir(bin_dir)) == ["app"]
+    # The oldest backups are removed first
+    assert sorted(os.listdir(backup_dir)) == ["app.20250101000000.bak", "app.20260101000010.bak"]
+
+
+def test_no_backups(appimage, tmp_path):
+    appimage = appimage(keep_backups=0)
+
+    for version in range(2):
+        source, _ = serve(tmp_path, f"app-{version}", f"version {version}".encode())
+        res = appimage.installed("app", source, str(tmp_path / "bin"), force=True)
+
+    assert "backup" not in res["changes"]
+    assert os.listdir(tmp_path / "backups" / str(tmp_path / "bin").lstrip("/")) == []
+
+
+@pytest.fixture
+def store(appimage, tmp_path):
+    return appimage(store_dir=str(tmp_path / "store"), keep_versions=2)
+
+
+def stored(tmp_path):
+    return sorted(name for name in os.listdir(tmp_path / "store") if name != "index.json")
+
+
+def test_store_versions_and_rollback(store, tmp_path):
+    bin_dir = str(tmp_path / "bin")
+    (tmp_path / "bin").mkdir()
+    (tmp_path / "bin" / "app").write_bytes(b"version 0")
+    checksums = []
+    for version in range(1, 3):
+        source, checksum = serve(tmp_path, f"app-{version}", f"version {version}".encode())
+        res = store.installed("app", source, bin_dir, checksum=checksum, force=True)
+        checksums.append(checksum)
+
+    assert res["changes"]["version"] == checksums[1]
+    assert os.readlink(tmp_path / "bin" / "app") == str(tmp_path / "store" / checksums[1] / "app.AppImage")
+    # The AppImage installed before the store was moved into it, then dropped over keep_versions
+    assert [(version["sha256"], version["current"]) for version in store.versions("app", bin_dir)] == [(checksums[0], False), (checksums[1], True)]
+    assert stored(tmp_path) == sorted(checksums)
+
+    assert store.rollback("app", bin_dir)["changes"] == {"old": checksums[1], "new": checksums[0]}
+    assert (tmp_path / "bin" / "app").read_bytes() == b"version 1"
+    store.hashed.clear()
+    assert store.is_installed("app", bin_dir, checksums[0])
+    assert store.hashed == []
+
+    assert store.rollback("app", bin_dir)["changes"]["new"] == checksums[1]
+    assert store.rollback("app", bin_dir, version=checksums[1][:8])["changes"] == {}
+    with pytest.raises(store.CommandExecutionError):
+        store.rollback("app", bin_dir, version="zz")
+
+
+def test_store_deduplicates(store, tmp_path):
+    source, checksum = serve(tmp_path, "app", b"version 1")
+    store.installed("app", source, str(tmp_path / "bin"))
+    store.installed("same", source, str(tmp_path / "bin"))
+
+    version_dir = tmp_path / "store" / checksum
+    assert os.stat(version_dir / "app.AppImage").st_ino == os.stat(version_dir / "same.AppImage").st_ino
+
+
+def test_store_gc(store, tmp_path):
+    bin_dir = str(tmp_path / "bin")
+    source, checksum = serve(tmp_path, "app", b"version 1")
+    other_source, other_checksum = serve(tmp_path, "other", b"other version 1")
+    store.installed("app", source, bin_dir)
+    store.installed("other", other_source, bin_dir)
+
+    store.removed("other", bin_dir)
+    # Removed AppImages can be rolled back to until the next gc
+    assert stored(tmp_path) == sorted([checksum, other_checksum])
+    assert store.gc() == 1
+    assert stored(tmp_path) == [checksum]
+    assert list(json.loads((tmp_path / "store" / "index.json").read_text())) == [os.path.join(bin_dir, "app")]
+
+
+def test_store_link_to_removed_version_removed(store, tmp_path):
+    source, checksum = serve(tmp_path, "app", b"version 1")
+    store.installed("app", source, str(tmp_path / "bin"))
+    (tmp_path / "store" / checksum / "app.AppImage").unlink()
+
+    assert store.removed("app", str(tmp_path / "bin"))["changes"] == {"removed": str(tmp_path / "bin" / "app")}
+    assert not os.path.lexists(tmp_path / "bin" / "app")
+
+
+def test_store_reuses_download_digest(store, tmp_path):
+    source, checksum = serve(tmp_path, "app", b"version 1")
+
+    store.installed("app", source, str(tmp_path / "bin"), downloaded_path=str(tmp_path / "files" / "app"), downloaded_sha256=checksum)
+
+    assert store.hashed == []
+    assert os.readlink(tmp_path / "bin" / "app") == str(tmp_path / "store" / checksum / "app.AppImage")
+
+
+def test_store_hashes_http_download_once(appimage, server, tmp_path):
+    store = appimage(store_dir=str(tmp_path / "store"))
+
+    res = store.installed("app", server.url, str(tmp_path / "bin"), checksum=hashlib.md5(DATA).hexdigest(), checksum_type="md5")
+
+    # The sha256 naming the version is computed while downloading, with the md5
+    assert res["changes"]["version"] == hashlib.sha256(DATA).hexdigest()
+    assert store.hashed == []
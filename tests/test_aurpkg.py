@@ -0,0 +1,76 @@
+import pytest
+
+
+@pytest.fixture
+def run(load_salt_module):
+    """Load aurpkg with the given installed packages and provisions, and a yay which installs what it's asked to."""
+    def load(installed, provided=(), test=False, fail=False):
+        installed = dict(installed)
+        commands = []
+
+        def version(pkg, provides=False):
+            if pkg in installed:
+                return installed[pkg]
+            return "1" if provides and pkg in provided else None
+
+        def run_cmd(cmd):
+            commands.append(cmd)
+            pkgs = cmd.split()[3:]
+            # A failed transaction may still have installed some packages
+            for pkg in pkgs[:1] if fail else pkgs:
+                installed[pkg] = "1-1"
+            if fail:
+                raise aurpkg.CommandExecutionError("yay failed")
+
+        aurpkg = load_salt_module(
+            "_states/aurpkg/__init__.py",
+            opts={"test": test},
+            salt={
+                "pacman_index.version": version,
+                "pacman_index.missing": lambda pkgs, provides=False: [pkg for pkg in pkgs if version(pkg, provides) is None],
+                "pacman_build.refresh_sync_dbs": lambda: None,
+                "pacman_build.run_cmd": run_cmd,
+            },
+        )
+        return aurpkg, commands
+
+    return load
+
+
+def test_installs_only_missing_packages(run):
+    aurpkg, commands = run({"a": "1-1"}, provided=["b"])
+
+    res = aurpkg.installed("x", pkgs=["a", "b", "c", "d"])
+
+    assert commands == ["yay --sync --noconfirm c d"]
+    assert res["result"] is True
+    assert res["changes"] == {"c": {"old": "", "new": "1-1"}, "d": {"old": "", "new": "1-1"}}
+
+
+def test_all_installed(run):
+    aurpkg, commands = run({"a": "1-1"}, provided=["b"])
+
+    res = aurpkg.installed("x", pkgs=["a", "b"])
+
+    assert commands == []
+    assert res["result"] is True
+    assert res["changes"] == {}
+
+
+def test_test_mode(run):
+    aurpkg, commands = run({"a": "1-1"}, test=True)
+
+    res = aurpkg.installed("c")
+
+    assert commands == []
+    assert res["result"] is None
+    assert res["changes"] == {"c": {"old": "", "new": "installed"}}
+
+
+def test_failure_reports_packages_installed(run):
+    aurpkg, commands = run({}, fail=True)
+
+    res = aurpkg.installed("x", pkgs=["c", "d"])
+
+    assert res["result"] is False
+    assert res["changes"] == {"c": {"old": "", "new": "1-1"}}
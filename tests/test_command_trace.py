@@ -0,0 +1,90 @@
+import json
+
+import pytest
+
+import salt_trace
+
+
+@pytest.fixture
+def trace_file(tmp_path):
+    return tmp_path / "trace.jsonl"
+
+
+@pytest.fixture
+def opts(trace_file):
+    return {"command_trace": {"file": str(trace_file)}}
+
+
+def read_spans(trace_file):
+    return [json.loads(line) for line in trace_file.read_text().splitlines()]
+
+
+def test_trace_span(opts, trace_file):
+    context = {salt_trace.CONTEXT_STATE_ID_KEY: "build-foo"}
+    with salt_trace.trace_span(opts, context, {}, ["makepkg", "--syncdeps"], "makepkg") as fields:
+        fields["output_bytes"] = 10
+
+    with pytest.raises(OSError):
+        with salt_trace.trace_span(opts, {}, {}, "git fetch", "makepkg"):
+            raise OSError("failed")
+
+    spans = read_spans(trace_file)
+    assert spans[0]["command"] == "makepkg --syncdeps"
+    assert spans[0]["state_id"] == "build-foo"
+    assert spans[0]["retcode"] == 0
+    assert spans[0]["output_bytes"] == 10
+    assert spans[0]["end"] >= spans[0]["start"]
+    assert spans[1]["state_id"] is None
+    assert spans[1]["retcode"] is None
+
+
+def test_trace_span_disabled(trace_file):
+    with salt_trace.trace_span({}, {}, {}, "true", "makepkg") as fields:
+        fields["retcode"] = 0
+
+    assert not trace_file.exists()
+
+
+def test_traced_state():
+    context = {}
+    state_ids = []
+    namespace = {"__context__": context, "__low__": {"__id__": "outer"}}
+    exec("def state():\n    return record()", namespace)
+    namespace["record"] = lambda: state_ids.append(context[salt_trace.CONTEXT_STATE_ID_KEY]) or "result"
+    state = salt_trace.traced_state(namespace["state"])
+
+    assert state() == "result"
+    assert state_ids == ["outer"]
+    assert context[salt_trace.CONTEXT_STATE_ID_KEY] is None
+
+    # Called by another state, without low data
+    context[salt_trace.CONTEXT_STATE_ID_KEY] = "caller"
+    namespace["__low__"] = None
+    state()
+    assert state_ids == ["outer", "caller"]
+
+
+def test_summary(load_salt_module, opts, trace_file):
+    command_trace = load_salt_module("_modules/command_trace.py", opts=opts)
+    spans = [
+        {"command": "/usr/bin/makepkg --syncdeps", "source": "makepkg", "state_id": "foo", "start": 100, "duration": 30, "cpu_user": 20},
+        {"command": "makepkg --printsrcinfo", "source": "makepkg", "state_id": "foo", "start": 100, "duration": 1},
+        {"command": "makepkg --printsrcinfo", "source": "makepkg", "state_id": "foo", "start": 100, "duration": 0, "cached": True},
+        {"command": "yay --sync bar", "source": "aurpkg", "state_id": "bar", "start": 50, "duration": 10},
+    ]
+    trace_file.write_text("".join(json.dumps(span) + "\n" for span in spans) + "not json\n")
+
+    summary = command_trace.summary()
+
+    assert summary["spans"] == 3
+    assert summary["duplicates_avoided"] == 1
+    assert summary["total"] == 41
+    assert [span["duration"] for span in summary["slowest"]] == [30, 10, 1]
+    assert summary["by_program"][0] == {"program": "makepkg", "count": 2, "total": 31, "max": 30, "cpu": 20}
+    assert [group["state_id"] for group in summary["by_state"]] == ["foo", "bar"]
+
+    assert command_trace.summary(since=75)["spans"] == 2
+    assert command_trace.summary(top=1)["by_source"] == [{"source": "makepkg", "count": 2, "total": 31, "max": 30, "cpu": 20}]
+
+    assert command_trace.clear()
+    assert command_trace.summary()["spans"] == 0
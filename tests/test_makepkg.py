@@ -0,0 +1,359 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="git is not installed")
+def test_update_git_mirror_ttl(load_salt_module, tmp_path, monkeypatch):
+    upstream = tmp_path / "upstream" / "foo.git"
+    subprocess.run(["git", "init", "--quiet", "--bare", str(upstream)], check=True)
+
+    commands = []
+
+    def run_cmd(cmd, cwd=None):
+        commands.append(cmd)
+        return subprocess.run(cmd, shell=True, cwd=cwd, check=True, capture_output=True, text=True).stdout
+
+    makepkg = load_salt_module(
+        "_modules/makepkg/__init__.py",
+        opts={"makepkg": {"upstream_git_url": str(tmp_path / "upstream" / "{pkg}.git"), "git_mirror_ttl": 60}},
+        salt={"pacman_build.run_cmd": run_cmd, "pacman_build.get_build_user": lambda: None},
+    )
+    monkeypatch.setattr(makepkg, "GIT_MIRROR_DIR", str(tmp_path / "mirrors"))
+
+    mirror_dir = makepkg._update_git_mirror("foo")
+    assert mirror_dir == str(tmp_path / "mirrors" / "foo.git")
+    assert len(commands) == 1 and commands[0].startswith("git clone --mirror")
+
+    # Fetched within the TTL
+    assert makepkg._update_git_mirror("foo") == mirror_dir
+    assert len(commands) == 1
+
+    # The TTL ran out
+    stamp_path = os.path.join(mirror_dir, makepkg.GIT_MIRROR_STAMP_FILE)
+    os.utime(stamp_path, (0, 0))
+    assert makepkg._update_git_mirror("foo") == mirror_dir
+    assert len(commands) == 2 and " fetch " in commands[1]
+    assert os.stat(stamp_path).st_mtime > 0
+
+
+def test_fetch_upstream_falls_back_to_yay(load_salt_module, tmp_path, monkeypatch):
+    commands = []
+
+    def run_cmd(cmd, cwd=None):
+        commands.append(cmd)
+        if cmd.startswith("git"):
+            raise makepkg.CommandExecutionError("unreachable")
+        return ""
+
+    makepkg = load_salt_module(
+        "_modules/makepkg/__init__.py",
+        opts={"makepkg": {"upstream_git_url": "https://example.invalid/{pkg}.git"}},
+        salt={"pacman_build.run_cmd": run_cmd, "pacman_build.get_build_user": lambda: None},
+    )
+    monkeypatch.setattr(makepkg, "GIT_MIRROR_DIR", str(tmp_path / "mirrors"))
+
+    makepkg._fetch_upstream("foo", str(tmp_path))
+
+    assert commands[-1] == "yay -G --force foo"
+
+
+def test_build_cache_key(load_salt_module, tmp_path):
+    makepkg = load_salt_module("_modules/makepkg/__init__.py")
+    (tmp_path / "PKGBUILD").write_text("pkgname=foo\n")
+    (tmp_path / ".git").mkdir()
+    (tmp_path / ".git" / "HEAD").write_text("ref: refs/heads/master\n")
+    flags = {"install_deps": False, "check": True}
+
+    key = makepkg._build_cache_key(str(tmp_path), {}, flags)
+    assert key == makepkg._build_cache_key(str(tmp_path), {}, dict(flags))
+
+    # Git metadata isn't part of the build
+    (tmp_path / ".git" / "HEAD").write_text("ref: refs/heads/other\n")
+    assert makepkg._build_cache_key(str(tmp_path), {}, flags) == key
+
+    assert makepkg._build_cache_key(str(tmp_path), {}, {**flags, "check": False}) != key
+    assert makepkg._build_cache_key(str(tmp_path), {"template": "jinja", "context": {"a": 1}}, flags) != key
+
+    (tmp_path / "foo.patch").write_text("")
+    assert makepkg._build_cache_key(str(tmp_path), {}, flags) != key
+
+
+@pytest.mark.parametrize("source,vcs", [
+    ("source=(\"$pkgname::git+https://example.com/foo.git\")", True),
+    ("source=('https://example.com/foo.tar.gz'\n        'svn+https://example.com/foo')", True),
+    ("source=(\"https://example.com/foo-$pkgver.tar.gz\")", False),
+])
+def test_has_vcs_sources(load_salt_module, source, vcs):
+    makepkg = load_salt_module("_modules/makepkg/__init__.py")
+
+    assert makepkg._has_vcs_sources(f"pkgname=foo\n{source}\n") is vcs
+
+
+def test_package_cache_evicts_least_recently_used(load_salt_module, tmp_path, monkeypatch):
+    makepkg = load_salt_module("_modules/makepkg/__init__.py", opts={"makepkg": {"package_cache_max_mb": 1}})
+    monkeypatch.setattr(makepkg, "PACKAGE_CACHE_DIR", str(tmp_path / "cache"))
+
+    built = []
+    for name in ("a", "b", "c"):
+        path = tmp_path / f"{name}-1-1-x86_64.pkg.tar.zst"
+        path.write_bytes(b"\0" * 400 * 1024)
+        built.append(str(path))
+
+    makepkg._store_cached_packages("key-a", built[:1])
+    makepkg._store_cached_packages("key-b", built[1:2])
+    os.utime(tmp_path / "cache" / "key-a", (1, 1))
+    os.utime(tmp_path / "cache" / "key-b", (2, 2))
+
+    # Using an entry makes it the most recently used
+    assert makepkg._get_cached_packages("key-a") == [str(tmp_path / "cache" / "key-a" / os.path.basename(built[0]))]
+
+    makepkg._store_cached_packages("key-c", built[2:])
+
+    assert sorted(os.listdir(tmp_path / "cache")) == ["key-a", "key-c"]
+    assert makepkg._get_cached_packages("key-b") == []
+
+
+SRCINFO = """\
+pkgbase = foo
+\tpkgver = 1.2.3
+\tpkgrel = 2
+\tsource = foo.tar.gz
+\tsource = foo.patch
+
+pkgname = foo
+
+pkgname = foo-docs
+\tdepends = foo
+"""
+
+
+def test_parse_srcinfo(load_salt_module):
+    makepkg = load_salt_module("_modules/makepkg/__init__.py")
+
+    srcinfo = makepkg._parse_srcinfo(SRCINFO)
+
+    assert srcinfo["pkgname"] == ["foo", "foo-docs"]
+    assert srcinfo["pkgver"] == ["1.2.3"]
+    assert srcinfo["source"] == ["foo.tar.gz", "foo.patch"]
+    assert srcinfo["depends"] == ["foo"]
+
+
+@pytest.mark.parametrize("installed,vcs,rebuild", [
+    ("1.2.3-2", False, False),
+    ("1.2.3-1", False, True),
+    ("1.10-1", False, False),
+    (None, False, True),
+    ("1.2.3-1", True, False),
+])
+def test_check_metadata_only_rebuilds_older_versions(load_salt_module, installed, vcs, rebuild):
+    pacman_index = load_salt_module("_modules/pacman_index.py")
+    makepkg = load_salt_module("_modules/makepkg/__init__.py", salt={
+        "pacman_index.version": lambda name: installed,
+        "pacman_index.vercmp": pacman_index.vercmp,
+    })
+
+    metadata = {"pkgnames": ["foo"], "version": None if vcs else "1.2.3-2", "vcs": vcs}
+    result = makepkg._check_metadata(metadata, {})
+
+    assert (result is None) is rebuild
+
+
+@pytest.fixture
+def build_many(load_salt_module, monkeypatch):
+    """Run makepkg.build_many over packages given as {name: dependencies}, with builds which fail for names in fail."""
+    def run(packages, fail=(), workers=4):
+        makepkg = load_salt_module("_modules/makepkg/__init__.py", opts={"makepkg": {"max_parallel_builds": workers}}, salt={
+            "pacman_index.version": lambda name: None,
+            "pacman_index.is_installed": lambda name, provides=False: False,
+        })
+        built = []
+
+        def resolve_and_prepare(stack, timings, source, **build_args):
+            return None, {
+                "pkgname": source, "pkgnames": [source], "old_version": None, "timings": timings, "details": {},
+                "download_dir": source, "pkgbuild_content": "", "patched": False, "install_deps": False,
+            }
+
+        def build(prepared, pkgdest):
+            if prepared["pkgname"] in fail:
+                raise fail[prepared["pkgname"]]
+            built.append(prepared["pkgname"])
+            return [prepared["pkgname"]]
+
+        monkeypatch.setattr(makepkg, "_resolve_and_prepare", resolve_and_prepare)
+        monkeypatch.setattr(makepkg, "_install_cached", lambda prepared: None)
+        monkeypatch.setattr(makepkg, "_get_srcinfo", lambda name, content, patched: {"pkgname": [name], "depends": packages[name]})
+        monkeypatch.setattr(makepkg, "_mk_build_user_dir", lambda stack: "/nonexistent")
+        monkeypatch.setattr(makepkg, "_build", build)
+        monkeypatch.setattr(makepkg, "_install_built", lambda prepared, files: makepkg._mk_result(prepared, True, "built"))
+
+        results = makepkg.build_many([{"source": name} for name in packages])
+        return {res["pkgname"]: res for res in results}, built
+
+    return run
+
+
+def test_build_many_builds_dependencies_first(build_many):
+    results, built = build_many({"c": ["b>=1"], "b": ["a"], "a": ["glibc"], "d": []})
+
+    assert all(res["success"] for res in results.values())
+    assert built.index("a") < built.index("b") < built.index("c")
+    assert sorted(built) == ["a", "b", "c", "d"]
+
+
+def test_build_many_propagates_failures_down_chains(build_many, load_salt_module):
+    error = load_salt_module("_modules/makepkg/__init__.py").CommandExecutionError
+    results, built = build_many({"a": ["b"], "b": ["c"], "c": []}, fail={"c": error("makepkg failed")})
+
+    assert built == []
+    assert results["c"]["message"] == "makepkg failed"
+    assert results["b"]["message"] == "Not built because dependencies failed: c"
+    assert results["a"]["message"] == "Not built because dependencies failed: b"
+
+
+def test_build_many_unexpected_error_fails_only_its_build(build_many):
+    results, built = build_many({"a": [], "b": [], "c": ["a"]}, fail={"a": OSError("disk full")}, workers=1)
+
+    assert results["a"]["success"] is False
+    assert "disk full" in results["a"]["message"]
+    assert results["b"]["success"] is True
+    assert results["c"]["message"] == "Not built because dependencies failed: a"
+    assert built == ["b"]
+
+
+def test_build_many_dependency_cycle(build_many):
+    results, built = build_many({"a": ["b"], "b": ["a"], "c": []})
+
+    assert built == ["c"]
+    assert results["a"]["message"] == "Not built because of a dependency cycle"
+    assert results["b"]["message"] == "Not built because of a dependency cycle"
+
+
+SPLIT_PKGBUILD = """\
+pkgbase=foo
+pkgname=(
+    "$pkgbase"
+    '${pkgbase}-docs'  # Documentation
+    foo-extra
+)
+pkgver=1.2.3
+pkgrel=2
+"""
+
+
+def test_parse_pkgbuild_names(load_salt_module):
+    makepkg = load_salt_module("_modules/makepkg/__init__.py")
+
+    assert makepkg._parse_pkgbuild_names("pkgname='foo'\npkgver=1\n") == ["foo"]
+    assert makepkg._parse_pkgbuild_names(SPLIT_PKGBUILD) == ["foo", "foo-docs", "foo-extra"]
+    assert makepkg._parse_pkgbuild_name(SPLIT_PKGBUILD) == "foo"
+
+
+def test_parse_pkgbuild_names_needs_expansion(load_salt_module):
+    makepkg = load_salt_module("_modules/makepkg/__init__.py")
+
+    assert makepkg._parse_pkgbuild_names("pkgname=$_name\n") is None
+    assert makepkg._parse_pkgbuild_names("pkgname=(\"$_name\" foo-docs)\n") is None
+    assert makepkg._parse_pkgbuild_names("pkgver=1\n") is None
+
+
+def test_select_package_files(load_salt_module):
+    makepkg = load_salt_module("_modules/makepkg/__init__.py")
+    package_files = [
+        "/out/foo-1:1.2.3-2-x86_64.pkg.tar.zst",
+        "/out/foo-docs-1:1.2.3-2-any.pkg.tar.zst",
+        "/out/foo-extra-1:1.2.3-2-x86_64.pkg.tar.xz",
+    ]
+
+    assert makepkg._package_file_name(package_files[1]) == "foo-docs"
+    assert makepkg._select_package_files({"pkgnames": ["foo", "foo-extra"]}, package_files) == [package_files[0], package_files[2]]
+
+    with pytest.raises(makepkg.CommandExecutionError, match="foo-debug"):
+        makepkg._select_package_files({"pkgnames": ["foo", "foo-debug"]}, package_files)
+
+
+@pytest.fixture
+def resolving(load_salt_module, tmp_path, monkeypatch):
+    """Load makepkg with salt_file_utils, over a file server holding the files in hashes."""
+    hashes = {"salt://foo/PKGBUILD": "1", "salt://foo/fix.patch": "2"}
+    fetched = []
+
+    def get_file_str(source, **kwargs):
+        fetched.append(source)
+        return f"content of {source}"
+
+    def renderer(path, default_renderer, **template_vars):
+        fetched.append(path)
+        return f"rendered {path}"
+
+    salt = {
+        "cp.hash_file": lambda source, **kwargs: {"hash_type": "sha256", "hsum": hashes[source]} if source in hashes else {},
+        "cp.get_file_str": get_file_str,
+        "cp.cache_file": lambda source, **kwargs: source,
+        "slsutil.renderer": renderer,
+        "pacman_index.version": lambda name: "1.0-1",
+        "pacman_index.vercmp": load_salt_module("_modules/pacman_index.py").vercmp,
+    }
+    # Salt shares one context between the modules of a run
+    context = {}
+    salt_file_utils = load_salt_module("_modules/salt_file_utils.py", salt=salt, context=context, pillar={}, grains={})
+    salt["salt_file_utils.get_managed_file_key"] = salt_file_utils.get_managed_file_key
+    salt["salt_file_utils.get_managed_file_content"] = salt_file_utils.get_managed_file_content
+
+    makepkg = load_salt_module("_modules/makepkg/__init__.py", salt=salt, context=context)
+    monkeypatch.setattr(makepkg, "MAKEPKG_DIR", str(tmp_path))
+    monkeypatch.setattr(makepkg, "BUILD_METADATA_FILE", str(tmp_path / "metadata.json"))
+    makepkg.hashes = hashes
+    makepkg.fetched = fetched
+    return makepkg
+
+
+def test_resolve_key_doesnt_fetch_or_render(resolving):
+    makepkg = resolving
+    args = ("salt://foo/PKGBUILD", None, ["salt://foo/fix.patch"], True)
+
+    key = makepkg._resolve_key(*args, template="jinja", context={"a": 1})
+    assert makepkg.fetched == []
+
+    assert makepkg._resolve_key(*args, template="jinja", context={"a": 1}) == key
+    assert makepkg._resolve_key(*args, template="jinja", context={"a": 2}) != key
+
+    makepkg.hashes["salt://foo/fix.patch"] = "3"
+    makepkg.__context__.clear()
+    assert makepkg._resolve_key(*args, template="jinja", context={"a": 1}) != key
+    assert makepkg.fetched == []
+
+
+def test_resolve_key_of_unhashable_source(resolving):
+    makepkg = resolving
+
+    key = makepkg._resolve_key("https://example.com/PKGBUILD", None, None, True)
+
+    assert makepkg.fetched == ["https://example.com/PKGBUILD"]
+    assert key is not None
+
+
+@pytest.mark.parametrize("recorded_version,prepared", [("1.0-1", False), ("1.1-1", True)])
+def test_resolved_build_skips_fetch(resolving, monkeypatch, recorded_version, prepared):
+    makepkg = resolving
+    resolve_key = makepkg._resolve_key("salt://foo/PKGBUILD", None, None, False)
+    makepkg._record_build_metadata("salt://foo/PKGBUILD", resolve_key, ["foo"], recorded_version, False)
+
+    class Fetched(Exception):
+        pass
+
+    def prepare(*args, **kwargs):
+        raise Fetched()
+
+    monkeypatch.setattr(makepkg, "_prepare", prepare)
+
+    if prepared:
+        with pytest.raises(Fetched):
+            makepkg._resolve_and_prepare(None, {}, source="salt://foo/PKGBUILD")
+    else:
+        result, _ = makepkg._resolve_and_prepare(None, {}, source="salt://foo/PKGBUILD")
+        assert result["success"] is True
+    assert makepkg.fetched == []
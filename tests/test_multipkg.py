@@ -0,0 +1,138 @@
+import pytest
+
+
+INSTALLED = {"old": "", "new": "1"}
+
+
+def chunk(id_, pkgs, order=10000, **args):
+    return {"__id__": id_, "name": id_, "state": "multipkg", "fun": "installed", "order": order, "pkgs": pkgs, **args}
+
+
+@pytest.fixture
+def run(load_salt_module):
+    """Load multipkg for a run of the given low chunks, with package states which record their calls."""
+    def load(lowstate, opts=None, fail=()):
+        calls = []
+
+        def pkg_installed(name, pkgs):
+            calls.append((name, list(pkgs)))
+            if any(pkg in fail for pkg in pkgs):
+                return {"name": name, "result": False, "changes": {}, "comment": "failed"}
+            return {"name": name, "result": True, "changes": {pkg: INSTALLED for pkg in pkgs}, "comment": ""}
+
+        multipkg = load_salt_module(
+            "_states/multipkg/__init__.py",
+            opts={"test": False, **(opts or {})},
+            states={"pkg.installed": pkg_installed, "aurpkg.installed": pkg_installed},
+            lowstate=lowstate,
+        )
+
+        def installed(low):
+            multipkg.__low__ = low
+            return multipkg.installed(low["name"], low["pkgs"], defer=low.get("defer"))
+
+        return multipkg, installed, calls
+
+    return load
+
+
+def test_batch_candidates_stop_at_ordering_args_and_other_functions(run):
+    lowstate = [
+        chunk("a", ["a"]),
+        chunk("b", ["b"]),
+        chunk("c", ["c"], require=[{"pkg": "x"}]),
+        chunk("d", ["d"]),
+    ]
+    multipkg, _, _ = run(lowstate, opts={"multipkg": {"defer": True}})
+
+    multipkg.__low__ = lowstate[0]
+    assert [c["name"] for c in multipkg._batch_candidates()] == ["a", "b"]
+
+    multipkg.__low__ = lowstate[2]
+    assert [c["name"] for c in multipkg._batch_candidates()] == ["c", "d"]
+
+    other = dict(chunk("e", ["e"]), fun="enabled")
+    multipkg.__lowstate__ = [lowstate[0], other, lowstate[1]]
+    multipkg.__low__ = lowstate[0]
+    assert [c["name"] for c in multipkg._batch_candidates()] == ["a"]
+
+
+def test_batch_candidates_stop_at_state_without_defer(run):
+    lowstate = [
+        chunk("a", ["a"], defer=True),
+        chunk("b", ["b"], defer=True),
+        chunk("c", ["c"]),
+        chunk("d", ["d"], defer=True),
+    ]
+    multipkg, _, _ = run(lowstate)
+
+    multipkg.__low__ = lowstate[0]
+    assert [c["name"] for c in multipkg._batch_candidates()] == ["a", "b"]
+
+
+def test_installed_batches_following_states(run):
+    lowstate = [
+        chunk("a", ["a1", {"aurpkg": "a2"}]),
+        chunk("b", ["b1", {"aurpkg": ["a2", "b2"]}]),
+        chunk("c", ["c1"], require=[{"pkg": "x"}]),
+    ]
+    _, installed, calls = run(lowstate, opts={"multipkg": {"defer": True}})
+
+    res_a = installed(lowstate[0])
+    assert calls == [
+        ("multipkg.batch.pkg", ["a1", "b1"]),
+        ("multipkg.batch.aurpkg", ["a2", "b2"]),
+    ]
+    assert res_a["result"] is True
+    assert res_a["comment"] == (
+        "a.pkg: 1 of 1 packages installed in batched pkg transaction\n"
+        "a.aurpkg: 1 of 1 packages installed in batched aurpkg transaction"
+    )
+    assert res_a["changes"] == {"a1": INSTALLED, "a2": INSTALLED}
+
+    res_b = installed(lowstate[1])
+    assert len(calls) == 2
+    assert res_b["result"] is True
+    assert "b.aurpkg: 2 of 2 packages installed in batched aurpkg transaction" in res_b["comment"]
+    assert res_b["changes"] == {"b1": INSTALLED, "a2": INSTALLED, "b2": INSTALLED}
+
+    installed(lowstate[2])
+    assert calls[2:] == [("multipkg.batch.pkg", ["c1"])]
+
+
+def test_installed_failed_batch_reruns_current_state_alone(run):
+    lowstate = [
+        chunk("a", ["a1"]),
+        chunk("b", ["b1"]),
+    ]
+    _, installed, calls = run(lowstate, opts={"multipkg": {"defer": True}}, fail=["b1"])
+
+    res_a = installed(lowstate[0])
+    assert calls == [("multipkg.batch.pkg", ["a1", "b1"]), ("a.pkg", ["a1"])]
+    assert res_a["result"] is True
+
+    # The failed state's result was not stored, it runs again on its turn
+    res_b = installed(lowstate[1])
+    assert calls[2:] == [("multipkg.batch.pkg", ["b1"]), ("b.pkg", ["b1"])]
+    assert res_b["result"] is False
+
+
+def test_installed_without_defer(run):
+    lowstate = [chunk("a", ["a1"]), chunk("b", ["b1"])]
+    _, installed, calls = run(lowstate)
+
+    installed(lowstate[0])
+    installed(lowstate[1])
+    assert calls == [("a.pkg", ["a1"]), ("b.pkg", ["b1"])]
+    assert installed(lowstate[1])["changes"] == {"b1": INSTALLED}
+
+
+def test_aggregate_results_keeps_both_change_shapes(run):
+    multipkg, _, _ = run([])
+
+    res = multipkg._aggregate_results("x", [
+        {"name": "x.pkg", "result": True, "changes": {"p1": INSTALLED}, "comment": ""},
+        {"name": "x.other", "result": True, "changes": {"old": "off", "new": "on"}, "comment": ""},
+    ])
+
+    assert res["changes"] == {"old": "x.other: off", "new": "x.other: on", "p1": INSTALLED}
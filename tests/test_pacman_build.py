@@ -0,0 +1,211 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    (tmp_path / "db" / "sync").mkdir(parents=True)
+    (tmp_path / "db" / "sync" / "core.db").write_bytes(b"")
+    return tmp_path / "db"
+
+
+@pytest.fixture
+def pacman_build(load_salt_module, db_path, tmp_path, monkeypatch):
+    commands = []
+    pacman_build = load_salt_module(
+        "_modules/pacman_build.py",
+        opts={"pacman": {"db_path": str(db_path), "refresh_ttl": 60}},
+        salt={"cmd.run": lambda cmd, **kwargs: commands.append(cmd) or ""},
+    )
+    pacman_build.commands = commands
+    monkeypatch.setattr(pacman_build, "REFRESH_STAMP_PATH", str(tmp_path / "stamp" / "last-refresh"))
+    return pacman_build
+
+
+def test_refresh_once_per_run(pacman_build):
+    assert pacman_build.sync_dbs_age() is None
+
+    assert pacman_build.refresh_sync_dbs() is True
+    assert pacman_build.refresh_sync_dbs() is False
+    assert pacman_build.commands == ["pacman --sync --refresh --noconfirm"]
+    assert pacman_build.sync_dbs_age() < 60
+
+
+def test_refresh_skipped_within_ttl(pacman_build):
+    pacman_build.refresh_sync_dbs()
+
+    # A later run
+    pacman_build.__context__.clear()
+    assert pacman_build.refresh_sync_dbs() is False
+    assert len(pacman_build.commands) == 1
+
+    os.utime(pacman_build.REFRESH_STAMP_PATH, (0, 0))
+    pacman_build.__context__.clear()
+    assert pacman_build.refresh_sync_dbs() is True
+    assert len(pacman_build.commands) == 2
+
+
+def test_refresh_forced(pacman_build):
+    pacman_build.refresh_sync_dbs()
+
+    assert pacman_build.refresh_sync_dbs(force=True) is True
+    assert len(pacman_build.commands) == 2
+
+
+def test_refresh_without_sync_databases(pacman_build, db_path):
+    pacman_build.refresh_sync_dbs()
+    (db_path / "sync" / "core.db").unlink()
+
+    # Databases removed since the last refresh are fetched again
+    pacman_build.__context__.clear()
+    assert pacman_build.sync_dbs_age() is None
+    assert pacman_build.refresh_sync_dbs() is True
+
+
+def test_worker_script_protocol(load_salt_module, tmp_path):
+    pacman_build = load_salt_module("_modules/pacman_build.py")
+    proc = subprocess.Popen([sys.executable, "-c", pacman_build.WORKER_SCRIPT], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+
+    requests = [
+        {"id": 0, "argv": [sys.executable, "-c", "import os, sys; print(os.getcwd(), os.environ['FOO'], sys.stdin.read())"],
+         "cwd": str(tmp_path), "env": {"FOO": "bar"}, "stdin": "input"},
+        {"id": 1, "argv": [sys.executable, "-c", "import sys; sys.exit(3)"]},
+        {"id": 2, "argv": [str(tmp_path / "missing")]},
+    ]
+    for request in requests:
+        proc.stdin.write(json.dumps(request) + "\n")
+    proc.stdin.close()
+    responses = {response["id"]: response for response in map(json.loads, proc.stdout)}
+    proc.wait()
+
+    assert responses[0]["retcode"] == 0
+    assert responses[0]["output"] == f"{tmp_path} bar input\n"
+    assert responses[0]["max_rss_kb"] > 0
+    assert responses[1]["retcode"] == 3
+    assert responses[2]["retcode"] is None
+
+
+def test_login_environment(load_salt_module, monkeypatch):
+    pacman_build = load_salt_module("_modules/pacman_build.py")
+    commands = []
+    subprocess_run = subprocess.run
+
+    def run(argv, **kwargs):
+        commands.append(argv)
+        # Run the script without su
+        return subprocess_run([sys.executable], **{**kwargs, "env": {"HOME": "/home/builder", "MULTI": "a\nb=c"}})
+
+    monkeypatch.setattr(pacman_build.subprocess, "run", run)
+
+    env = pacman_build._login_environment("builder")
+
+    assert commands[0][:5] == ["su", "-s", "/bin/bash", "-", "builder"]
+    assert env["HOME"] == "/home/builder"
+    assert env["MULTI"] == "a\nb=c"
+
+
+class FakeWorker:
+    started = []
+
+    def __init__(self, build_user):
+        if build_user == "nobody-here":
+            raise KeyError(build_user)
+        self.runs = []
+        self.fail = False
+        FakeWorker.started.append(self)
+
+    def run(self, argv, **kwargs):
+        if self.fail:
+            raise OSError("Build worker exited")
+        self.runs.append((argv, kwargs))
+        return {"retcode": 1 if argv[0] == "false" else 0, "output": "out\n", "cpu_user": 0.1}
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def worker_build(load_salt_module, monkeypatch):
+    commands = []
+    pacman_build = load_salt_module("_modules/pacman_build.py", opts={"pacman": {"nonroot_builder": "builder", "build_worker": True}}, salt={
+        "cmd.run": lambda **kwargs: commands.append(kwargs) or "cmd.run output",
+    })
+    pacman_build.commands = commands
+    FakeWorker.started = []
+    monkeypatch.setattr(pacman_build, "_BuildWorker", FakeWorker)
+    return pacman_build
+
+
+def test_run_cmd_in_worker(worker_build):
+    assert worker_build.run_cmd("makepkg --printsrcinfo", cwd="/build") == "out"
+    assert worker_build.run_cmd("git status", cwd="/build") == "out"
+
+    assert len(FakeWorker.started) == 1
+    assert FakeWorker.started[0].runs == [
+        (["makepkg", "--printsrcinfo"], {"cwd": "/build"}),
+        (["git", "status"], {"cwd": "/build"}),
+    ]
+    assert worker_build.commands == []
+
+    with pytest.raises(worker_build.CommandExecutionError, match="return code: 1"):
+        worker_build.run_cmd("false")
+
+
+def test_run_cmd_outside_worker(worker_build):
+    # Shell syntax, and arguments the worker doesn't support
+    worker_build.run_cmd("makepkg --printsrcinfo > .SRCINFO")
+    worker_build.run_cmd("makepkg", python_shell=True)
+
+    assert [command["cmd"] for command in worker_build.commands] == ["makepkg --printsrcinfo > .SRCINFO", "makepkg"]
+    assert all(command["runas"] == "builder" for command in worker_build.commands)
+
+
+def test_run_cmd_worker_backoff(worker_build, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(worker_build.time, "monotonic", lambda: now[0])
+
+    worker_build.run_cmd("true")
+    FakeWorker.started[0].fail = True
+
+    # The failed command and the commands during the backoff run with cmd.run
+    assert worker_build.run_cmd("true") == "cmd.run output"
+    assert worker_build.run_cmd("true") == "cmd.run output"
+    assert len(FakeWorker.started) == 1
+
+    now[0] += worker_build.WORKER_RETRY_DELAY
+    assert worker_build.run_cmd("true") == "out"
+    assert len(FakeWorker.started) == 2
+    assert len(worker_build.commands) == 2
+
+
+def test_run_cmd_worker_start_failure(worker_build):
+    worker_build.__opts__["pacman"]["nonroot_builder"] = "nobody-here"
+
+    assert worker_build.run_cmd("true") == "cmd.run output"
+    assert worker_build._worker_failures["nobody-here"][0] == 1
+
+
+def test_query_memoized(worker_build):
+    srcinfo = worker_build.query("makepkg --printsrcinfo", scope="pkgbuild:1", cwd="/build/a")
+    # The same PKGBUILD prepared in another directory
+    assert worker_build.query("makepkg --printsrcinfo", scope="pkgbuild:1", cwd="/build/b") == srcinfo
+    worker_build.query("makepkg --printsrcinfo", scope="pkgbuild:2", cwd="/build/b")
+
+    assert len(FakeWorker.started[0].runs) == 2
+    assert worker_build.query_stats() == {"run": 2, "avoided": 1, "invalidated": 0}
+
+    assert worker_build.invalidate_queries("pkgbuild:1") == 1
+    worker_build.query("makepkg --printsrcinfo", scope="pkgbuild:1", cwd="/build/a")
+    assert len(FakeWorker.started[0].runs) == 3
+
+
+def test_query_failure_not_memoized(worker_build):
+    for _ in range(2):
+        with pytest.raises(worker_build.CommandExecutionError):
+            worker_build.query("false", scope="pkgbuild:1")
+
+    assert worker_build.query_stats()["avoided"] == 0
@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+
+def add_package(db_path, name, version, provides=()):
+    entry = db_path / "local" / f"{name}-{version}"
+    entry.mkdir(parents=True)
+    desc = f"%NAME%\n{name}\n\n%VERSION%\n{version}\n\n"
+    if provides:
+        desc += "%PROVIDES%\n" + "\n".join(provides) + "\n\n"
+    (entry / "desc").write_text(desc)
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    add_package(tmp_path, "foo", "1.0-1", provides=["libfoo.so=1-64", "foo-bin"])
+    add_package(tmp_path, "bar", "1:2.0-3")
+    (tmp_path / "local" / "ALPM_DB_VERSION").write_text("9\n")
+    return tmp_path
+
+
+@pytest.fixture
+def pacman_index(load_salt_module, db_path):
+    return load_salt_module("_modules/pacman_index.py", salt={"pacman_build.get_db_path": lambda: str(db_path)})
+
+
+def test_version(pacman_index):
+    assert pacman_index.version("foo") == "1.0-1"
+    assert pacman_index.version("bar") == "1:2.0-3"
+    assert pacman_index.version("baz") is None
+
+
+def test_provides(pacman_index):
+    assert pacman_index.version("foo-bin") is None
+    assert pacman_index.version("foo-bin", provides=True) == "1.0-1"
+    assert pacman_index.version("libfoo.so", provides=True) == "1-64"
+    assert pacman_index.missing(["bar", "foo-bin", "baz"]) == ["foo-bin", "baz"]
+    assert pacman_index.missing(["bar", "foo-bin", "baz"], provides=True) == ["baz"]
+
+
+def test_reloads_when_database_changes(pacman_index, db_path):
+    assert not pacman_index.is_installed("baz")
+
+    add_package(db_path, "baz", "0.1-1")
+    # Make sure the directory's modification time changes even on coarse timestamp filesystems
+    stat = os.stat(db_path / "local")
+    os.utime(db_path / "local", ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    assert pacman_index.is_installed("baz")
+
+
+def test_missing_database(load_salt_module, tmp_path):
+    pacman_index = load_salt_module("_modules/pacman_index.py", salt={"pacman_build.get_db_path": lambda: str(tmp_path)})
+
+    assert pacman_index.missing(["foo"]) == ["foo"]
+
+
+@pytest.mark.parametrize("older,newer", [
+    ("1.0-1", "1.0-2"),
+    ("1.0-1", "1.1-1"),
+    ("1.9-1", "1.10-1"),
+    ("1.0alpha-1", "1.0-1"),
+    ("1.0-1", "1.0.1-1"),
+    ("1.0", "1.0.a"),
+    ("2.0-1", "1:1.0-1"),
+    ("1:2.0-1", "2:1.0-1"),
+    ("r123.abc-1", "r124.abc-1"),
+])
+def test_vercmp_ordering(pacman_index, older, newer):
+    assert pacman_index.vercmp(older, newer) < 0
+    assert pacman_index.vercmp(newer, older) > 0
+
+
+@pytest.mark.parametrize("version_a,version_b", [
+    ("1.0-1", "1.0-1"),
+    ("0:1.0-1", "1.0-1"),
+    ("1.0-1", "1.0"),
+    ("1.0", "1_0"),
+])
+def test_vercmp_equal(pacman_index, version_a, version_b):
+    assert pacman_index.vercmp(version_a, version_b) == 0
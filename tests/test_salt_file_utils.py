@@ -0,0 +1,104 @@
+import os
+
+import pytest
+
+
+@pytest.fixture
+def file_utils(load_salt_module, tmp_path):
+    """Load salt_file_utils over a file server holding the files in contents, recording each fetch and render."""
+    contents = {"salt://a": "a", "salt://b": "b", "salt://c": "c"}
+    hashes = {source: content for source, content in contents.items()}
+    fetched = []
+    (tmp_path / "cached").mkdir()
+
+    def cache_file(source, **kwargs):
+        fetched.append(source)
+        path = tmp_path / "cached" / source.replace("salt://", "")
+        path.write_text(contents[source])
+        return str(path)
+
+    def renderer(path, default_renderer, **template_vars):
+        return f"{open(path).read()} {template_vars}"
+
+    def load(**opts):
+        return load_salt_module(
+            "_modules/salt_file_utils.py",
+            opts={"salt_file_utils": opts},
+            salt={
+                "cp.hash_file": lambda source, **kwargs: {"hash_type": "sha256", "hsum": hashes[source]},
+                "cp.get_file_str": lambda source, **kwargs: fetched.append(source) or contents[source],
+                "cp.cache_file": cache_file,
+                "slsutil.renderer": renderer,
+            },
+            pillar={},
+            grains={},
+        )
+
+    load.contents = contents
+    load.hashes = hashes
+    load.fetched = fetched
+    return load
+
+
+def test_key(file_utils):
+    salt_file_utils = file_utils()
+
+    assert salt_file_utils.get_managed_file_content("salt://a", template="jinja", context={"x": 1}) == "a {'x': 1}"
+    assert salt_file_utils.get_managed_file_content("salt://a", template="jinja", defaults={"x": 1}) == "a {'x': 1}"
+    assert salt_file_utils.get_managed_file_content("salt://a", template="jinja", context={"x": 2}) == "a {'x': 2}"
+    assert salt_file_utils.get_managed_file_content("salt://a") == "a"
+    assert file_utils.fetched == ["salt://a", "salt://a", "salt://a"]
+
+    # The template engine, variables, and pillar and grains are part of the key
+    key = salt_file_utils.get_managed_file_key("salt://a", template="jinja", context={"x": 1})
+    assert salt_file_utils.get_managed_file_key("salt://a", template="jinja", defaults={"x": 1}) == key
+    assert salt_file_utils.get_managed_file_key("salt://a", template="mako", context={"x": 1}) != key
+    assert salt_file_utils.get_managed_file_key("salt://a", template="jinja", context={"x": 2}) != key
+    salt_file_utils.__pillar__ = {"y": 1}
+    salt_file_utils.__context__.clear()
+    assert salt_file_utils.get_managed_file_key("salt://a", template="jinja", context={"x": 1}) != key
+
+
+def test_source_changed(file_utils):
+    salt_file_utils = file_utils()
+    salt_file_utils.get_managed_file_content("salt://a")
+
+    file_utils.contents["salt://a"] = file_utils.hashes["salt://a"] = "new a"
+    # Source hashes are looked up once per run
+    salt_file_utils.__context__.pop(salt_file_utils.CONTEXT_SOURCE_HASHES_KEY)
+
+    assert salt_file_utils.get_managed_file_content("salt://a") == "new a"
+
+
+def test_least_recently_used_evicted(file_utils):
+    salt_file_utils = file_utils(cache_size=2)
+
+    for source in ["salt://a", "salt://b", "salt://a", "salt://c", "salt://a", "salt://b"]:
+        assert salt_file_utils.get_managed_file_content(source) == source[-1]
+
+    assert file_utils.fetched == ["salt://a", "salt://b", "salt://c", "salt://b"]
+
+
+def test_disk_cache(file_utils, tmp_path):
+    cache_dir = tmp_path / "disk"
+    salt_file_utils = file_utils(cache_dir=str(cache_dir), disk_cache_size=2)
+    salt_file_utils.get_managed_file_content("salt://a")
+    salt_file_utils.get_managed_file_content("salt://b", template="jinja")
+    salt_file_utils.get_managed_file_path("salt://c", str(tmp_path / "c"))
+    file_utils.fetched.clear()
+
+    # A later run
+    salt_file_utils = file_utils(cache_dir=str(cache_dir), disk_cache_size=2)
+    assert salt_file_utils.get_managed_file_content("salt://a") == "a"
+    assert salt_file_utils.get_managed_file_path("salt://c", str(tmp_path / "c2")) == str(tmp_path / "c2")
+    assert (tmp_path / "c2").read_text() == "c"
+    # Templates are only cached for the run
+    salt_file_utils.get_managed_file_content("salt://b", template="jinja")
+    assert file_utils.fetched == ["salt://b"]
+
+    os.utime(cache_dir / salt_file_utils.get_managed_file_key("salt://a"), (0, 0))
+    salt_file_utils.get_managed_file_content("salt://b")
+    assert sorted(os.listdir(cache_dir)) == sorted(salt_file_utils.get_managed_file_key(source) for source in ["salt://b", "salt://c"])
+
+    assert salt_file_utils.clear_cache(disk=True) == 5
+    assert os.listdir(cache_dir) == []
@@ -0,0 +1,35 @@
+from types import MappingProxyType
+
+from salt_lowstate import following_chunks, thaw
+
+
+def chunk(id_, fun="installed", order=10000, **args):
+    return {"__id__": id_, "name": id_, "state": "makepkg", "fun": fun, "order": order, **args}
+
+
+def test_following_chunks():
+    lowstate = [chunk("a"), chunk("b"), chunk("c"), chunk("d", unless="true"), chunk("e")]
+
+    assert [c["name"] for c in following_chunks(lowstate[0], lowstate, lambda c: True)] == ["a", "b", "c"]
+    assert [c["name"] for c in following_chunks(lowstate[1], lowstate, lambda c: c["name"] != "c")] == ["b"]
+    assert [c["name"] for c in following_chunks(lowstate[3], lowstate, lambda c: True)] == ["d", "e"]
+
+
+def test_following_chunks_stop_at_other_functions_and_earlier_order():
+    lowstate = [chunk("a"), chunk("b", fun="removed"), chunk("c")]
+    assert [c["name"] for c in following_chunks(lowstate[0], lowstate, lambda c: True)] == ["a"]
+
+    lowstate = [chunk("a", order=2), chunk("b", order=1)]
+    assert [c["name"] for c in following_chunks(lowstate[0], lowstate, lambda c: True)] == ["a"]
+
+
+def test_following_chunks_of_unknown_chunk():
+    low = chunk("x")
+
+    assert following_chunks(low, [chunk("a")], lambda c: True) == [low]
+
+
+def test_thaw():
+    frozen = MappingProxyType({"pkgs": ("a", MappingProxyType({"aurpkg": ("b",)}))})
+
+    assert thaw(frozen) == {"pkgs": ["a", {"aurpkg": ["b"]}]}
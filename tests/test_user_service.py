@@ -0,0 +1,74 @@
+import getpass
+
+import pytest
+
+
+@pytest.fixture
+def user_service(load_salt_module, tmp_path, monkeypatch):
+    """Load user_service with a systemctl which reports each service's status from a dict."""
+    status = {"foo": {"is-active": "failed", "is-enabled": "disabled"}}
+    commands = []
+
+    def run(cmd, **kwargs):
+        commands.append(cmd)
+        args = cmd.split()
+        query, name = args[-2:]
+        if query in ("is-active", "is-enabled"):
+            return status[name][query]
+
+        status[name] = {"is-active": "active" if query == "start" else "failed", "is-enabled": "enabled"}
+        return ""
+
+    user_service = load_salt_module("_states/user_service/__init__.py", opts={"test": False}, salt={"cmd.run": run})
+    user_service.status = status
+    user_service.commands = commands
+    (tmp_path / "units").mkdir()
+    monkeypatch.setattr(user_service, "USER_UNIT_DIRS", [str(tmp_path / "units")])
+    monkeypatch.setattr(user_service, "USER_RUNTIME_UNIT_DIR", str(tmp_path / "run" / "{uid}"))
+    return user_service
+
+
+def queries(user_service):
+    return [" ".join(cmd.split()[-2:]) for cmd in user_service.commands]
+
+
+def test_queries_memoized(user_service):
+    user = getpass.getuser()
+
+    assert user_service.disabled("foo", user)["changes"] == {}
+    res = user_service.masked("foo", user)
+
+    assert res["result"] is True
+    assert res["duplicates_avoided"] == 1
+    assert queries(user_service) == ["is-enabled foo", "mask foo"]
+
+
+def test_change_forgets_service(user_service):
+    user = getpass.getuser()
+
+    user_service.enabled("foo", user)
+    res = user_service.enabled("foo", user)
+
+    assert res["changes"] == {}
+    assert res["duplicates_avoided"] == 0
+    assert queries(user_service) == ["is-enabled foo", "enable foo", "is-enabled foo"]
+
+
+def test_unit_file_change_forgets_user(user_service, tmp_path):
+    user = getpass.getuser()
+
+    user_service.stopped("foo", user)
+    user_service.status["foo"]["is-active"] = "active"
+    (tmp_path / "units" / "foo.service").write_text("[Service]\n")
+    res = user_service.stopped("foo", user)
+
+    assert res["duplicates_avoided"] == 0
+    assert queries(user_service) == ["is-active foo", "is-active foo", "stop foo"]
+
+
+def test_missing_user(user_service):
+    res = user_service.enabled("foo", "nobody-here")
+
+    assert res["result"] is False
+    assert res["comment"] == "User 'nobody-here' does not exist"
+    assert user_service.commands == []